@@ -0,0 +1,133 @@
+"""Бенчмарк разбиения длинных ответов на сообщения Telegram
+
+Сравнивает прежний алгоритм (html.escape, затем разбиение по len с rfind)
+с MessageProcessor.split_text на синтетических ответах в стиле deepseek-r1
+размером в сотни килобайт: кириллица, эмодзи вне BMP, символы &<>,
+блок <think> с рассуждениями. Второй корпус — плотный текст без пробелов
+(код, base64, эмодзи подряд), на котором проявляются разрывы внутри &amp;
+и превышение лимита Telegram в UTF-16.
+
+Запуск: python benchmarks/bench_chunker.py [--sizes 100 300 800] [--repeat 5]
+"""
+import argparse
+import html
+import importlib.util
+import os
+import random
+import time
+
+TELEGRAM_LIMIT = 4096
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'c0d1x_ai_v1.0.py')
+
+
+def load_bot():
+    """Импортирует модуль бота по пути к файлу (в имени файла есть точка)"""
+    spec = importlib.util.spec_from_file_location('c0d1x_ai', BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_split(text, max_length):
+    """Прежний MessageProcessor.split_text (до перехода на UTF-16 и разбиение до экранирования)"""
+    if len(text) <= max_length:
+        return [text]
+    parts = []
+    start = 0
+    text_length = len(text)
+    while start < text_length:
+        end = start + max_length
+        if end >= text_length:
+            parts.append(text[start:])
+            break
+        for separator in ['\n', ' ', '.', ',', ';', '!', '?']:
+            break_pos = text.rfind(separator, start, end)
+            if break_pos != -1:
+                break
+        if break_pos == -1:
+            break_pos = end
+        parts.append(text[start:break_pos].strip())
+        start = break_pos
+        while start < text_length and text[start] in [' ', '\n', '\r', '\t']:
+            start += 1
+    return parts
+
+
+def make_answer(size_kb, seed=0):
+    """Синтетический ответ модели рассуждений заданного размера"""
+    rng = random.Random(seed)
+    words = ['рассмотрим', 'случай', 'если', 'x < y', 'a & b', 'функция', 'значит', 'O(n)',
+             'answer', 'the', 'proof', '😀', '🚀', 'итак', '"цитата"', '<tag>', 'шаг']
+    target = size_kb * 1024
+    pieces = ['<think>']
+    total = 0
+    while total < target:
+        sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 25)))
+        tail = rng.choice(['. ', '! ', '? ', '.\n', '.\n\n', ', '])
+        pieces.append(sentence + tail)
+        total += len(sentence) + len(tail)
+        if total > target * 0.7 and pieces[-1] != '</think>' and '</think>' not in pieces:
+            pieces.append('</think>')
+    return ''.join(pieces)
+
+
+def make_dense(size_kb, seed=0):
+    """Плотный текст без пробелов: разрыв приходится на произвольный символ"""
+    rng = random.Random(seed)
+    alphabet = ['a', 'b', '&', '<', '>', 'ж', '😀', '🚀', '=', '/']
+    return ''.join(rng.choice(alphabet) for _ in range(size_kb * 1024 // 2))
+
+
+def broken_entities(part):
+    """Количество сущностей, разрезанных на границе части"""
+    tail = part[-5:]
+    amp = tail.rfind('&')
+    return int(amp != -1 and ';' not in tail[amp:])
+
+
+def measure(function, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run_corpus(processor, limit, name, make_text, sizes, repeat):
+    """Замеряет оба алгоритма на одном корпусе"""
+    print(f"--- {name}")
+    for size in sizes:
+        thoughts, content = processor.extract_thoughts(make_text(size))
+        chunks = [chunk for chunk in (thoughts, content) if chunk]
+        variants = {
+            'прежний': lambda: [part for chunk in chunks for part in legacy_split(html.escape(chunk), limit)],
+            'новый': lambda: [part for chunk in chunks for part in processor.split_text(chunk, limit, escape=True)],
+        }
+        for algorithm, function in variants.items():
+            elapsed, parts = measure(function, repeat)
+            # Запас на префикс "✅ Ответ (продолжение):" и теги <code></code>
+            too_long = sum(1 for part in parts if processor.utf16_length(part) + 40 > TELEGRAM_LIMIT)
+            broken = sum(broken_entities(part) for part in parts)
+            shortest = min(len(part) for part in parts)
+            print(f"{size:>5} {algorithm:>10} {elapsed * 1000:>8.2f} {len(parts):>7} "
+                  f"{too_long:>13} {broken:>8} {shortest:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 300, 800], help='размеры ответов, КБ')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    limit = bot.CONFIG['MAX_HTML_LENGTH']
+
+    print(f"{'KB':>5} {'алгоритм':>10} {'мс':>8} {'частей':>7} {'>4096 UTF-16':>13} {'битых &':>8} {'мин. часть':>10}")
+    run_corpus(bot.MessageProcessor, limit, 'рассуждения', make_answer, args.sizes, args.repeat)
+    run_corpus(bot.MessageProcessor, limit, 'плотный', make_dense, args.sizes, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
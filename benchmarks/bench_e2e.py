@@ -0,0 +1,346 @@
+"""Сквозной нагрузочный тест бота с моками Void AI и Telegram Bot API
+
+Бот запускается целиком (Application, BotHandlers, очереди, планировщик
+отправки) против локальных моков, работающих в отдельном потоке, а генератор
+нагрузки от имени множества пользователей шлёт /text, /image и /model
+(с нажатием кнопки выбора модели) прямо в очередь обновлений приложения.
+
+Каждый запрос идёт в свой чат; он завершён, когда в чат пришло первое
+итоговое сообщение (не статус и не промежуточная правка с курсором) или фото.
+Отчёт: задач в секунду, ожидание в очереди и время от обновления до ответа
+(p50/p95/p99), счётчики моков и рост памяти процесса.
+
+Запуск: python benchmarks/bench_e2e.py [--users 50] [--duration 30] [--mix text=0.8,image=0.1,model=0.1]
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import importlib.util
+import os
+import random
+import resource
+import socket
+import threading
+import time
+import tracemalloc
+
+from mock_telegram import MockTelegram
+from mock_voidai import MockVoidAI
+from mockhttp import MockServer
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'c0d1x_ai_v1.0.py')
+# Промежуточные сообщения: место в очереди, статус генерации, смена модели
+STATUS_PREFIXES = ('⏳ Запрос в очереди', '🔄 Генерирую', '🎨 Генерирую', 'ℹ️')
+# Отказы бота по началу текста (см. reply_rate_limited, reply_overloaded, drop_dead_job)
+REJECTIONS = (
+    ('⏳ Слишком много запросов', 'rate_limited'),
+    ('🚦 Бот сейчас перегружен', 'overloaded'),
+    ('⌛', 'expired'),
+)
+
+
+def load_bot():
+    """Импортирует модуль бота по пути к файлу (в имени файла есть точка)"""
+    spec = importlib.util.spec_from_file_location('c0d1x_ai', BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb():
+    """Текущий RSS процесса (на Linux), иначе пиковый"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(values):
+    if not values:
+        return '—'
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return f"{pick(0.5) * 1000:8.0f} {pick(0.95) * 1000:8.0f} {pick(0.99) * 1000:8.0f}"
+
+
+class MockThread(threading.Thread):
+    """Моки в отдельном потоке со своим циклом событий, чтобы не мешать циклу бота"""
+
+    def __init__(self, voidai, telegram):
+        super().__init__(daemon=True)
+        self.voidai = voidai
+        self.telegram = telegram
+        self.ready = threading.Event()
+        self.loop = None
+        self.voidai_port = None
+        self.telegram_port = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.start_servers())
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def start_servers(self):
+        self.voidai_port = (await MockServer(self.voidai.handle).start()).port
+        self.telegram_port = (await MockServer(self.telegram.handle).start()).port
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class LoadGenerator:
+    """Имитирует пользователей: замкнутый цикл «запрос — ответ — пауза»"""
+
+    def __init__(self, bot, application, args):
+        self.bot = bot
+        self.application = application
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.mix = self.parse_mix(args.mix)
+        self.chats = {}
+        self.next_chat_id = 10 ** 6
+        self.update_id = 0
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.Counter()
+        self.loop = None
+
+    @staticmethod
+    def parse_mix(spec):
+        weights = {}
+        for item in spec.split(','):
+            kind, _, weight = item.partition('=')
+            weights[kind.strip()] = float(weight)
+        return weights
+
+    def on_message(self, method, chat_id, text, message_id, at):
+        """Вызывается в потоке моков для каждого принятого сообщения"""
+        self.loop.call_soon_threadsafe(self.deliver, method, chat_id, text, message_id, at)
+
+    def deliver(self, method, chat_id, text, message_id, at):
+        queue = self.chats.get(chat_id)
+        if queue is not None:
+            queue.put_nowait((method, text or '', message_id, at))
+
+    async def inject(self, data):
+        self.update_id += 1
+        data['update_id'] = self.update_id
+        await self.application.update_queue.put(self.bot.Update.de_json(data, self.application.bot))
+
+    @staticmethod
+    def sender(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+    async def send_command(self, user_id, chat_id, text):
+        command = text.split(' ', 1)[0]
+        await self.inject({'message': {
+            'message_id': 1, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'}, 'from': self.sender(user_id),
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        }})
+
+    async def press_button(self, user_id, chat_id, message_id, data):
+        await self.inject({'callback_query': {
+            'id': str(self.update_id), 'from': self.sender(user_id), 'chat_instance': str(chat_id), 'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'}, 'text': '🤖'}
+        }})
+
+    async def wait_final(self, queue):
+        """Ждёт итоговое сообщение; возвращает (исход, момент)"""
+        cursor = self.bot.CONFIG['STREAM_CURSOR'].strip()
+        while True:
+            method, text, _, at = await queue.get()
+            if method == 'sendPhoto':
+                return 'ok', at
+            if text.endswith(cursor) or text.startswith(STATUS_PREFIXES):
+                continue
+            for prefix, outcome in REJECTIONS:
+                if text.startswith(prefix):
+                    return outcome, at
+            if text.startswith(('❌', '⚠️', '⏳')):
+                return 'error', at
+            return 'ok', at
+
+    def prompt(self):
+        # Распределение с тяжёлым хвостом: популярные запросы повторяются (кэш, объединение)
+        index = int(self.rng.paretovariate(1.2)) % self.args.prompts
+        return f'вопрос {index}: расскажи о числе {index}'
+
+    async def request(self, user_id, kind):
+        chat_id = self.next_chat_id
+        self.next_chat_id += 1
+        queue = self.chats[chat_id] = asyncio.Queue()
+        started = time.monotonic()
+        try:
+            if kind == 'model':
+                await self.send_command(user_id, chat_id, '/model')
+                _, _, message_id, _ = await queue.get()
+                model = self.rng.choice(list(self.bot.MODELS))
+                await self.press_button(user_id, chat_id, message_id, f'model:{model}')
+                _, _, _, finished = await queue.get()
+                outcome = 'ok'
+            else:
+                await self.send_command(user_id, chat_id, f'/{kind} {self.prompt()}')
+                outcome, finished = await self.wait_final(queue)
+        finally:
+            del self.chats[chat_id]
+        self.outcomes[kind, outcome] += 1
+        if outcome == 'ok':
+            self.latencies[kind].append(finished - started)
+
+    async def user(self, user_id, deadline):
+        kinds, weights = zip(*self.mix.items())
+        # Пользователи начинают не одновременно
+        await asyncio.sleep(self.rng.uniform(0, self.args.think_time))
+        while time.monotonic() < deadline:
+            kind = self.rng.choices(kinds, weights)[0]
+            try:
+                await asyncio.wait_for(self.request(user_id, kind), self.args.request_timeout)
+            except asyncio.TimeoutError:
+                self.outcomes[kind, 'timeout'] += 1
+            await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.args.duration
+        await asyncio.gather(*(self.user(user_id, deadline) for user_id in range(1, self.args.users + 1)))
+
+
+async def sample_memory(samples, interval=1.0):
+    while True:
+        samples.append((time.monotonic(), rss_mb()))
+        await asyncio.sleep(interval)
+
+
+async def run(args, mocks, telegram_mock):
+    bot = load_bot()
+    application = bot.build_application()
+    bot_handlers = application.bot_data['bot_handlers']
+
+    # Ожидание в очереди берём у брокера: он видит момент, когда задачу взял воркер
+    queue_waits = collections.defaultdict(list)
+    started = bot_handlers.broker.started
+
+    def record_start(job):
+        queue_waits[job.kind].append(time.monotonic() - job.enqueued_at)
+        started(job)
+    bot_handlers.broker.started = record_start
+
+    load = LoadGenerator(bot, application, args)
+    telegram_mock.on_message = load.on_message
+    memory = []
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        gc.collect()
+        objects_before = len(gc.get_objects())
+        if args.tracemalloc:
+            tracemalloc.start()
+            snapshot_before = tracemalloc.take_snapshot()
+        sampler = asyncio.create_task(sample_memory(memory))
+
+        began = time.monotonic()
+        await load.run()
+        elapsed = time.monotonic() - began
+
+        sampler.cancel()
+        gc.collect()
+        objects_after = len(gc.get_objects())
+        top_growth = []
+        if args.tracemalloc:
+            top_growth = tracemalloc.take_snapshot().compare_to(snapshot_before, 'lineno')[:10]
+            tracemalloc.stop()
+        scheduler_stats = bot.send_scheduler.stats()
+        await application.stop()
+        await bot.post_stop(application)
+
+    report(args, load, queue_waits, elapsed, memory, objects_before, objects_after, top_growth,
+           mocks, telegram_mock, scheduler_stats)
+
+
+def report(args, load, queue_waits, elapsed, memory, objects_before, objects_after, top_growth,
+           mocks, telegram_mock, scheduler_stats):
+    print()
+    print(f"Пользователей: {args.users}, длительность: {elapsed:.1f} с, смесь: {args.mix}")
+    completed = sum(count for (kind, outcome), count in load.outcomes.items() if kind != 'model')
+    print(f"Задач (text + image) в секунду: {completed / elapsed:.2f}")
+    print()
+    print(f"{'':24} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8}  исходы")
+    for kind in load.mix:
+        outcomes = ', '.join(f"{outcome}: {count}" for (k, outcome), count in sorted(load.outcomes.items()) if k == kind)
+        print(f"{'от обновления до ответа':>16} {kind:>6} {percentiles(load.latencies[kind])}  {outcomes}")
+    for kind, waits in sorted(queue_waits.items()):
+        print(f"{'ожидание в очереди':>16} {kind:>5} {percentiles(waits)}  задач: {len(waits)}")
+    print()
+    print(f"Void AI: {dict(mocks.voidai.stats)}")
+    print(f"Telegram: {dict(telegram_mock.calls)}, отказов 429: {telegram_mock.flood_errors}")
+    print(f"Планировщик отправки: {scheduler_stats}")
+    if memory:
+        start, end = memory[0][1], memory[-1][1]
+        print(f"Память (RSS): {start:.1f} → {end:.1f} МБ ({end - start:+.1f}), пик {max(rss for _, rss in memory):.1f} МБ")
+    print(f"Объектов Python: {objects_before} → {objects_after} ({objects_after - objects_before:+d})")
+    for stat in top_growth:
+        print(f"  {stat}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30.0, help='секунд подачи нагрузки')
+    parser.add_argument('--mix', default='text=0.8,image=0.1,model=0.1')
+    parser.add_argument('--think-time', type=float, default=2.0, help='средняя пауза пользователя, с')
+    parser.add_argument('--prompts', type=int, default=500, help='различных запросов в пуле')
+    parser.add_argument('--request-timeout', type=float, default=180.0)
+    parser.add_argument('--no-stream', action='store_true', help='выключить потоковую генерацию')
+    parser.add_argument('--no-cache', action='store_true', help='выключить кэш ответов')
+    parser.add_argument('--text-workers', type=int)
+    parser.add_argument('--image-workers', type=int)
+    parser.add_argument('--tracemalloc', action='store_true', help='показать строки с наибольшим ростом памяти')
+    parser.add_argument('--seed', type=int, default=1)
+    MockVoidAI.add_arguments(parser)
+    MockTelegram.add_arguments(parser)
+    args = parser.parse_args()
+
+    voidai = MockVoidAI.from_args(args)
+    telegram = MockTelegram.from_args(args)
+    mocks = MockThread(voidai, telegram)
+    mocks.start()
+    mocks.ready.wait()
+
+    # Модуль бота читает настройки из окружения при импорте
+    voidai_url = f'http://127.0.0.1:{mocks.voidai_port}'
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:BENCH',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{mocks.telegram_port}/bot',
+        'VOIDAI_API_KEY': 'bench',
+        'VOIDAI_BASE_URL': voidai_url,
+        'VOIDAI_TEXT_URL': f'{voidai_url}/v1/chat/completions',
+        'VOIDAI_IMAGE_URL': f'{voidai_url}/v1/images/generations',
+        'PORT': str(free_port()),
+        'JOURNAL_ENABLED': '0',
+        'IMAGE_CACHE_DB_PATH': '',
+        'STREAM_TEXT': '0' if args.no_stream else '1',
+        'CACHE_ENABLED': '0' if args.no_cache else '1',
+    })
+    if args.text_workers:
+        os.environ['TEXT_WORKERS'] = str(args.text_workers)
+    if args.image_workers:
+        os.environ['IMAGE_WORKERS'] = str(args.image_workers)
+
+    try:
+        asyncio.run(run(args, mocks, telegram))
+    finally:
+        mocks.stop()
+
+
+if __name__ == '__main__':
+    main()
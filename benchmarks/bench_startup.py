@@ -0,0 +1,98 @@
+"""Бенчмарк холодного старта: время импорта модуля бота и самые дорогие импорты
+
+Каждый замер — новый процесс Python, как при запуске контейнера после
+простоя. Сравнивает роль процесса приёма (BOT_ROLE=all, импортирует
+telegram.ext при сборке приложения) и процесса-воркера (BOT_ROLE=worker,
+telegram.ext не нужен). Список самых дорогих импортов берётся из
+python -X importtime.
+
+Запуск: python benchmarks/bench_startup.py [--repeat 5] [--top 15]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'c0d1x_ai_v1.0.py')
+
+# Загружает модуль так же, как при запуске, но без main(); для роли all ещё и собирает приложение
+LOAD_SCRIPT = f"""
+import importlib.util, os, time
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('c0d1x_ai', {BOT_PATH!r})
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+loaded = time.perf_counter()
+if os.environ['BOT_ROLE'] != 'worker':
+    bot.build_application()
+print(loaded - started, time.perf_counter() - loaded)
+"""
+
+
+def bot_env(role):
+    env = dict(os.environ)
+    env.update({
+        'BOT_ROLE': role,
+        'TELEGRAM_BOT_TOKEN': env.get('TELEGRAM_BOT_TOKEN', '123456:TEST'),
+        'VOIDAI_API_KEY': env.get('VOIDAI_API_KEY', 'test'),
+        'JOURNAL_ENABLED': '0',
+    })
+    return env
+
+
+def measure(role, repeat):
+    """Медианы времени процесса, импорта модуля и сборки приложения по repeat запускам"""
+    totals, imports, builds = [], [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', LOAD_SCRIPT], env=bot_env(role),
+            capture_output=True, text=True, check=True
+        ).stdout
+        totals.append(time.perf_counter() - started)
+        module_time, build_time = map(float, output.split())
+        imports.append(module_time)
+        builds.append(build_time)
+    return statistics.median(totals), statistics.median(imports), statistics.median(builds)
+
+
+def top_imports(role, top):
+    """Самые дорогие пакеты верхнего уровня по данным -X importtime (накопительное время, мс)"""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', LOAD_SCRIPT], env=bot_env(role),
+        capture_output=True, text=True, check=True
+    ).stderr
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Вложенные импорты выводятся с отступом; время верхнего уровня включает их
+        name = name[1:]
+        if not name.startswith(' '):
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + int(cumulative) / 1000
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='сколько самых дорогих импортов показать')
+    args = parser.parse_args()
+
+    print(f"{'роль':>7} {'процесс, мс':>12} {'модуль, мс':>11} {'приложение, мс':>15}")
+    for role in ('all', 'worker'):
+        total, module_time, build_time = measure(role, args.repeat)
+        print(f"{role:>7} {total * 1000:>12.1f} {module_time * 1000:>11.1f} {build_time * 1000:>15.1f}")
+
+    for role in ('all', 'worker'):
+        print(f"--- самые дорогие импорты ({role})")
+        for package, milliseconds in top_imports(role, args.top):
+            print(f"{package:>30} {milliseconds:>8.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
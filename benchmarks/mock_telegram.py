@@ -0,0 +1,167 @@
+"""Мок Telegram Bot API для нагрузочных тестов
+
+Отвечает на вызовы, которые делает бот (getMe, sendMessage, editMessageText,
+sendPhoto, answerCallbackQuery, deleteMessage и т. п.), считает их и
+применяет лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду
+в личный чат (с короткой пачкой) и 20 в минуту в группу. Превышение
+получает 429 с retry_after, как настоящий API.
+
+Отдельный запуск: python benchmarks/mock_telegram.py --port 8091, затем
+бот с TELEGRAM_API_URL=http://127.0.0.1:8091/bot.
+"""
+import argparse
+import asyncio
+import collections
+import email.parser
+import email.policy
+import json
+import math
+import re
+import time
+import urllib.parse
+
+from mockhttp import MockServer
+
+SENDING_METHODS = {'sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument'}
+
+
+class MockTelegram:
+    def __init__(self, latency=0.03, global_rate=30, chat_rate=1.0, chat_burst=3, group_per_minute=20,
+                 on_message=None):
+        self.latency = latency
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60.0
+        self.on_message = on_message
+        self.window = collections.deque()
+        self.buckets = {}
+        self.next_message_id = 1
+        self.calls = collections.Counter()
+        self.flood_errors = 0
+        self.bytes_received = 0
+
+    @classmethod
+    def add_arguments(cls, parser):
+        group = parser.add_argument_group('мок Telegram Bot API')
+        group.add_argument('--telegram-latency', type=float, default=0.03, help='задержка ответа Bot API, с')
+        group.add_argument('--telegram-global-rate', type=float, default=30, help='сообщений в секунду на бота')
+        group.add_argument('--telegram-chat-rate', type=float, default=1.0, help='сообщений в секунду в личный чат')
+        group.add_argument('--telegram-chat-burst', type=int, default=3, help='допустимая пачка в чат')
+
+    @classmethod
+    def from_args(cls, args, on_message=None):
+        return cls(args.telegram_latency, args.telegram_global_rate, args.telegram_chat_rate,
+                   args.telegram_chat_burst, on_message=on_message)
+
+    @staticmethod
+    def parse_params(request):
+        """Параметры вызова: форма, multipart (файлы) или JSON"""
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + request.body
+            )
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                params[name] = payload if part.get_filename() else payload.decode()
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(request.body or b'{}')
+        return {name: values[-1] for name, values in urllib.parse.parse_qs(request.body.decode()).items()}
+
+    def flood_wait(self, chat_id, now):
+        """Через сколько секунд можно отправить в чат; 0 — можно сейчас (токен списывается)"""
+        while self.window and now - self.window[0] >= 1:
+            self.window.popleft()
+        if len(self.window) >= self.global_rate:
+            return 1
+        rate = self.group_rate if chat_id < 0 else self.chat_rate
+        burst = 1 if chat_id < 0 else self.chat_burst
+        tokens, updated = self.buckets.get(chat_id, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self.buckets[chat_id] = (tokens, now)
+            return max(1, math.ceil((1 - tokens) / rate))
+        self.buckets[chat_id] = (tokens - 1, now)
+        self.window.append(now)
+        return 0
+
+    @staticmethod
+    def reply(status, payload):
+        return status, {'Content-Type': 'application/json'}, json.dumps(payload, ensure_ascii=False).encode()
+
+    def message(self, chat_id, message_id, params):
+        result = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'}
+        }
+        if 'text' in params:
+            result['text'] = params['text']
+        return result
+
+    async def handle(self, request):
+        match = re.match(r'/bot[^/]+/(\w+)', request.path)
+        if match is None:
+            return self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+        method = match.group(1)
+        params = self.parse_params(request)
+        self.calls[method] += 1
+        self.bytes_received += len(request.body)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            return self.reply(200, {'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'
+            }})
+        if method not in SENDING_METHODS:
+            return self.reply(200, {'ok': True, 'result': True})
+
+        chat_id = int(params['chat_id'])
+        now = time.monotonic()
+        wait = self.flood_wait(chat_id, now)
+        if wait:
+            self.flood_errors += 1
+            return self.reply(429, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {wait}',
+                'parameters': {'retry_after': wait}
+            })
+
+        if method == 'editMessageText':
+            message_id = int(params['message_id'])
+        else:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        result = self.message(chat_id, message_id, params)
+        text = params.get('text') or params.get('caption')
+        if method == 'sendPhoto':
+            file_id = params['photo'] if isinstance(params.get('photo'), str) else f'photo-{message_id}'
+            result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1024, 'height': 1024}]
+            result['caption'] = params.get('caption', '')
+        if self.on_message is not None:
+            self.on_message(method, chat_id, text, message_id, now)
+        return self.reply(200, {'ok': True, 'result': result})
+
+
+async def serve(args):
+    mock = MockTelegram.from_args(args)
+    server = await MockServer(mock.handle).start(args.host, args.port)
+    print(f"Мок Telegram Bot API слушает {args.host}:{server.port}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8091)
+    MockTelegram.add_arguments(parser)
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
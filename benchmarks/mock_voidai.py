@@ -0,0 +1,135 @@
+"""Мок Void AI (OpenAI-совместимый API) для нагрузочных тестов
+
+Задержка до первого байта — логнормальная с заданной медианой и разбросом,
+часть запросов получает 429 (с Retry-After) или 5xx. Поддерживает потоковые
+ответы (SSE, в том числе reasoning_content) и генерацию изображений.
+
+Отдельный запуск: python benchmarks/mock_voidai.py --port 8090, затем
+бот с VOIDAI_TEXT_URL=http://127.0.0.1:8090/v1/chat/completions
+и VOIDAI_IMAGE_URL=http://127.0.0.1:8090/v1/images/generations.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import random
+
+from mockhttp import MockServer
+
+WORDS = ['рассмотрим', 'ответ', 'функция', 'x < y', 'a & b', 'значит', 'итак', 'the', 'answer',
+         'пример', '😀', '🚀', 'шаг', 'код', '"цитата"', 'результат', 'список', 'O(n)']
+
+
+class MockVoidAI:
+    def __init__(self, latency_median=0.8, latency_sigma=0.5, rate_429=0.0, rate_5xx=0.0,
+                 answer_chars=1500, stream_chunks=30, chunk_interval=0.05, think_share=0.2,
+                 image_kb=64, seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.answer_chars = answer_chars
+        self.stream_chunks = stream_chunks
+        self.chunk_interval = chunk_interval
+        self.think_share = think_share
+        self.rng = random.Random(seed)
+        self.image_b64 = base64.b64encode(self.rng.randbytes(image_kb * 1024)).decode()
+        self.stats = {'text': 0, 'stream': 0, 'image': 0, '429': 0, '5xx': 0}
+
+    @classmethod
+    def add_arguments(cls, parser):
+        group = parser.add_argument_group('мок Void AI')
+        group.add_argument('--voidai-latency', type=float, default=0.8, help='медиана задержки до первого байта, с')
+        group.add_argument('--voidai-sigma', type=float, default=0.5, help='разброс логнормальной задержки')
+        group.add_argument('--voidai-429', type=float, default=0.0, help='доля ответов 429')
+        group.add_argument('--voidai-5xx', type=float, default=0.0, help='доля ответов 503')
+        group.add_argument('--answer-chars', type=int, default=1500, help='средний размер ответа, символов')
+        group.add_argument('--stream-chunks', type=int, default=30, help='фрагментов в потоковом ответе')
+        group.add_argument('--chunk-interval', type=float, default=0.05, help='пауза между фрагментами, с')
+        group.add_argument('--think-share', type=float, default=0.2, help='доля ответов с рассуждениями')
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.voidai_latency, args.voidai_sigma, args.voidai_429, args.voidai_5xx,
+                   args.answer_chars, args.stream_chunks, args.chunk_interval, args.think_share)
+
+    def latency(self):
+        return self.rng.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+    def make_text(self, size):
+        words = []
+        total = 0
+        while total < size:
+            word = self.rng.choice(WORDS)
+            words.append(word)
+            total += len(word) + 1
+            if self.rng.random() < 0.08:
+                words.append(self.rng.choice(['.\n', '.\n\n', '!']))
+        return ' '.join(words)
+
+    def make_answer(self):
+        """(рассуждения, ответ) — размер ответа разбросан вокруг answer_chars"""
+        size = max(20, int(self.rng.expovariate(1 / self.answer_chars)))
+        thoughts = self.make_text(size // 2) if self.rng.random() < self.think_share else ''
+        return thoughts, self.make_text(size)
+
+    @staticmethod
+    def json_response(status, payload, headers=None):
+        return status, {'Content-Type': 'application/json', **(headers or {})}, json.dumps(payload).encode()
+
+    async def handle(self, request):
+        if request.method == 'HEAD' or request.method == 'GET':
+            return 200, {}, b''
+        await asyncio.sleep(self.latency())
+        roll = self.rng.random()
+        if roll < self.rate_429:
+            self.stats['429'] += 1
+            return self.json_response(429, {'error': {'message': 'rate limited'}}, {'Retry-After': '1'})
+        if roll < self.rate_429 + self.rate_5xx:
+            self.stats['5xx'] += 1
+            return self.json_response(503, {'error': {'message': 'overloaded'}})
+
+        payload = json.loads(request.body or b'{}')
+        if request.path.endswith('/images/generations'):
+            self.stats['image'] += 1
+            return self.json_response(200, {'data': [{'b64_json': self.image_b64}]})
+
+        thoughts, content = self.make_answer()
+        if payload.get('stream'):
+            self.stats['stream'] += 1
+            return 200, {'Content-Type': 'text/event-stream'}, self.stream(thoughts, content)
+        self.stats['text'] += 1
+        text = f'<think>{thoughts}</think>{content}' if thoughts else content
+        return self.json_response(200, {'choices': [{'message': {'role': 'assistant', 'content': text}}]})
+
+    async def stream(self, thoughts, content):
+        """SSE-поток: сначала reasoning_content, потом content"""
+        pieces = [('reasoning_content', thoughts), ('content', content)]
+        total = len(thoughts) + len(content)
+        step = max(1, total // max(1, self.stream_chunks))
+        for field, text in pieces:
+            for start in range(0, len(text), step):
+                await asyncio.sleep(self.chunk_interval)
+                chunk = {'choices': [{'delta': {field: text[start:start + step]}}]}
+                yield f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode()
+        yield b'data: [DONE]\n\n'
+
+
+async def serve(args):
+    mock = MockVoidAI.from_args(args)
+    server = await MockServer(mock.handle).start(args.host, args.port)
+    print(f"Мок Void AI слушает {args.host}:{server.port}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    MockVoidAI.add_arguments(parser)
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Минимальный HTTP/1.1 сервер для моков: keep-alive и потоковые (chunked) ответы
+
+Обработчик получает MockRequest и возвращает (статус, заголовки, тело), где
+тело — bytes или асинхронный итератор bytes (тогда ответ идёт частями).
+"""
+import asyncio
+import http
+
+
+class MockRequest:
+    __slots__ = ('method', 'path', 'headers', 'body')
+
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class MockServer:
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = None
+        self.port = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def read_request(self, reader):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        method, path, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        body = await reader.readexactly(length) if length else b''
+        return MockRequest(method.upper(), path, headers, body)
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                status, headers, body = await self.handler(request)
+                head = [f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}']
+                head += [f'{name}: {value}' for name, value in headers.items()]
+                if isinstance(body, (bytes, bytearray)):
+                    head.append(f'Content-Length: {len(body)}')
+                    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+                else:
+                    head.append('Transfer-Encoding: chunked')
+                    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+                    async for chunk in body:
+                        writer.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                        await writer.drain()
+                    writer.write(b'0\r\n\r\n')
+                await writer.drain()
+                if request.headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -1,30 +1,213 @@
+# Аннотации не вычисляются при импорте: telegram.ext нужен только процессу приёма обновлений
+from __future__ import annotations
+
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import random
+import re
 import asyncio
 import base64
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
 import html
+import io
+import http
 import httpx
+import json
+import hashlib
+import hmac
+import itertools
+import secrets
+import signal
+import sys
 import threading
-import time
-from datetime import datetime
+import traceback
+import typing
+from datetime import datetime, timezone
+from types import SimpleNamespace
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+if typing.TYPE_CHECKING:
+    from telegram.ext import Application, ContextTypes
+
+IMPORTS_DONE = time.perf_counter()
 
 # Конфигурация
 CONFIG = {
     'VOIDAI_API_KEY': os.getenv('VOIDAI_API_KEY'),
+    # Пул ключей через запятую; без него используется один VOIDAI_API_KEY
+    'VOIDAI_API_KEYS': [
+        key.strip() for key in (os.getenv('VOIDAI_API_KEYS') or os.getenv('VOIDAI_API_KEY') or '').split(',')
+        if key.strip()
+    ],
+    'VOIDAI_KEY_RPM': int(os.getenv('VOIDAI_KEY_RPM', 60)),  # Запросов в минуту на ключ (уточняется по x-ratelimit-*)
+    'VOIDAI_KEY_TPM': int(os.getenv('VOIDAI_KEY_TPM', 0)),  # Токенов в минуту на ключ; 0 — пока не сообщит Void AI
+    'VOIDAI_KEY_OUTPUT_TOKENS': 800,  # Ожидаемая длина ответа при списании токенов с ключа
+    'VOIDAI_KEY_RATE_QUARANTINE': float(os.getenv('VOIDAI_KEY_RATE_QUARANTINE', 20)),  # Отдых ключа после 429 без Retry-After
+    'VOIDAI_KEY_AUTH_QUARANTINE': float(os.getenv('VOIDAI_KEY_AUTH_QUARANTINE', 600)),  # Отдых ключа после 401/403
     'TELEGRAM_TOKEN': os.getenv('TELEGRAM_BOT_TOKEN'),
-    'VOIDAI_TEXT_URL': 'https://api.voidai.app/v1/chat/completions',
-    'VOIDAI_IMAGE_URL': 'https://api.voidai.app/v1/images/generations',
+    'TELEGRAM_API_URL': os.getenv('TELEGRAM_API_URL'),  # Свой сервер Bot API, например http://127.0.0.1:8081/bot
+    'VOIDAI_TEXT_URL': os.getenv('VOIDAI_TEXT_URL', 'https://api.voidai.app/v1/chat/completions'),
+    'VOIDAI_IMAGE_URL': os.getenv('VOIDAI_IMAGE_URL', 'https://api.voidai.app/v1/images/generations'),
     'MAX_MESSAGE_LENGTH': 4000,
     'MAX_HTML_LENGTH': 3500,
-    'REQUEST_TIMEOUT': 120.0,
+    'LONG_ANSWER_POLICY': os.getenv('LONG_ANSWER_POLICY', 'document'),  # document — длинный ответ файлом, messages — частями
+    'LONG_ANSWER_MAX_MESSAGES': int(os.getenv('LONG_ANSWER_MAX_MESSAGES', 3)),  # Больше частей — отправляем файлом
+    'LONG_ANSWER_MAX_CHARS': int(os.getenv('LONG_ANSWER_MAX_CHARS', 0)),  # Или длиннее стольких символов (0 — не учитывать)
+    'LONG_ANSWER_PREVIEW_CHARS': 700,  # Длина превью длинного ответа
+    'LONG_ANSWER_FORMAT': os.getenv('LONG_ANSWER_FORMAT', 'md'),  # Файл ответа: md или txt
+    'REQUEST_TIMEOUT': 120.0,  # Таймаут чтения ответа модели
+    'CONNECT_TIMEOUT': float(os.getenv('CONNECT_TIMEOUT', 10.0)),
+    'WRITE_TIMEOUT': float(os.getenv('WRITE_TIMEOUT', 30.0)),
+    'POOL_TIMEOUT': float(os.getenv('POOL_TIMEOUT', 30.0)),  # Ожидание свободного соединения в пуле
+    'HTTP2': os.getenv('HTTP2', '0') == '1',  # Мультиплексирование HTTP/2 (нужен пакет h2)
+    'HTTP_KEEPALIVE_EXPIRY': float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 120.0)),
+    'HTTP_PREWARM_CONNECTIONS': int(os.getenv('HTTP_PREWARM_CONNECTIONS', 2)),
+    'JOURNAL_ENABLED': os.getenv('JOURNAL_ENABLED', '1') == '1',  # Журнал задач: очередь переживает перезапуск
+    'JOURNAL_PATH': os.getenv('JOURNAL_PATH', 'c0d1x_jobs.db'),
+    'JOURNAL_FLUSH_INTERVAL': float(os.getenv('JOURNAL_FLUSH_INTERVAL', 0.02)),  # Окно сбора пачки перед записью
+    'JOURNAL_MAX_ATTEMPTS': int(os.getenv('JOURNAL_MAX_ATTEMPTS', 3)),  # Задачу, ронявшую бот столько раз, не повторяем
     'PORT': int(os.getenv('PORT', 8080)),
+    'ROLE': os.getenv('BOT_ROLE', 'all'),  # all — всё в одном процессе; ingest — приём обновлений и брокер; worker — воркер
+    'BROKER_HOST': os.getenv('BROKER_HOST', '127.0.0.1'),  # 0.0.0.0, чтобы принимать воркеры с других хостов
+    'BROKER_PORT': int(os.getenv('BROKER_PORT', 8765)),
+    'BROKER_SECRET': os.getenv('BROKER_SECRET') or secrets.token_urlsafe(32),  # Общий секрет процесса приёма и воркеров
+    'WORKER_PROCESSES': int(os.getenv('WORKER_PROCESSES', 0)),  # Локальные процессы-воркеры в роли ingest
+    'UPDATE_MODE': os.getenv('UPDATE_MODE', 'polling'),  # polling или webhook (на порту PORT)
+    'WEBHOOK_URL': os.getenv('WEBHOOK_URL', os.getenv('RENDER_EXTERNAL_URL')),  # Публичный адрес бота
+    'WEBHOOK_PATH': os.getenv('WEBHOOK_PATH', '/telegram/webhook'),
+    'WEBHOOK_SECRET': os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32),  # Проверяется в каждом запросе Telegram
+    'WEBHOOK_MAX_CONNECTIONS': int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)),
+    'IMAGE_MODEL': 'gpt-image-1',
+    'TEXT_WORKERS': int(os.getenv('TEXT_WORKERS', 8)),  # Количество воркеров текстовой очереди
+    'IMAGE_WORKERS': int(os.getenv('IMAGE_WORKERS', 3)),  # Количество воркеров очереди изображений
+    'MODEL_CONCURRENCY_INITIAL': int(os.getenv('MODEL_CONCURRENCY_INITIAL', 2)),
+    'MODEL_CONCURRENCY_MIN': 1,
+    'MODEL_CONCURRENCY_MAX': int(os.getenv('MODEL_CONCURRENCY_MAX', 16)),
+    'MODEL_LATENCY_TOLERANCE': 1.5,  # Во сколько раз задержка может превысить базовую, оставаясь "здоровой"
+    'STREAM_TEXT': os.getenv('STREAM_TEXT', '1') == '1',  # Потоковая генерация текста
+    'STREAM_EDIT_INTERVAL': float(os.getenv('STREAM_EDIT_INTERVAL', 1.5)),  # Не чаще одного редактирования за N секунд
+    'STREAM_CURSOR': ' ▌',
+    'CACHE_ENABLED': os.getenv('CACHE_ENABLED', '1') == '1',  # Кэш текстовых ответов
+    'CACHE_MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 1000)),
+    'CACHE_TTL': int(os.getenv('CACHE_TTL', 3600)),  # Время жизни ответа в кэше, секунды
+    'CACHE_DB_PATH': os.getenv('CACHE_DB_PATH'),  # Файл SQLite для дискового уровня кэша (по умолчанию выключен)
+    'CACHE_DISK_MAX_ENTRIES': int(os.getenv('CACHE_DISK_MAX_ENTRIES', 50000)),
+    'CACHE_BYPASS_MODELS': {'gpt-4o-mini-search-preview'},  # Модели, ответы которых всегда должны быть свежими
+    'IMAGE_SIZE': '1024x1024',
+    'IMAGE_QUALITY': 'standard',
+    'IMAGE_RESPONSE_FORMAT': os.getenv('IMAGE_RESPONSE_FORMAT', 'b64_json'),  # url — Telegram скачивает изображение сам
+    'IMAGE_RECOMPRESS': os.getenv('IMAGE_RECOMPRESS', '').lower() or None,  # jpeg или webp перед загрузкой (нужен Pillow)
+    'IMAGE_RECOMPRESS_QUALITY': int(os.getenv('IMAGE_RECOMPRESS_QUALITY', 85)),
+    'IMAGE_MAX_SIDE': int(os.getenv('IMAGE_MAX_SIDE', 0)),  # Уменьшать до этой стороны при перекодировании (0 — не уменьшать)
+    'IMAGE_PIPELINE_EXECUTOR': os.getenv('IMAGE_PIPELINE_EXECUTOR', 'thread'),  # thread или process
+    'IMAGE_PIPELINE_WORKERS': int(os.getenv('IMAGE_PIPELINE_WORKERS', 2)),
+    'IMAGE_CACHE_ENABLED': os.getenv('IMAGE_CACHE_ENABLED', '1') == '1',  # Повторная отправка изображений по file_id
+    'IMAGE_CACHE_MAX_ENTRIES': int(os.getenv('IMAGE_CACHE_MAX_ENTRIES', 5000)),
+    'IMAGE_CACHE_TTL': int(os.getenv('IMAGE_CACHE_TTL', 30 * 24 * 3600)),
+    'IMAGE_CACHE_DB_PATH': os.getenv('IMAGE_CACHE_DB_PATH', 'c0d1x_image_cache.db'),  # Файл SQLite с file_id изображений
+    'USER_TEXT_RATE': float(os.getenv('USER_TEXT_RATE', 10)),  # Текстовых запросов в минуту на пользователя
+    'USER_TEXT_BURST': int(os.getenv('USER_TEXT_BURST', 5)),
+    'USER_IMAGE_RATE': float(os.getenv('USER_IMAGE_RATE', 3)),  # Изображений в минуту на пользователя
+    'USER_IMAGE_BURST': int(os.getenv('USER_IMAGE_BURST', 2)),
+    'TEXT_QUEUE_MAX': int(os.getenv('TEXT_QUEUE_MAX', 500)),  # Больше задач в очередь не берём (0 — без ограничения)
+    'IMAGE_QUEUE_MAX': int(os.getenv('IMAGE_QUEUE_MAX', 100)),
+    'QUEUE_SHED_POLICY': os.getenv('QUEUE_SHED_POLICY', 'degrade'),  # reject — только отказ при полной очереди, degrade — ещё и дешёвая модель
+    'QUEUE_DEGRADE_AT': float(os.getenv('QUEUE_DEGRADE_AT', 0.5)),  # С какой заполненности очереди текст отвечает дешёвая модель
+    'QUEUE_DEGRADE_MODEL': os.getenv('QUEUE_DEGRADE_MODEL', 'gpt-4o-mini'),
+    'QUEUE_FEEDBACK_INTERVAL': float(os.getenv('QUEUE_FEEDBACK_INTERVAL', 5)),  # Как часто обновлять место в очереди
+    'QUEUE_FEEDBACK_MIN_AHEAD': 1,  # Сообщать место в очереди, если впереди хотя бы столько задач
+    'QUEUE_SERVICE_SMOOTHING': 0.2,  # Вес нового замера во времени обслуживания (для оценки ожидания)
+    # Сколько секунд задача может ждать начала выполнения: сначала ищется модель, затем команда
+    'JOB_DEADLINES': {
+        'text': int(os.getenv('TEXT_JOB_DEADLINE', 300)),
+        'image': int(os.getenv('IMAGE_JOB_DEADLINE', 600)),
+        'gpt-5': 600,
+        'deepseek-r1': 600,
+        'o3-mini': 600
+    },
+    'VOIDAI_BASE_URL': os.getenv('VOIDAI_BASE_URL', 'https://api.voidai.app'),
+    'RETRY_ATTEMPTS': int(os.getenv('RETRY_ATTEMPTS', 3)),  # Попыток на модель при 429/5xx и сетевых ошибках
+    'RETRY_BASE_DELAY': 0.5,
+    'RETRY_MAX_DELAY': 10.0,
+    'RETRY_AFTER_MAX': 30.0,  # Дольше ждать по Retry-After не будем
+    'BREAKER_THRESHOLD': int(os.getenv('BREAKER_THRESHOLD', 5)),  # Ошибок подряд до размыкания предохранителя
+    'BREAKER_COOLDOWN': float(os.getenv('BREAKER_COOLDOWN', 30.0)),
+    'HEDGE_REQUESTS': os.getenv('HEDGE_REQUESTS', '0') == '1',  # Дублировать медленные запросы после p95
+    'HEDGE_QUANTILE': 0.95,
+    'HEDGE_MIN_SAMPLES': 20,
+    'SEND_GLOBAL_RATE': float(os.getenv('SEND_GLOBAL_RATE', 30)),  # Сообщений в секунду на весь бот
+    'SEND_CHAT_RATE': float(os.getenv('SEND_CHAT_RATE', 1)),  # Сообщений в секунду в личный чат
+    'SEND_GROUP_RATE': float(os.getenv('SEND_GROUP_RATE', 20)),  # Сообщений в минуту в группу
+    'SEND_CHAT_BURST': int(os.getenv('SEND_CHAT_BURST', 3)),  # Короткая пачка сверх лимита чата
+    'SEND_STATUS_MAX_AGE': 10.0,  # Статус, не отправленный за это время, уже не нужен
+    'SEND_MAX_RETRIES': 3,  # Повторов ответа после RetryAfter
+    # Цепочки замены модели, когда её предохранитель разомкнут
+    'MODEL_FALLBACKS': {
+        'gpt-5': ['gpt-4o', 'gpt-4o-mini'],
+        'gpt-5-mini': ['gpt-4o-mini'],
+        'chatgpt-4o-latest': ['gpt-4o', 'gpt-4o-mini'],
+        'gpt-4o': ['gpt-4o-mini'],
+        'o3-mini': ['o4-mini', 'gpt-4o-mini'],
+        'o4-mini': ['o3-mini', 'gpt-4o-mini'],
+        'deepseek-r1': ['deepseek-v3', 'gpt-4o-mini'],
+        'deepseek-v3': ['gpt-4o-mini'],
+        'gemini-2.5-flash': ['gemini-2.0-flash', 'gpt-4o-mini'],
+        'grok-4': ['gpt-4o', 'gpt-4o-mini'],
+        'default': ['gpt-4o-mini']
+    },
+    'HISTORY_ENABLED': os.getenv('HISTORY_ENABLED', '0') == '1',  # Режим диалога: /text помнит предыдущие реплики
+    'HISTORY_MAX_USERS': int(os.getenv('HISTORY_MAX_USERS', 10000)),  # Сверх этого вытесняются давно писавшие
+    'HISTORY_IDLE_TTL': int(os.getenv('HISTORY_IDLE_TTL', 3600)),  # История забывается после часа тишины
+    # Сколько токенов истории (вместе с вопросом) отправлять модели
+    'HISTORY_TOKEN_BUDGET': {
+        'gpt-5': 8000,
+        'gpt-4o': 6000,
+        'chatgpt-4o-latest': 6000,
+        'gemini-2.5-flash': 8000,
+        'grok-4': 8000,
+        'gpt-3.5-turbo': 2000,
+        'default': 4000
+    },
+    'DEFAULT_MODEL': os.getenv('DEFAULT_MODEL', 'auto'),  # Модель /text, пока пользователь не выбрал свою
+    'AUTO_MODEL_TIER': os.getenv('AUTO_MODEL_TIER', 'standard'),  # Среди каких моделей выбирает "auto"
+    'AUTO_MODEL_TIERS': {
+        'fast': ['gpt-4o-mini', 'gpt-3.5-turbo', 'gemini-2.0-flash', 'deepseek-v3'],
+        'standard': ['gpt-4o-mini', 'gpt-4o', 'gemini-2.5-flash', 'gpt-5-mini', 'deepseek-v3'],
+        'premium': ['gpt-5', 'gpt-4o', 'chatgpt-4o-latest', 'gemini-2.5-flash', 'grok-4']
+    },
+    'AUTO_SMOOTHING': 0.2,  # Вес нового замера в сглаженной задержке и доле ошибок
+    'AUTO_UNKNOWN_LATENCY': 5.0,  # Предполагаемая задержка модели без замеров, секунды
+    'AUTO_EXPLORE': 0.05,  # Доля запросов "auto", отправляемых случайной модели уровня
+    'STARTUP_BUDGET': float(os.getenv('STARTUP_BUDGET', 3.0)),  # Предупреждать, если запуск дольше, секунды
+    'TRACE_ENABLED': os.getenv('TRACE_ENABLED', '1') == '1',  # Трассировка этапов запросов (/debug/trace)
+    'TRACE_BUFFER_SIZE': int(os.getenv('TRACE_BUFFER_SIZE', 500)),  # Сколько последних трасс хранить в памяти
+    'TRACE_SLOW_SECONDS': float(os.getenv('TRACE_SLOW_SECONDS', 30.0)),  # Запросы дольше пишутся в лог с разбивкой по этапам
+    'TRACE_OTLP_FILE': os.getenv('TRACE_OTLP_FILE'),  # Файл для экспорта трасс в OTLP/JSON (по умолчанию выключен)
+    'TRACE_MAX_SPANS': 200,  # Больше этапов в одной трассе не записываем
+    'TRACE_SERVICE_NAME': os.getenv('TRACE_SERVICE_NAME', 'c0d1x-ai'),
+    'DEBUG_TOKEN': os.getenv('DEBUG_TOKEN'),  # Токен для /debug/*; без него отладочные адреса закрыты
+    'LOOP_WATCHDOG': os.getenv('LOOP_WATCHDOG', '1') == '1',  # Замер задержки цикла событий и поиск блокировок
+    'LOOP_LAG_INTERVAL': 0.1,  # Как часто мерить задержку цикла, секунды
+    'LOOP_STALL_THRESHOLD': float(os.getenv('LOOP_STALL_THRESHOLD', 0.25)),  # Блокировка дольше — в лог со стеком
+    'LOOP_STALL_HISTORY': 20,  # Сколько последних блокировок показывать в /debug/loop
+    'LOOP_STALL_LOG_FRAMES': 5,  # Сколько внутренних вызовов стека печатать в лог
+    'LOOP_LAG_WINDOW': 3000,  # Замеров в окне перцентилей (5 минут при интервале 0.1 с)
+    'PROFILE_INTERVAL': float(os.getenv('PROFILE_INTERVAL', 0.01)),  # Период выборок /debug/profile
+    'PROFILE_MAX_SECONDS': 60,
     'SELF_PING_INTERVAL': 300,  # Пинг каждые 5 минут
     'HEALTH_CHECK_PORT': int(os.getenv('PORT', 8080))
 }
 
 # Модели AI
 MODELS = {
+    'auto': '🤖 Авто (самая быстрая сейчас)',
     'gpt-3.5-turbo': '⚡ GPT-3.5 Turbo (быстрая)',
     'gpt-4o-mini': '🚀 GPT-4o Mini (рекомендуется)',
     'gpt-4o': '💎 GPT-4o (мощная)',
@@ -42,73 +225,667 @@ MODELS = {
     'deepseek-v3': '💡 DeepSeek V3'
 }
 
-# Глобальные переменные
-text_queue = asyncio.Queue()
-image_queue = asyncio.Queue()
-user_models = {}
-bot_start_time = datetime.now()
+class Job:
+    """Задача генерации, ожидающая обработки воркером
 
-class KeepAliveServer:
-    """Простой HTTP сервер для поддержания активности на Render.com"""
+    Содержит только сериализуемые поля, чтобы её можно было сохранить
+    в журнал и выполнить после перезапуска.
+    """
     
-    def __init__(self, port=8080):
-        self.port = port
-        self.server = None
-        self.thread = None
+    __slots__ = ('kind', 'chat_id', 'user_id', 'prompt', 'model', 'created_at', 'attempts', 'job_id',
+                 'history', 'status_message_id', 'deadline', 'cancelled', 'routed_model',
+                 'enqueued_at', 'dequeued_at', 'trace')
     
-    def start(self):
-        """Запускает HTTP сервер в отдельном потоке"""
-        def run_server():
-            from http.server import HTTPServer, BaseHTTPRequestHandler
-            import json
-            
-            class HealthHandler(BaseHTTPRequestHandler):
-                def do_GET(self):
-                    if self.path == '/health':
-                        self.send_response(200)
-                        self.send_header('Content-type', 'application/json')
-                        self.end_headers()
-                        uptime = datetime.now() - bot_start_time
-                        response = {
-                            'status': 'healthy',
-                            'bot_uptime': str(uptime),
-                            'text_queue_size': text_queue.qsize(),
-                            'image_queue_size': image_queue.qsize(),
-                            'timestamp': datetime.now().isoformat()
-                        }
-                        self.wfile.write(json.dumps(response, indent=2, ensure_ascii=False).encode())
-                    elif self.path == '/':
-                        self.send_response(200)
-                        self.send_header('Content-type', 'text/html')
-                        self.end_headers()
-                        self.wfile.write(b'<html><body><h1>C0D1X AI Bot is running!</h1><p><a href="/health">Health Check</a></p></body></html>')
+    def __init__(self, kind, chat_id, user_id, prompt, model, created_at=None, attempts=0, job_id=None, history=None):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.model = model
+        self.created_at = created_at or time.time()
+        self.attempts = attempts
+        self.job_id = job_id
+        # Предыдущие реплики диалога (в журнал не пишутся — после перезапуска их всё равно нет)
+        self.history = history
+        # Сообщение о месте в очереди — воркер превратит его в статус генерации
+        self.status_message_id = None
+        # Срок считается от постановки, поэтому задачи из журнала тоже устаревают
+        deadlines = CONFIG['JOB_DEADLINES']
+        self.deadline = self.created_at + deadlines.get(model, deadlines[kind])
+        self.cancelled = False
+        # Модель, выбранная воркером для "auto"
+        self.routed_model = None
+        self.dequeued_at = None
+        # Время ожидания в очереди считается и для задач, переживших перезапуск
+        self.enqueued_at = time.monotonic() - max(0.0, time.time() - self.created_at)
+        # Трасса запроса (не сериализуется: после перезапуска начинается заново)
+        self.trace = None
+    
+    def expired(self):
+        return time.time() > self.deadline
+    
+    @property
+    def upstream_model(self):
+        """Модель, к которой идёт запрос (для "auto" — выбранная воркером)"""
+        return self.routed_model or self.model
+    
+    @property
+    def standalone(self):
+        """Запрос без контекста диалога: его можно кэшировать и объединять с такими же"""
+        return not self.history
+    
+    def to_record(self):
+        return (self.job_id, self.kind, self.chat_id, self.user_id, self.prompt, self.model, self.created_at, self.attempts)
+    
+    @classmethod
+    def from_record(cls, row):
+        job_id, kind, chat_id, user_id, prompt, model, created_at, attempts = row
+        return cls(kind, chat_id, user_id, prompt, model, created_at, attempts, job_id)
+
+class UserSlot:
+    """Компактное состояние пользователя в очереди: токен-бакет и его задачи"""
+    
+    __slots__ = ('tokens', 'updated', 'jobs')
+    
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.jobs = collections.deque()
+
+class FairQueue:
+    """Очередь с честным распределением между пользователями
+
+    Задачи разных пользователей выдаются по кругу (round-robin), поэтому
+    один пользователь с десятками запросов не задерживает остальных.
+    Воркер может попросить только задачи, готовые к выполнению (например,
+    у модели есть свободный слот): остальные ждут здесь же, сохраняя
+    очерёдность пользователей и учитываясь в размере очереди.
+    Частоту постановки в очередь ограничивает токен-бакет пользователя,
+    общий размер — max_size (проверяет вызывающий через full()).
+    По сглаженному времени обслуживания оценивается ожидание в очереди.
+    """
+    
+    def __init__(self, rate_per_minute, burst, max_size=0):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_size = max_size
+        self.users = {}
+        self.active = collections.deque()
+        # Устанавливается, когда может появиться задача для выдачи
+        self.changed = asyncio.Event()
+        self.size = 0
+        self.last_sweep = time.monotonic()
+        self.serving = 0
+        self.service_time = None
+    
+    def refill(self, slot, now):
+        """Пополняет токены пользователя за прошедшее время"""
+        slot.tokens = min(self.burst, slot.tokens + (now - slot.updated) * self.rate)
+        slot.updated = now
+    
+    def try_put(self, job):
+        """Ставит задачу в очередь; возвращает False, если лимит пользователя исчерпан"""
+        now = time.monotonic()
+        if now - self.last_sweep > 60:
+            self.sweep(now)
+        
+        slot = self.users.get(job.user_id)
+        if slot is None:
+            slot = self.users[job.user_id] = UserSlot(self.burst, now)
+        else:
+            self.refill(slot, now)
+        if slot.tokens < 1:
+            return False
+        
+        slot.tokens -= 1
+        self.put(job, slot)
+        return True
+    
+    def put(self, job, slot=None):
+        """Ставит задачу в очередь без проверки лимита (для задач из журнала)"""
+        if slot is None:
+            slot = self.users.get(job.user_id)
+            if slot is None:
+                slot = self.users[job.user_id] = UserSlot(self.burst, time.monotonic())
+        if not slot.jobs:
+            self.active.append(job.user_id)
+        slot.jobs.append(job)
+        self.size += 1
+        self.changed.set()
+    
+    def retry_after(self, user_id):
+        """Через сколько секунд у пользователя появится токен"""
+        slot = self.users.get(user_id)
+        if slot is None or slot.tokens >= 1:
+            return 0
+        return (1 - slot.tokens) / self.rate
+    
+    def remove(self, job):
+        """Убирает задачу из очереди (отмена); False, если её там уже нет"""
+        slot = self.users.get(job.user_id)
+        if slot is None or job not in slot.jobs:
+            return False
+        slot.jobs.remove(job)
+        if not slot.jobs:
+            self.active.remove(job.user_id)
+        self.size -= 1
+        return True
+    
+    def wakeup(self):
+        """Сообщает ожидающим get(), что готовность задач могла измениться (освободился слот модели)"""
+        self.changed.set()
+    
+    async def get(self, ready=None):
+        """Возвращает следующую задачу, переходя по кругу между пользователями
+
+        ready(job) — можно ли выдать задачу сейчас. Пользователь, у которого
+        готовых задач нет, пропускается, но сохраняет место в круге.
+        """
+        while True:
+            job = self.pick(ready)
+            if job is not None:
+                break
+            self.changed.clear()
+            await self.changed.wait()
+        self.size -= 1
+        self.serving += 1
+        job.dequeued_at = time.monotonic()
+        if job.trace is not None:
+            job.trace.add('queue.wait', job.enqueued_at, job.dequeued_at)
+        return job
+    
+    def pick(self, ready):
+        """Первая готовая задача в порядке круга; выбранный пользователь уходит в конец круга"""
+        for user_id in self.active:
+            slot = self.users[user_id]
+            job = next((job for job in slot.jobs if ready is None or ready(job)), None)
+            if job is not None:
+                slot.jobs.remove(job)
+                self.active.remove(user_id)
+                if slot.jobs:
+                    self.active.append(user_id)
+                return job
+        return None
+    
+    def task_done(self, job, completed=True, measured=True):
+        """Отмечает конец обслуживания задачи
+
+        Время выполненных задач учитывается в оценке ожидания; снятые
+        (отменённые, устаревшие) — measured=False — оценку не искажают.
+        """
+        self.serving -= 1
+        if not completed:
+            # Задача вернётся в очередь (воркер отключился)
+            job.dequeued_at = None
+            return
+        if not measured:
+            return
+        elapsed = time.monotonic() - job.dequeued_at
+        if self.service_time is None:
+            self.service_time = elapsed
+        else:
+            alpha = CONFIG['QUEUE_SERVICE_SMOOTHING']
+            self.service_time += alpha * (elapsed - self.service_time)
+    
+    def qsize(self):
+        return self.size
+    
+    def full(self):
+        return 0 < self.max_size <= self.size
+    
+    def load(self):
+        """Заполненность очереди от 0 до 1 (0 для очереди без ограничения)"""
+        return self.size / self.max_size if self.max_size else 0.0
+    
+    def order(self):
+        """Задачи в порядке, в котором их выдаст get() (повторяет круговой обход)"""
+        iterators = collections.deque(iter(self.users[user_id].jobs) for user_id in self.active)
+        while iterators:
+            jobs = iterators.popleft()
+            job = next(jobs, None)
+            if job is not None:
+                yield job
+                iterators.append(jobs)
+    
+    def position(self, job):
+        """Сколько задач будет выдано раньше этой; None, если её нет в очереди"""
+        for ahead, queued in enumerate(self.order()):
+            if queued is job:
+                return ahead
+        return None
+    
+    def estimate_wait(self, ahead):
+        """Ожидаемое время до готовности задачи, перед которой ahead задач; None без статистики
+
+        Под нагрузкой заняты все исполнители, поэтому их число оценивается
+        по задачам в обслуживании (закон Литтла).
+        """
+        if self.service_time is None:
+            return None
+        return (ahead / max(1, self.serving) + 1) * self.service_time
+    
+    def sweep(self, now):
+        """Удаляет состояние пользователей, у которых нет задач и бакет уже полон"""
+        self.last_sweep = now
+        for user_id in [
+            user_id for user_id, slot in self.users.items()
+            if not slot.jobs and slot.tokens + (now - slot.updated) * self.rate >= self.burst
+        ]:
+            del self.users[user_id]
+
+class JobJournal:
+    """Журнал задач на SQLite (WAL), переживающий перезапуски и падения бота
+
+    Постановка задачи лишь добавляет операцию в буфер, а фоновая задача
+    записывает накопленное одной транзакцией — одна синхронизация с диском
+    на пачку, поэтому /text не ждёт диска. Завершённые задачи удаляются,
+    незавершённые при запуске возвращаются в очереди.
+    Номера задач не повторяются между запусками (по ним работают кнопки
+    отмены): их последовательность хранит SQLite (AUTOINCREMENT).
+    """
+    
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, '
+        'chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, prompt TEXT NOT NULL, '
+        'model TEXT NOT NULL, created_at REAL NOT NULL, attempts INTEGER NOT NULL)'
+    )
+    
+    def __init__(self, path, flush_interval, enabled=True):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.enabled = enabled and bool(path)
+        self.conn = None
+        # Один поток записи: пачки ложатся на диск строго по порядку
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+        self.ops = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+        # Без журнала номера начинаются с текущего времени в мс — мимо кнопок прошлого запуска
+        self.next_id = int(time.time() * 1000)
+        self.batches = 0
+        self.writes = 0
+    
+    def open(self):
+        """Открывает журнал и возвращает незавершённые задачи в порядке постановки"""
+        if not self.enabled:
+            return []
+        import sqlite3  # Журнал ведёт только процесс приёма — воркеры sqlite3 не загружают
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # FULL: пачка на диске сразу после commit, синхронизация — одна на пачку
+        self.conn.execute('PRAGMA synchronous=FULL')
+        schema = self.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'jobs'").fetchone()
+        if schema is not None and 'AUTOINCREMENT' not in schema[0].upper():
+            # Журнал прежней версии: переносим задачи в таблицу с последовательностью номеров
+            self.conn.executescript(
+                f'BEGIN; ALTER TABLE jobs RENAME TO jobs_old; {self.SCHEMA}; '
+                'INSERT INTO jobs SELECT * FROM jobs_old; DROP TABLE jobs_old; COMMIT;'
+            )
+        self.conn.execute(self.SCHEMA)
+        self.conn.commit()
+        rows = self.conn.execute(
+            'SELECT id, kind, chat_id, user_id, prompt, model, created_at, attempts FROM jobs ORDER BY id'
+        ).fetchall()
+        # sqlite_sequence помнит наибольший выданный номер, даже если задача уже удалена
+        sequence = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'jobs'").fetchone()
+        self.next_id = max(sequence[0] if sequence else 0, rows[-1][0] if rows else 0) + 1
+        return [Job.from_record(row) for row in rows]
+    
+    def append(self, job):
+        """Записывает новую задачу; номер задача получает и при выключенном журнале"""
+        job.job_id = self.next_id
+        self.next_id += 1
+        if self.conn is None:
+            return
+        self.push(('put', job.to_record()))
+    
+    def started(self, job):
+        """Отмечает очередную попытку выполнения задачи"""
+        job.attempts += 1
+        if self.conn is not None and job.job_id is not None:
+            self.push(('start', job.job_id))
+    
+    def finished(self, job):
+        """Удаляет выполненную задачу из журнала"""
+        if self.conn is not None and job.job_id is not None:
+            self.push(('done', job.job_id))
+    
+    def push(self, op):
+        self.ops.append(op)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+    
+    async def run(self):
+        """Фоновая запись: копит операции flush_interval и пишет их одной транзакцией"""
+        Tracer.detach()
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.flush_interval)
+            self.wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        ops, self.ops = self.ops, []
+        if ops:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.write, ops)
+    
+    def write(self, ops):
+        """Применяет пачку операций (выполняется в потоке журнала)"""
+        import sqlite3
+        try:
+            with self.conn:
+                for op, value in ops:
+                    if op == 'put':
+                        self.conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', value)
+                    elif op == 'start':
+                        self.conn.execute('UPDATE jobs SET attempts = attempts + 1 WHERE id = ?', (value,))
                     else:
-                        self.send_response(404)
-                        self.end_headers()
-                
-                def log_message(self, format, *args):
-                    # Отключаем стандартное логирование
-                    pass
-            
-            self.server = HTTPServer(('0.0.0.0', self.port), HealthHandler)
-            print(f"🔄 Keep-alive сервер запущен на порту {self.port}")
-            self.server.serve_forever()
+                        self.conn.execute('DELETE FROM jobs WHERE id = ?', (value,))
+            self.batches += 1
+            self.writes += len(ops)
+        except sqlite3.Error as e:
+            print(f"Ошибка записи журнала задач: {e}")
+    
+    def stats(self):
+        return {'batches': self.batches, 'writes': self.writes, 'buffered': len(self.ops)}
+    
+    async def close(self):
+        """Дописывает буфер и закрывает журнал; задачи в работе останутся для повтора"""
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        if self.conn is not None:
+            await self.flush()
+            self.executor.shutdown(wait=True)
+            self.conn.close()
+            self.conn = None
+
+
+class Conversation:
+    """История диалога одного пользователя: реплики с заранее посчитанными токенами"""
+    
+    __slots__ = ('turns', 'tokens', 'touched')
+    
+    def __init__(self, now):
+        self.turns = collections.deque()
+        self.tokens = 0
+        self.touched = now
+
+class ConversationStore:
+    """Ограниченное по памяти хранилище историй диалогов
+
+    Токены каждой реплики оцениваются один раз при записи, сумма ведётся
+    инкрементально: старые реплики отбрасываются с начала, пока история
+    не уложится в max_tokens, поэтому память на пользователя постоянна.
+    Простаивающие пользователи вытесняются по LRU и по времени простоя.
+    """
+    
+    def __init__(self, budgets, max_users, idle_ttl, enabled=True):
+        self.budgets = budgets
+        self.max_tokens = max(budgets.values())
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.enabled = enabled
+        self.users = collections.OrderedDict()
+        self.evicted = 0
+    
+    @staticmethod
+    def estimate_tokens(text):
+        """Грубая оценка без токенизатора: ~3 символа на токен (с запасом для кириллицы)"""
+        return len(text) // 3 + 1
+    
+    def budget(self, model):
+        return self.budgets.get(model, self.budgets['default'])
+    
+    def context(self, user_id, model, prompt):
+        """Предыдущие реплики для запроса, укладывающиеся в бюджет модели вместе с prompt"""
+        if not self.enabled:
+            return None
+        conversation = self.users.get(user_id)
+        if conversation is None:
+            return []
+        self.users.move_to_end(user_id)
+        available = self.budget(model) - self.estimate_tokens(prompt)
+        selected = []
+        # Берём самые свежие реплики, пока хватает бюджета; пары не разрываем
+        for role, content, tokens in reversed(conversation.turns):
+            available -= tokens
+            if available < 0:
+                break
+            selected.append({'role': role, 'content': content})
+        if selected and selected[-1]['role'] == 'assistant':
+            selected.pop()
+        selected.reverse()
+        return selected
+    
+    def record(self, user_id, prompt, answer):
+        """Добавляет вопрос и ответ (без размышлений) и отбрасывает то, что не влезает"""
+        if not self.enabled or answer is None:
+            return
+        now = time.monotonic()
+        self.sweep(now)
+        conversation = self.users.get(user_id)
+        if conversation is None:
+            conversation = self.users[user_id] = Conversation(now)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.users.move_to_end(user_id)
+        conversation.touched = now
         
-        self.thread = threading.Thread(target=run_server, daemon=True)
-        self.thread.start()
-        return self
+        _, answer = MessageProcessor.extract_thoughts(answer)
+        # Одна реплика не может занять больше всей истории
+        limit = self.max_tokens * 3 // 2
+        for role, content in (('user', prompt[:limit]), ('assistant', answer[:limit])):
+            tokens = self.estimate_tokens(content)
+            conversation.turns.append((role, content, tokens))
+            conversation.tokens += tokens
+        while conversation.tokens > self.max_tokens:
+            _, _, tokens = conversation.turns.popleft()
+            conversation.tokens -= tokens
+    
+    def reset(self, user_id):
+        return self.users.pop(user_id, None) is not None
+    
+    def sweep(self, now):
+        """Удаляет пользователей, простаивающих дольше idle_ttl (они в начале LRU)"""
+        while self.users:
+            user_id, conversation = next(iter(self.users.items()))
+            if now - conversation.touched < self.idle_ttl:
+                break
+            del self.users[user_id]
+            self.evicted += 1
+    
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'tokens': sum(conversation.tokens for conversation in self.users.values()),
+            'evicted': self.evicted
+        }
+
+
+class QueueFeedback:
+    """Показывает пользователям место в очереди и ожидаемое время
+
+    После постановки задачи отправляется статусное сообщение, которое раз
+    в CONFIG['QUEUE_FEEDBACK_INTERVAL'] секунд редактируется на месте, пока
+    задача ждёт. Когда её берёт воркер, он правит это же сообщение.
+    """
+    
+    def __init__(self, interval, min_ahead):
+        self.interval = interval
+        self.min_ahead = min_ahead
+        self.bot = None
+        self.tracked = {}  # задача -> отображаемый текст
+        self.is_running = False
+    
+    @staticmethod
+    def render(queue, ahead):
+        text = f"⏳ Запрос в очереди: перед вами {ahead}"
+        wait = queue.estimate_wait(ahead)
+        if wait is not None:
+            text += f"\nПримерное ожидание: {format_duration(wait)}"
+        return text
+    
+    async def track(self, bot, queue, job):
+        """Сообщает место в очереди, если ждать придётся; возвращает статусное сообщение или None"""
+        ahead = queue.position(job)
+        if ahead is None or ahead < self.min_ahead:
+            return None
+        self.bot = bot
+        text = self.render(queue, ahead)
+        message = await send_scheduler.send(
+            job.chat_id, 'sendMessage',
+            lambda: bot.send_message(chat_id=job.chat_id, text=text, reply_markup=cancel_keyboard(job)),
+            status=True
+        )
+        # Воркер мог забрать задачу, пока сообщение отправлялось, — тогда он уже отправил своё
+        if message is not None and job.dequeued_at is None:
+            job.status_message_id = message.message_id
+            self.tracked[job] = text
+        return message
+    
+    async def run(self):
+        """Периодически обновляет позиции и ожидание в статусных сообщениях"""
+        self.is_running = True
+        while self.is_running:
+            await asyncio.sleep(self.interval)
+            if self.tracked:
+                self.refresh()
+    
+    def refresh(self):
+        waiting = set()
+        for queue in (text_queue, image_queue):
+            positions = {job: ahead for ahead, job in enumerate(queue.order()) if job in self.tracked}
+            for job, ahead in positions.items():
+                text = self.render(queue, ahead)
+                if text != self.tracked[job]:
+                    self.tracked[job] = text
+                    self.edit(job, text)
+            waiting.update(positions)
+        # Задачи, которые уже взяли воркеры или отменили
+        for job in [job for job in self.tracked if job not in waiting]:
+            del self.tracked[job]
+    
+    def edit(self, job, text):
+        """Правка без ожидания: более новая заменит её в планировщике, под нагрузкой её можно отбросить"""
+        chat_id, message_id = job.chat_id, job.status_message_id
+        future = send_scheduler.submit(
+            chat_id, 'editMessageText',
+            lambda: self.bot.edit_message_text(
+                chat_id=chat_id, message_id=message_id, text=text, reply_markup=cancel_keyboard(job)
+            ),
+            status=True, merge_key=message_id
+        )
+        future.add_done_callback(self.report)
+    
+    @staticmethod
+    def report(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Ошибка обновления места в очереди: {future.exception()}")
     
     def stop(self):
-        """Останавливает HTTP сервер"""
-        if self.server:
-            self.server.shutdown()
-            self.server.server_close()
-            print("🔴 Keep-alive сервер остановлен")
+        self.is_running = False
+
+
+def cancel_keyboard(job):
+    """Кнопка отмены задачи под статусным сообщением"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("✖️ Отмена", callback_data=f"cancel:{job.job_id}")]])
+
+
+class JobRegistry:
+    """Задачи, которые пользователь может отменить, — в очереди и в работе
+
+    Задача из очереди удаляется сразу. Для выполняющейся вызывается функция
+    отмены, зарегистрированная тем, кто её выполняет: локальный воркер
+    отменяет свою asyncio-задачу (вместе с запросом httpx к Void AI),
+    брокер пересылает отмену процессу-воркеру.
+    """
+    
+    CANCELLED_TEXT = "🚫 Запрос отменён."
+    
+    def __init__(self):
+        self.jobs = {}  # job_id -> задача (в процессе приёма)
+        self.cancellers = {}  # job_id -> функция отмены выполняющейся задачи
+    
+    def add(self, job):
+        self.jobs[job.job_id] = job
+    
+    def discard(self, job):
+        self.jobs.pop(job.job_id, None)
+    
+    def attach(self, job, cancel):
+        self.cancellers[job.job_id] = cancel
+    
+    def detach(self, job):
+        self.cancellers.pop(job.job_id, None)
+    
+    def user_jobs(self, user_id):
+        return [job for job in self.jobs.values() if job.user_id == user_id]
+    
+    def cancel(self, job_id, user_id=None):
+        """Отменяет задачу (только свою, если указан user_id); возвращает её или None"""
+        job = self.jobs.get(job_id)
+        if job is None or job.cancelled or (user_id is not None and job.user_id != user_id):
+            return None
+        job.cancelled = True
+        queue, flights = LocalBroker.channel(job.kind)
+        if queue.remove(job):
+            # Воркер её ещё не получал — завершаем здесь же
+            self.discard(job)
+            job_journal.finished(job)
+            tracer.finish(job.trace, 'cancelled')
+            if job.standalone:
+                flights.finish(ResponseCache.make_key(job.model, job.prompt), (None, self.follower_text()))
+        else:
+            self.abort(job_id)
+        return job
+    
+    def abort(self, job_id):
+        """Прерывает выполняющуюся задачу, если её выполнение зарегистрировано здесь"""
+        cancel = self.cancellers.get(job_id)
+        if cancel is not None:
+            cancel()
+    
+    @staticmethod
+    def follower_text():
+        """Ответ тем, кто ждал такой же запрос другого пользователя"""
+        return "🚫 Такой же запрос другого пользователя был отменён — отправьте свой ещё раз."
+
+
+def format_duration(seconds):
+    """Короткая запись длительности для пользователя"""
+    seconds = max(1, round(seconds))
+    if seconds < 60:
+        return f"{seconds} с"
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes} мин {seconds} с" if seconds else f"{minutes} мин"
+
+
+# Глобальные переменные
+text_queue = FairQueue(CONFIG['USER_TEXT_RATE'], CONFIG['USER_TEXT_BURST'], CONFIG['TEXT_QUEUE_MAX'])
+image_queue = FairQueue(CONFIG['USER_IMAGE_RATE'], CONFIG['USER_IMAGE_BURST'], CONFIG['IMAGE_QUEUE_MAX'])
+queue_feedback = QueueFeedback(CONFIG['QUEUE_FEEDBACK_INTERVAL'], CONFIG['QUEUE_FEEDBACK_MIN_AHEAD'])
+job_registry = JobRegistry()
+job_journal = JobJournal(CONFIG['JOURNAL_PATH'], CONFIG['JOURNAL_FLUSH_INTERVAL'], CONFIG['JOURNAL_ENABLED'])
+user_models = {}
+conversations = ConversationStore(
+    CONFIG['HISTORY_TOKEN_BUDGET'],
+    CONFIG['HISTORY_MAX_USERS'],
+    CONFIG['HISTORY_IDLE_TTL'],
+    CONFIG['HISTORY_ENABLED']
+)
+bot_start_time = datetime.now()
 
 class SelfPinger:
     """Класс для самопинга чтобы избежать сна"""
     
-    def __init__(self, interval=300):
+    def __init__(self, client, interval=300):
+        self.client = client
         self.interval = interval
         self.is_running = False
         self.task = None
@@ -120,13 +897,12 @@ class SelfPinger:
         
         while self.is_running:
             try:
-                # Пингуем сами себя
-                async with httpx.AsyncClient(timeout=10.0) as client:
-                    response = await client.get(f'http://localhost:{CONFIG["PORT"]}/health')
-                    if response.status_code == 200:
-                        print(f"✅ Самопинг успешен: {datetime.now().strftime('%H:%M:%S')}")
-                    else:
-                        print(f"⚠️ Самопинг неудачен: статус {response.status_code}")
+                # Пингуем сами себя через общий HTTP-клиент
+                response = await self.client.get(f'http://localhost:{CONFIG["PORT"]}/health', timeout=10.0)
+                if response.status_code == 200:
+                    print(f"✅ Самопинг успешен: {datetime.now().strftime('%H:%M:%S')}")
+                else:
+                    print(f"⚠️ Самопинг неудачен: статус {response.status_code}")
             except Exception as e:
                 print(f"❌ Ошибка самопинга: {e}")
             
@@ -141,6 +917,57 @@ class SelfPinger:
         self.is_running = False
         print("🔴 Самопинг остановлен")
 
+class StartupTimer:
+    """Замеры этапов холодного старта и отчёт о них
+
+    Этапы, идущие параллельно, замеряются каждый отдельно; итог — время
+    от начала импорта модуля (и, если известно, от запуска процесса) до
+    готовности принимать обновления.
+    """
+    
+    def __init__(self, origin, imports_done):
+        self.origin = origin
+        self.phases = [('импорты', imports_done - origin)]
+        self.ready_after = None
+    
+    def mark(self, name, started):
+        self.phases.append((name, time.perf_counter() - started))
+    
+    async def timed(self, name, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.mark(name, started)
+    
+    @staticmethod
+    def process_age():
+        """Секунды с запуска процесса по /proc (Linux); None, если узнать нельзя"""
+        try:
+            with open('/proc/self/stat') as f:
+                # Поля после имени процесса в скобках; starttime — 22-е поле
+                start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+            with open('/proc/uptime') as f:
+                uptime = float(f.read().split()[0])
+            return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+    
+    def report(self):
+        """Печатает отчёт о запуске, когда бот готов принимать обновления"""
+        self.ready_after = time.perf_counter() - self.origin
+        age = self.process_age()
+        phases = ', '.join(f"{name} {seconds:.2f} с" for name, seconds in self.phases)
+        total = f"{self.ready_after:.2f} с от импорта"
+        if age is not None:
+            total += f", {age:.2f} с от запуска процесса"
+        print(f"⏱ Запуск: {phases}. Готов через {total}")
+        if (age or self.ready_after) > CONFIG['STARTUP_BUDGET']:
+            print(f"⚠️ Запуск дольше бюджета {CONFIG['STARTUP_BUDGET']} с")
+
+
+startup_timer = StartupTimer(IMPORT_STARTED, IMPORTS_DONE)
+
 class MessageProcessor:
     """Класс для обработки и форматирования сообщений"""
     
@@ -149,49 +976,114 @@ class MessageProcessor:
         """Экранирует HTML-символы"""
         return html.escape(text) if text else None
 
+    TAG_PATTERN = re.compile(r'</?[a-zA-Z][^>]*>')
+    THINK_PATTERN = re.compile(r'<think>(.*?)</think>', re.DOTALL)
+
+    @staticmethod
+    def strip_html(text):
+        """Превращает HTML-сообщение в обычный текст"""
+        return html.unescape(MessageProcessor.TAG_PATTERN.sub('', text))
+
     @staticmethod
     def extract_thoughts(text):
         """Извлекает мысли из текста"""
-        import re
-        thought_match = re.search(r'<think>(.*?)</think>', text, re.DOTALL)
+        thought_match = MessageProcessor.THINK_PATTERN.search(text)
         if thought_match:
             thoughts = thought_match.group(1).strip()
-            content = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
+            content = MessageProcessor.THINK_PATTERN.sub('', text).strip()
             return thoughts, content
         return None, text
 
     @staticmethod
-    def split_text(text, max_length=4000):
-        """Разбивает текст на части оптимальным образом"""
-        if len(text) <= max_length:
+    def extract_partial_thoughts(text):
+        """Извлекает мысли из незавершённого (потокового) текста"""
+        start = text.find('<think>')
+        if start == -1:
+            return None, text
+        end = text.find('</think>', start)
+        if end != -1:
+            return MessageProcessor.extract_thoughts(text)
+        # Блок размышлений ещё не закрыт — ответа пока нет
+        return text[start + len('<think>'):].strip(), text[:start].strip()
+
+    # Концы предложений, после которых удобно разрывать текст
+    SENTENCE_ENDS = ('. ', '! ', '? ', '… ', '.\t', '!\t', '?\t')
+
+    @staticmethod
+    def utf16_length(text):
+        """Длина текста так, как её считает Telegram (в единицах UTF-16)"""
+        return len(text.encode('utf-16-le')) // 2
+
+    @staticmethod
+    def split_text(text, max_length=4000, escape=False):
+        """Разбивает текст на части за один проход
+
+        Длина частей считается в единицах UTF-16, как у Telegram. При escape=True
+        текст экранируется до разбиения, а разрыв никогда не попадает внутрь
+        HTML-сущности вроде &amp;. Место разрыва ищется только во второй половине
+        окна и по приоритету: абзац, строка, конец предложения, пробел, — поэтому
+        части не бывают слишком короткими, а общая работа линейна.
+        """
+        if escape:
+            text = html.escape(text, quote=False)
+        
+        # Символы вне BMP занимают две единицы UTF-16; в ASCII-тексте их нет,
+        # и длину окна можно не пересчитывать
+        wide = not text.isascii()
+        if len(text) <= max_length and (not wide or MessageProcessor.utf16_length(text) <= max_length):
             return [text]
         
         parts = []
         start = 0
         text_length = len(text)
+        half = max(1, max_length // 2)
         
         while start < text_length:
-            end = start + max_length
+            end = min(text_length, start + max_length)
+            if wide:
+                excess = MessageProcessor.utf16_length(text[start:end]) - max_length
+                if excess > 0:
+                    end -= excess
+            
             if end >= text_length:
-                parts.append(text[start:])
+                parts.append(text[start:].strip())
                 break
             
-            # Ищем оптимальное место для разрыва
-            for separator in ['\n', ' ', '.', ',', ';', '!', '?']:
-                break_pos = text.rfind(separator, start, end)
-                if break_pos != -1:
-                    break
-            if break_pos == -1:
-                break_pos = end
+            if escape:
+                # Не разрываем сущность: самая длинная из html.escape — "&amp;"
+                amp = text.rfind('&', max(start, end - 4), end)
+                if amp > start and text.find(';', amp, end) == -1:
+                    end = amp
             
-            parts.append(text[start:break_pos].strip())
-            start = break_pos
+            cut = MessageProcessor.find_break(text, start + half, end)
+            parts.append(text[start:cut].strip())
+            start = cut
             
             # Пропускаем разделители
-            while start < text_length and text[start] in [' ', '\n', '\r', '\t']:
+            while start < text_length and text[start] in ' \n\r\t':
                 start += 1
         
-        return parts
+        return [part for part in parts if part] or ['']
+
+    @staticmethod
+    def find_break(text, low, high):
+        """Лучшее место разрыва в text[low:high]: абзац, строка, предложение, пробел"""
+        line = text.rfind('\n', low, high)
+        if line != -1:
+            paragraph = text.rfind('\n\n', low, line + 1)
+            return paragraph if paragraph != -1 else line
+        
+        space = text.rfind(' ', low, high)
+        if space == -1:
+            space = text.rfind('\t', low, high)
+            if space == -1:
+                # Ни одного пробела (код, base64): концов предложений тоже нет
+                return high
+        
+        position = max(text.rfind(separator, low, high) for separator in MessageProcessor.SENTENCE_ENDS)
+        if position != -1:
+            return position + 1
+        return space
 
     @staticmethod
     def format_ai_response(thoughts, content):
@@ -199,18 +1091,15 @@ class MessageProcessor:
         messages = []
         
         if thoughts:
-            thought_parts = MessageProcessor.split_text(
-                MessageProcessor.escape_html(thoughts), 
-                CONFIG['MAX_HTML_LENGTH']
-            )
+            thought_parts = MessageProcessor.split_text(thoughts, CONFIG['MAX_HTML_LENGTH'], escape=True)
             for i, part in enumerate(thought_parts):
                 prefix = "✅ Размышления:" if i == 0 else "✅ Размышления (продолжение):"
                 messages.append(f"{prefix}\n\n<i>{part}</i>")
         
-        content_parts = MessageProcessor.split_text(
-            MessageProcessor.escape_html(content), 
-            CONFIG['MAX_HTML_LENGTH']
-        )
+        if thoughts and not content:
+            return messages
+        
+        content_parts = MessageProcessor.split_text(content or '', CONFIG['MAX_HTML_LENGTH'], escape=True)
         for i, part in enumerate(content_parts):
             if i == 0 and not thoughts:
                 messages.append(f"✅ Результат:\n\n<code>{part}</code>")
@@ -220,156 +1109,3242 @@ class MessageProcessor:
         
         return messages
 
+    # Сколько символов кодировать за раз при записи файла ответа
+    DOCUMENT_WRITE_CHUNK = 64 * 1024
+
+    @staticmethod
+    def is_long_answer(thoughts, content):
+        """Отправлять ли ответ файлом: оценка числа частей без самого разбиения"""
+        if CONFIG['LONG_ANSWER_POLICY'] != 'document':
+            return False
+        length = len(thoughts or '') + len(content or '')
+        if CONFIG['LONG_ANSWER_MAX_CHARS'] and length > CONFIG['LONG_ANSWER_MAX_CHARS']:
+            return True
+        chunk = CONFIG['MAX_HTML_LENGTH']
+        parts = -(-len(thoughts or '') // chunk) + -(-len(content or '') // chunk)
+        return parts > CONFIG['LONG_ANSWER_MAX_MESSAGES']
+
+    @staticmethod
+    def format_preview(thoughts, content):
+        """Короткое сообщение-превью длинного ответа (полный ответ — в файле)"""
+        body = content or thoughts
+        limit = CONFIG['LONG_ANSWER_PREVIEW_CHARS']
+        preview = body[:limit]
+        if len(body) > limit:
+            cut = preview.rfind(' ', limit // 2)
+            preview = (preview[:cut] if cut != -1 else preview).rstrip() + ' …'
+        title = "✅ Ответ (начало):" if content else "✅ Размышления (начало):"
+        note = "📎 Полный ответ и размышления — в файле ниже." if thoughts and content else "📎 Полностью — в файле ниже."
+        return f"{title}\n\n<code>{html.escape(preview, quote=False)}</code>\n\n{note}"
+
+    @staticmethod
+    def document_pieces(thoughts, content, markdown):
+        """Части файла ответа по порядку — без склейки в одну большую строку"""
+        if thoughts:
+            yield "## Размышления\n\n" if markdown else "Размышления:\n\n"
+            yield thoughts
+            yield "\n\n"
+            if content:
+                yield "## Ответ\n\n" if markdown else "Ответ:\n\n"
+        if content:
+            yield content
+        yield "\n"
+
+    @staticmethod
+    def build_document(thoughts, content):
+        """Файл с полным ответом: (байты, имя файла); текст кодируется кусками прямо в буфер"""
+        markdown = CONFIG['LONG_ANSWER_FORMAT'] == 'md'
+        step = MessageProcessor.DOCUMENT_WRITE_CHUNK
+        buffer = io.BytesIO()
+        for piece in MessageProcessor.document_pieces(thoughts, content, markdown):
+            for start in range(0, len(piece), step):
+                buffer.write(piece[start:start + step].encode('utf-8'))
+        return buffer.getvalue(), f"answer.{'md' if markdown else 'txt'}"
+
+
+# Приоритет выполняемого вызова (status, merge_key) — его передаёт дальше RemoteBot
+outbound_send = contextvars.ContextVar('outbound_send', default=(False, None))
+
+class SendItem:
+    """Исходящий вызов Telegram Bot API, ожидающий своей очереди"""
+    
+    __slots__ = ('method', 'call', 'future', 'status', 'merge_key', 'enqueued_at', 'attempts')
+    
+    def __init__(self, method, call, future, status, merge_key):
+        self.method = method
+        self.call = call
+        self.future = future
+        self.status = status
+        self.merge_key = merge_key
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class ChatSlot:
+    """Состояние отправки в один чат: очереди ответов и статусов, токен-бакет и пауза"""
+    
+    __slots__ = ('final', 'status', 'tokens', 'updated', 'rate', 'paused_until', 'busy')
+    
+    def __init__(self, rate, tokens, now):
+        self.final = collections.deque()
+        self.status = collections.deque()
+        self.tokens = tokens
+        self.updated = now
+        self.rate = rate
+        self.paused_until = 0.0
+        self.busy = False
+
+class SendScheduler:
+    """Центральный планировщик исходящих сообщений Telegram
+
+    Держит общий лимит бота (~30 сообщений в секунду) и лимит чата (~1 в секунду
+    в личке, 20 в минуту в группах), а при RetryAfter приостанавливает чат на
+    указанное время. Ответы отправляются раньше статусных сообщений: правки
+    одного и того же сообщения сливаются, устаревшие статусы и статусы чата,
+    в который уже стоит ответ, отбрасываются (вызывающий получает None).
+    """
+    
+    def __init__(self, global_rate, chat_rate, group_rate_per_minute, burst, status_max_age, max_retries):
+        self.global_rate = global_rate
+        self.global_tokens = 1.0
+        self.global_updated = time.monotonic()
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60.0
+        self.burst = burst
+        self.status_max_age = status_max_age
+        self.max_retries = max_retries
+        self.chats = {}
+        self.pending = {}  # Чаты с неотправленными вызовами в порядке обхода по кругу
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.deliveries = set()
+        self.last_sweep = time.monotonic()
+        self.sent = 0
+        self.dropped = 0
+        self.merged = 0
+        self.flood_waits = 0
+    
+    def submit(self, chat_id, method, call, status=False, merge_key=None):
+        """Ставит вызов в очередь и возвращает future с его результатом
+
+        call — функция без аргументов, возвращающая корутину запроса к Bot API.
+        status=True помечает статусное сообщение или промежуточную правку,
+        которые можно отбросить; ждущие вызовы того же вида с одинаковым
+        merge_key сливаются в один (выполняется последний).
+        """
+        if self.task is None and not self.stopping:
+            self.task = asyncio.create_task(self.run())
+        now = time.monotonic()
+        slot = self.chats.get(chat_id)
+        if slot is None:
+            # Отрицательный chat_id — группы и каналы, у них свой лимит
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            slot = self.chats[chat_id] = ChatSlot(rate, self.burst, now)
+        
+        if merge_key is not None:
+            for item in slot.status if status else slot.final:
+                if item.merge_key == merge_key:
+                    item.call = call
+                    self.merged += 1
+                    return item.future
+        
+        item = SendItem(method, call, asyncio.get_running_loop().create_future(), status, merge_key)
+        if status:
+            slot.status.append(item)
+        else:
+            # Ответ уже в очереди — статусы этого чата больше не нужны
+            while slot.status:
+                self.drop(slot.status.popleft())
+            slot.final.append(item)
+        self.pending.setdefault(chat_id, None)
+        self.wakeup.set()
+        return item.future
+    
+    async def send(self, chat_id, method, call, status=False, merge_key=None):
+        """Отправляет вызов через очередь и дожидается результата"""
+        with tracer.span(f'telegram.{method}', status=status):
+            return await self.submit(chat_id, method, call, status, merge_key)
+    
+    def drop(self, item):
+        """Отбрасывает статусный вызов, не отправляя его"""
+        if not item.future.done():
+            item.future.set_result(None)
+        self.dropped += 1
+    
+    def refill(self, slot, now):
+        """Пополняет токены чата за прошедшее время"""
+        slot.tokens = min(self.burst, slot.tokens + (now - slot.updated) * slot.rate)
+        slot.updated = now
+    
+    def ready_at(self, slot, now):
+        """Момент, когда в чат можно отправить следующее сообщение"""
+        self.refill(slot, now)
+        ready = now if slot.tokens >= 1 else now + (1 - slot.tokens) / slot.rate
+        return max(ready, slot.paused_until)
+    
+    def queued(self):
+        return sum(len(slot.final) + len(slot.status) for slot in self.chats.values())
+    
+    async def run(self):
+        """Цикл отправки: по кругу между чатами, ответы раньше статусов"""
+        Tracer.detach()
+        while not self.stopping:
+            self.wakeup.clear()
+            now = time.monotonic()
+            if now - self.last_sweep > 60:
+                self.sweep(now)
+            
+            # Общий лимит без запаса: сообщения идут равномерно, а не пачками
+            self.global_tokens = min(1.0, self.global_tokens + (now - self.global_updated) * self.global_rate)
+            self.global_updated = now
+            if self.global_tokens < 1:
+                wake = now + (1 - self.global_tokens) / self.global_rate
+            else:
+                chat_id, wake = self.pick(now)
+                if chat_id is not None:
+                    self.dispatch(chat_id)
+                    continue
+            
+            timeout = None if wake is None else max(0.0, wake - now)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+    
+    def pick(self, now):
+        """Выбирает чат для следующей отправки; возвращает (chat_id, время пробуждения)"""
+        status_chat, wake = None, None
+        for chat_id in list(self.pending):
+            slot = self.chats[chat_id]
+            while slot.status and (slot.status[0].future.done()
+                                   or now - slot.status[0].enqueued_at > self.status_max_age):
+                self.drop(slot.status.popleft())
+            while slot.final and slot.final[0].future.done():
+                slot.final.popleft()
+            if not slot.final and not slot.status:
+                del self.pending[chat_id]
+                continue
+            if slot.busy:
+                continue
+            ready = self.ready_at(slot, now)
+            if ready > now:
+                wake = ready if wake is None else min(wake, ready)
+            elif slot.final:
+                return chat_id, None
+            elif status_chat is None:
+                status_chat = chat_id
+        return status_chat, wake
+    
+    def dispatch(self, chat_id):
+        """Запускает отправку следующего вызова чата, не дожидаясь её завершения"""
+        slot = self.chats[chat_id]
+        item = slot.final.popleft() if slot.final else slot.status.popleft()
+        slot.tokens -= 1
+        slot.busy = True
+        self.global_tokens -= 1
+        # Чат уходит в конец круга
+        del self.pending[chat_id]
+        self.pending[chat_id] = None
+        task = asyncio.create_task(self.deliver(chat_id, slot, item))
+        self.deliveries.add(task)
+        task.add_done_callback(self.deliveries.discard)
+    
+    async def deliver(self, chat_id, slot, item):
+        """Выполняет вызов Bot API и передаёт результат в future"""
+        outbound_send.set((item.status, item.merge_key))
+        try:
+            with metrics.telegram_latency.time(method=item.method):
+                result = await item.call()
+        except RetryAfter as e:
+            delay = e.retry_after
+            delay = delay.total_seconds() if hasattr(delay, 'total_seconds') else float(delay)
+            print(f"Telegram просит подождать {delay} с (чат {chat_id}, {item.method})")
+            slot.paused_until = time.monotonic() + delay
+            self.flood_waits += 1
+            item.attempts += 1
+            if item.status:
+                self.drop(item)
+            elif item.attempts > self.max_retries:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                slot.final.appendleft(item)
+                self.pending.setdefault(chat_id, None)
+        except asyncio.CancelledError:
+            item.future.cancel()
+            raise
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            slot.busy = False
+            self.wakeup.set()
+    
+    def sweep(self, now):
+        """Удаляет состояние чатов без очереди, у которых бакет уже полон"""
+        self.last_sweep = now
+        for chat_id in [
+            chat_id for chat_id, slot in self.chats.items()
+            if chat_id not in self.pending and not slot.busy and slot.paused_until <= now
+            and slot.tokens + (now - slot.updated) * slot.rate >= self.burst
+        ]:
+            del self.chats[chat_id]
+    
+    def stats(self):
+        return {
+            'queued': self.queued(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'merged': self.merged,
+            'flood_waits': self.flood_waits
+        }
+    
+    async def stop(self):
+        """Останавливает цикл отправки и незавершённые вызовы"""
+        # Цикл завершается сам по флагу: отмена, пришедшая в wait_for, может потеряться
+        self.stopping = True
+        self.wakeup.set()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        tasks = list(self.deliveries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for slot in self.chats.values():
+            for item in (*slot.final, *slot.status):
+                item.future.cancel()
+        self.chats.clear()
+        self.pending.clear()
+
+
+class StreamingReply:
+    """Постепенно выводит потоковый ответ, редактируя сообщения на месте
+
+    Первое сообщение — статусное "🔄 Генерирую текст", дальше по мере роста
+    ответа отправляются новые сообщения (при превышении MAX_HTML_LENGTH).
+    При политике длинных ответов document ответ идёт в одном сообщении,
+    показывающем последнюю часть текста; в конце длинный ответ становится
+    превью и файлом, а обычный раскладывается по сообщениям.
+    Пока ответ пишется, под ним остаётся reply_markup (кнопка отмены);
+    финальная правка её убирает.
+    """
+
+    def __init__(self, bot, chat_id, status_message=None, reply_markup=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_markup = reply_markup
+        self.sent = [status_message] if status_message else []
+        self.rendered = [None] * len(self.sent)
+        # Сообщения, под которыми сейчас кнопки (статус отправлен с ними же)
+        self.marked = set(range(len(self.sent))) if reply_markup is not None else set()
+        self.pending = {}
+        self.pieces = []
+        self.last_flush = 0.0
+
+    def feed(self, piece):
+        """Добавляет очередной фрагмент ответа"""
+        self.pieces.append(piece)
+
+    @property
+    def text(self):
+        return ''.join(self.pieces)
+
+    async def flush(self, final=False):
+        """Обновляет сообщения не чаще CONFIG['STREAM_EDIT_INTERVAL']"""
+        now = time.monotonic()
+        if not final and now - self.last_flush < CONFIG['STREAM_EDIT_INTERVAL']:
+            return
+        self.last_flush = now
+        
+        text = self.text
+        if final:
+            thoughts, content = MessageProcessor.extract_thoughts(text)
+        else:
+            thoughts, content = MessageProcessor.extract_partial_thoughts(text)
+        if not thoughts and not content and not final:
+            return
+        
+        if final and MessageProcessor.is_long_answer(thoughts, content):
+            await self.settle()
+            await self.render(0, MessageProcessor.format_preview(thoughts, content), final)
+            await send_answer_document(self.bot, self.chat_id, thoughts, content)
+            return
+        
+        messages = MessageProcessor.format_ai_response(thoughts, content)
+        if not final:
+            if CONFIG['LONG_ANSWER_POLICY'] == 'document':
+                # Новые сообщения не отправляем, пока неясно, не уйдёт ли ответ файлом
+                messages = messages[-1:]
+            messages[-1] += CONFIG['STREAM_CURSOR']
+        else:
+            await self.settle()
+        
+        for i, message in enumerate(messages):
+            await self.render(i, message, final)
+
+    async def render(self, index, message, final):
+        """Показывает message в index-м сообщении ответа: правит отправленное или отправляет новое"""
+        if index < len(self.sent):
+            if self.rendered[index] != message or (final and index in self.marked):
+                await self.edit(index, message, final)
+        else:
+            sent = await self.send(message)
+            self.sent.append(sent)
+            self.rendered.append(message)
+
+    async def send(self, message):
+        """Отправляет новое сообщение ответа"""
+        return await send_scheduler.send(
+            self.chat_id, 'sendMessage',
+            lambda: self.bot.send_message(chat_id=self.chat_id, text=message, parse_mode='HTML')
+        )
+
+    async def edit(self, index, message, final):
+        """Редактирует уже отправленное сообщение"""
+        message_id = self.sent[index].message_id
+        reply_markup = None if final else self.reply_markup
+        
+        async def call():
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id, message_id=message_id, text=message, parse_mode='HTML',
+                reply_markup=reply_markup
+            )
+            self.rendered[index] = message
+            if reply_markup is None:
+                self.marked.discard(index)
+            else:
+                self.marked.add(index)
+        
+        if not final:
+            # Промежуточные правки не ждём: планировщик сольёт их с более новыми
+            # или отбросит под нагрузкой, а поток продолжит читаться
+            self.pending[index] = send_scheduler.submit(
+                self.chat_id, 'editMessageText', call, status=True, merge_key=message_id
+            )
+            return
+        try:
+            await send_scheduler.send(self.chat_id, 'editMessageText', call)
+        except Exception as e:
+            print(f"Ошибка редактирования сообщения: {e}")
+            # Финальную версию нельзя потерять — отправляем новым сообщением
+            self.sent[index] = await self.send(message)
+            self.rendered[index] = message
+            self.marked.discard(index)
+
+    async def settle(self):
+        """Дожидается промежуточных правок, чтобы финальная версия сравнивалась с тем, что видно в чате"""
+        pending, self.pending = list(self.pending.values()), {}
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(f"Ошибка редактирования сообщения: {result}")
+
+
+async def send_answer_document(bot, chat_id, thoughts, content):
+    """Отправляет полный длинный ответ файлом (превью отправляет вызывающий)"""
+    document, filename = MessageProcessor.build_document(thoughts, content)
+    return await send_scheduler.send(
+        chat_id, 'sendDocument',
+        lambda: bot.send_document(chat_id=chat_id, document=document, filename=filename)
+    )
+
+
+class SqliteTier:
+    """Дисковый уровень кэша на SQLite, переживающий перезапуски бота"""
+
+    def __init__(self, path, table, max_entries):
+        self.table = table
+        self.max_entries = max_entries
+        self.writes = 0
+        self.lock = threading.Lock()
+        import sqlite3  # Дисковый уровень открывается при первом обращении — тогда и загружаем sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                f'(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            self.conn.commit()
+
+    def get(self, key):
+        """Возвращает значение по ключу или None, если его нет или оно устарело"""
+        with self.lock:
+            row = self.conn.execute(
+                f'SELECT value, expires FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                self.conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                self.conn.commit()
+                return None
+            return row[0]
+
+    def set(self, key, value, expires):
+        """Сохраняет значение и периодически удаляет лишние записи"""
+        with self.lock:
+            self.conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)',
+                (key, value, expires)
+            )
+            self.writes += 1
+            if self.writes % 100 == 0:
+                self.conn.execute(f'DELETE FROM {self.table} WHERE expires < ?', (time.time(),))
+                self.conn.execute(
+                    f'DELETE FROM {self.table} WHERE key NOT IN '
+                    f'(SELECT key FROM {self.table} ORDER BY expires DESC LIMIT ?)',
+                    (self.max_entries,)
+                )
+            self.conn.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ResponseCache:
+    """Кэш ответов по (модель, нормализованный запрос)
+
+    Первый уровень — LRU в памяти с TTL, второй (опционально) — SQLite на диске.
+    Используется для текстовых ответов и для file_id отправленных изображений.
+    """
+
+    def __init__(self, max_entries, ttl, disk_path=None, bypass_models=(),
+                 enabled=True, table='responses', disk_max_entries=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.table = table
+        self.disk_max_entries = disk_max_entries or max_entries
+        self.disk_path = disk_path
+        self.disk = None
+        self.bypass_models = set(bypass_models)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, prompt):
+        """Ключ кэша: регистр и лишние пробелы в запросе не важны"""
+        normalized = ' '.join(prompt.split()).casefold()
+        return hashlib.sha256(f'{model}\0{normalized}'.encode()).hexdigest()
+
+    def is_cacheable(self, model):
+        return self.enabled and model not in self.bypass_models
+
+    def get_disk(self):
+        """Открывает дисковый уровень при первом обращении"""
+        if self.disk is None and self.disk_path:
+            self.disk = SqliteTier(self.disk_path, self.table, self.disk_max_entries)
+        return self.disk
+
+    async def get(self, model, prompt):
+        """Возвращает закэшированный ответ или None"""
+        if not self.is_cacheable(model):
+            return None
+        
+        key = self.make_key(model, prompt)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, text = entry
+            if expires >= time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return text
+            del self.entries[key]
+        
+        disk = self.get_disk()
+        if disk is not None:
+            text = await asyncio.to_thread(disk.get, key)
+            if text is not None:
+                self.remember(key, text)
+                self.disk_hits += 1
+                return text
+        
+        self.misses += 1
+        return None
+
+    async def set(self, model, prompt, text):
+        """Сохраняет ответ модели"""
+        if not self.is_cacheable(model) or not text:
+            return
+        
+        key = self.make_key(model, prompt)
+        expires = self.remember(key, text)
+        disk = self.get_disk()
+        if disk is not None:
+            await asyncio.to_thread(disk.set, key, text, expires)
+
+    async def discard(self, model, prompt):
+        """Удаляет запись (например, если Telegram больше не принимает file_id)"""
+        key = self.make_key(model, prompt)
+        self.entries.pop(key, None)
+        disk = self.get_disk()
+        if disk is not None:
+            await asyncio.to_thread(disk.delete, key)
+
+    def remember(self, key, text):
+        """Кладёт ответ в LRU, вытесняя самые старые записи"""
+        expires = time.time() + self.ttl
+        self.entries[key] = (expires, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return expires
+
+    def stats(self):
+        """Счётчики попаданий и промахов"""
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0
+        }
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+
+class SingleFlight:
+    """Объединяет одинаковые одновременные запросы в один вызов API
+
+    Первый запрос с данным ключом становится ведущим и попадает в очередь,
+    остальные ждут его результата, не занимая ни очередь, ни Void AI.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.coalesced = 0
+
+    def join(self, key):
+        """Возвращает future уже выполняющегося запроса или None"""
+        flight = self.flights.get(key)
+        if flight is None or flight.done():
+            return None
+        self.coalesced += 1
+        return flight
+
+    def lead(self, key):
+        """Регистрирует ведущий запрос"""
+        self.flights[key] = asyncio.get_running_loop().create_future()
+
+    def finish(self, key, result):
+        """Передаёт результат ведущего запроса всем ожидающим"""
+        flight = self.flights.pop(key, None)
+        if flight is not None and not flight.done():
+            flight.set_result(result)
+
+
+class SharedImage:
+    """Изображение, общее для нескольких чатов: байты загружаются в Telegram один раз
+
+    data — байты изображения или ссылка на него (её Telegram скачивает сам).
+    """
+
+    def __init__(self, data, file_id=None):
+        self.data = data
+        self.file_id = file_id
+        self.lock = asyncio.Lock()
+
+    async def send(self, bot, chat_id, caption):
+        """Отправляет фото, после первой загрузки — по file_id"""
+        if self.file_id is None:
+            async with self.lock:
+                if self.file_id is None:
+                    data = self.data
+                    message = await send_scheduler.send(
+                        chat_id, 'sendPhoto',
+                        lambda: bot.send_photo(chat_id=chat_id, photo=data, caption=caption, parse_mode='HTML')
+                    )
+                    if message.photo:
+                        self.file_id = message.photo[-1].file_id
+                        self.data = None
+                    return message
+        file_id = self.file_id
+        return await send_scheduler.send(
+            chat_id, 'sendPhoto',
+            lambda: bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, parse_mode='HTML')
+        )
+
+
+class AdaptiveLimiter:
+    """Адаптивный лимит параллельных запросов к одной модели (AIMD)
+
+    Лимит медленно растёт, пока задержка близка к базовой, и уменьшается
+    вдвое при 429/5xx или сетевых ошибках Void AI.
+    """
+
+    def __init__(self, initial, minimum, maximum, tolerance):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.in_flight = 0
+        # Воркеры, ждущие слота (задачи от удалённого брокера выдаются без проверки слота)
+        self.waiting = 0
+        self.freed = asyncio.Event()
+        self.baseline_latency = None
+        self.recent_latency = None
+
+    def try_acquire(self):
+        """Занимает слот, если лимит модели не исчерпан"""
+        if self.available():
+            self.in_flight += 1
+            return True
+        return False
+
+    def available(self):
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        """Занимает слот, дожидаясь его освобождения"""
+        self.waiting += 1
+        try:
+            while not self.try_acquire():
+                self.freed.clear()
+                await self.freed.wait()
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        """Освобождает слот"""
+        self.in_flight -= 1
+        self.freed.set()
+
+    def observe(self, latency, status_code=None):
+        """Учитывает результат запроса: status_code=None означает сетевую ошибку"""
+        if status_code is None or status_code == 429 or status_code >= 500:
+            self.limit = max(self.minimum, self.limit / 2)
+            return
+
+        if self.baseline_latency is None:
+            self.baseline_latency = self.recent_latency = latency
+        else:
+            self.baseline_latency += 0.05 * (latency - self.baseline_latency)
+            self.recent_latency += 0.3 * (latency - self.recent_latency)
+
+        if self.recent_latency <= self.baseline_latency * self.tolerance:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+class ModelLimits:
+    """Реестр адаптивных лимитов параллельности по моделям"""
+
+    def __init__(self):
+        self.limiters = {}
+
+    def get(self, model):
+        """Возвращает лимитер модели, создавая его при первом обращении"""
+        limiter = self.limiters.get(model)
+        if limiter is None:
+            limiter = AdaptiveLimiter(
+                CONFIG['MODEL_CONCURRENCY_INITIAL'],
+                CONFIG['MODEL_CONCURRENCY_MIN'],
+                CONFIG['MODEL_CONCURRENCY_MAX'],
+                CONFIG['MODEL_LATENCY_TOLERANCE']
+            )
+            self.limiters[model] = limiter
+        return limiter
+
+    def snapshot(self):
+        """Текущее состояние лимитов: модель -> (в работе, лимит, ждут слота)"""
+        return {
+            model: (limiter.in_flight, int(limiter.limit), limiter.waiting)
+            for model, limiter in self.limiters.items()
+        }
+
+
+model_limits = ModelLimits()
+response_cache = ResponseCache(
+    CONFIG['CACHE_MAX_ENTRIES'],
+    CONFIG['CACHE_TTL'],
+    disk_path=CONFIG['CACHE_DB_PATH'],
+    bypass_models=CONFIG['CACHE_BYPASS_MODELS'],
+    enabled=CONFIG['CACHE_ENABLED'],
+    disk_max_entries=CONFIG['CACHE_DISK_MAX_ENTRIES']
+)
+image_cache = ResponseCache(
+    CONFIG['IMAGE_CACHE_MAX_ENTRIES'],
+    CONFIG['IMAGE_CACHE_TTL'],
+    disk_path=CONFIG['IMAGE_CACHE_DB_PATH'],
+    enabled=CONFIG['IMAGE_CACHE_ENABLED'],
+    table='images'
+)
+text_flights = SingleFlight()
+image_flights = SingleFlight()
+send_scheduler = SendScheduler(
+    CONFIG['SEND_GLOBAL_RATE'],
+    CONFIG['SEND_CHAT_RATE'],
+    CONFIG['SEND_GROUP_RATE'],
+    CONFIG['SEND_CHAT_BURST'],
+    CONFIG['SEND_STATUS_MAX_AGE'],
+    CONFIG['SEND_MAX_RETRIES']
+)
+
+
+class Metric:
+    """Метрика Prometheus с набором меток (counter или gauge)"""
+
+    def __init__(self, name, help_text, kind, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{name}="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for name, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for key, value in self.values.items():
+            lines.append(f'{self.name}{self.format_labels(key)} {value}')
+        return lines
+
+
+class Histogram(Metric):
+    """Гистограмма Prometheus с фиксированными корзинами"""
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, 'histogram', labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # [счётчики корзин..., сумма, количество]
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Измеряет длительность блока"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for key, state in self.values.items():
+            for bound, count in zip(self.buckets, state):
+                lines.append(f'{self.name}_bucket{self.format_labels(key, ("le", str(bound)))} {count}')
+            lines.append(f'{self.name}_bucket{self.format_labels(key, ("le", "+Inf"))} {state[-1]}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {state[-2]}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {state[-1]}')
+        return lines
+
+
+class Metrics:
+    """Реестр метрик бота для эндпоинта /metrics"""
+
+    def __init__(self):
+        self.registry = []
+        self.queue_wait = self.histogram(
+            'c0d1x_queue_wait_seconds', 'Time a job waited before a worker picked it up', ['queue'])
+        self.job_duration = self.histogram(
+            'c0d1x_job_duration_seconds', 'End-to-end job time from enqueue to completion', ['queue'])
+        self.voidai_latency = self.histogram(
+            'c0d1x_voidai_request_seconds', 'VoidAI request latency per attempt', ['model'])
+        self.telegram_latency = self.histogram(
+            'c0d1x_telegram_request_seconds', 'Telegram Bot API call latency', ['method'])
+        self.voidai_errors = self.metric(
+            'c0d1x_voidai_errors_total', 'VoidAI errors by status code', 'counter', ['model', 'status'])
+        self.jobs_in_flight = self.metric(
+            'c0d1x_jobs_in_flight', 'Jobs currently being processed', 'gauge', ['queue'])
+        self.queue_size = self.metric(
+            'c0d1x_queue_size', 'Jobs waiting in the queue', 'gauge', ['queue'])
+        self.pool_requests = self.metric(
+            'c0d1x_http_pool_requests_in_flight', 'VoidAI requests in flight', 'gauge')
+        self.pool_max = self.metric(
+            'c0d1x_http_pool_max_connections', 'VoidAI connection pool size', 'gauge')
+        self.pool_connections = self.metric(
+            'c0d1x_http_pool_connections', 'Open VoidAI connections', 'gauge', ['state'])
+        self.model_concurrency = self.metric(
+            'c0d1x_model_concurrency', 'Adaptive per-model concurrency', 'gauge', ['model', 'kind'])
+        self.send_queue = self.metric(
+            'c0d1x_telegram_send_queue', 'Outbound Telegram calls waiting in the scheduler', 'gauge')
+        self.sends = self.metric(
+            'c0d1x_telegram_sends_total', 'Outbound Telegram calls by outcome', 'counter', ['result'])
+        self.webhook_updates = self.metric(
+            'c0d1x_webhook_updates_total', 'Webhook requests from Telegram by result', 'counter', ['result'])
+        self.jobs_dropped = self.metric(
+            'c0d1x_jobs_dropped_total', 'Jobs dropped before completion by reason', 'counter', ['queue', 'reason'])
+        self.auto_routes = self.metric(
+            'c0d1x_auto_routes_total', 'Requests for the auto model by chosen model', 'counter', ['model'])
+        self.shed = self.metric(
+            'c0d1x_jobs_shed_total', 'Jobs rejected or degraded by admission control', 'counter', ['queue', 'action'])
+        self.cache_requests = self.metric(
+            'c0d1x_cache_requests_total', 'Cache lookups by result', 'counter', ['cache', 'result'])
+        self.loop_lag = self.histogram(
+            'c0d1x_event_loop_lag_seconds', 'Event loop scheduling lag', buckets=Histogram.LAG_BUCKETS)
+        self.loop_stalls = self.metric(
+            'c0d1x_event_loop_stalls_total', 'Event loop blocked longer than the stall threshold', 'counter')
+        self.key_headroom = self.metric(
+            'c0d1x_voidai_key_headroom', 'Remaining share of a VoidAI key budget', 'gauge', ['key'])
+        self.key_quarantines = self.metric(
+            'c0d1x_voidai_key_quarantines_total', 'VoidAI keys taken out of rotation by reason', 'counter', ['key', 'reason'])
+        self.uptime = self.metric(
+            'c0d1x_uptime_seconds', 'Bot uptime', 'gauge')
+
+    def metric(self, name, help_text, kind, labelnames=()):
+        metric = Metric(name, help_text, kind, labelnames)
+        self.registry.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        histogram = Histogram(name, help_text, labelnames, buckets)
+        self.registry.append(histogram)
+        return histogram
+
+    def collect_state(self, api_handler=None):
+        """Обновляет метрики-снимки текущего состояния перед выдачей"""
+        self.uptime.set(round((datetime.now() - bot_start_time).total_seconds(), 3))
+        self.queue_size.set(text_queue.qsize(), queue='text')
+        self.queue_size.set(image_queue.qsize(), queue='image')
+        for model, (in_flight, limit, waiting) in model_limits.snapshot().items():
+            self.model_concurrency.set(in_flight, model=model, kind='in_flight')
+            self.model_concurrency.set(limit, model=model, kind='limit')
+            self.model_concurrency.set(waiting, model=model, kind='waiting')
+        stats = send_scheduler.stats()
+        self.send_queue.set(stats['queued'])
+        for result in ('sent', 'dropped', 'merged', 'flood_waits'):
+            self.sends.set(stats[result], result=result)
+        for name, cache in (('response', response_cache), ('image', image_cache)):
+            stats = cache.stats()
+            self.cache_requests.set(stats['hits'], cache=name, result='hit')
+            self.cache_requests.set(stats['disk_hits'], cache=name, result='disk_hit')
+            self.cache_requests.set(stats['misses'], cache=name, result='miss')
+        if api_handler is not None:
+            stats = api_handler.pool_stats()
+            self.pool_requests.set(stats['in_flight'])
+            self.pool_max.set(stats['max_connections'])
+            if stats['connections'] is not None:
+                self.pool_connections.set(stats['idle_connections'], state='idle')
+                self.pool_connections.set(stats['connections'] - stats['idle_connections'], state='active')
+            for key in api_handler.keys.stats():
+                self.key_headroom.set(key['headroom'], key=key['key'])
+
+    def render(self, api_handler=None):
+        """Текстовый формат Prometheus"""
+        self.collect_state(api_handler)
+        lines = []
+        for metric in self.registry:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class Trace:
+    """Хронология одного запроса пользователя: корневой интервал и вложенные этапы
+
+    Этап — кортеж (span_id, parent_id, имя, начало, конец, атрибуты),
+    время — по time.monotonic(). Число этапов ограничено, чтобы долгий
+    потоковый ответ с сотнями правок не раздувал память.
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'name', 'attrs', 'started', 'wall_started', 'spans', 'status', 'duration')
+
+    def __init__(self, name, trace_id=None, **attrs):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.name = name
+        self.attrs = attrs
+        self.started = time.monotonic()
+        self.wall_started = time.time()
+        self.spans = []
+        self.status = None
+        self.duration = None
+
+    def add(self, name, start, end, parent_id=None, **attrs):
+        """Добавляет уже завершившийся этап (например, ожидание в очереди)"""
+        if len(self.spans) < CONFIG['TRACE_MAX_SPANS']:
+            start = max(start, self.started)
+            self.spans.append((secrets.token_hex(8), parent_id or self.span_id, name, start, max(start, end), attrs))
+
+    def breakdown(self):
+        """Суммарное время и число этапов по именам, самые долгие первыми"""
+        totals = {}
+        for _, _, name, start, end, _ in self.spans:
+            seconds, count = totals.get(name, (0.0, 0))
+            totals[name] = (seconds + end - start, count + 1)
+        return sorted(totals.items(), key=lambda item: item[1][0], reverse=True)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'status': self.status,
+            'started': datetime.fromtimestamp(self.wall_started, timezone.utc).isoformat(),
+            'duration': self.duration,
+            'attrs': self.attrs,
+            'spans': [
+                {'name': name, 'start': round(start - self.started, 6), 'duration': round(end - start, 6),
+                 'parent': None if parent_id == self.span_id else parent_id, 'id': span_id, 'attrs': attrs}
+                for span_id, parent_id, name, start, end, attrs in self.spans
+            ]
+        }
+
+    def to_otlp(self, service_name):
+        """Запись в формате OTLP/JSON (ExportTraceServiceRequest) — одна строка файла"""
+        def nanos(moment):
+            return str(int((self.wall_started + moment - self.started) * 1e9))
+
+        def attributes(attrs):
+            result = []
+            for key, value in attrs.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    result.append({'key': key, 'value': {'stringValue': str(value)}})
+                elif isinstance(value, int):
+                    result.append({'key': key, 'value': {'intValue': str(value)}})
+                else:
+                    result.append({'key': key, 'value': {'doubleValue': value}})
+            return result
+
+        root = {
+            'traceId': self.trace_id, 'spanId': self.span_id, 'name': self.name, 'kind': 2,
+            'startTimeUnixNano': nanos(self.started), 'endTimeUnixNano': nanos(self.started + self.duration),
+            'attributes': attributes({**self.attrs, 'status': self.status}),
+            'status': {'code': 1 if self.status in ('ok', 'cache_hit', 'coalesced') else 2}
+        }
+        spans = [root] + [
+            {'traceId': self.trace_id, 'spanId': span_id, 'parentSpanId': parent_id, 'name': name, 'kind': 1,
+             'startTimeUnixNano': nanos(start), 'endTimeUnixNano': nanos(end), 'attributes': attributes(attrs)}
+            for span_id, parent_id, name, start, end, attrs in self.spans
+        ]
+        return {'resourceSpans': [{
+            'resource': {'attributes': attributes({'service.name': service_name, 'process.pid': os.getpid()})},
+            'scopeSpans': [{'scope': {'name': 'c0d1x_ai'}, 'spans': spans}]
+        }]}
+
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """Лёгкая трассировка запросов: кольцевой буфер, журнал медленных запросов и экспорт OTLP
+
+    Трасса запроса передаётся через очередь в поле Job.trace, а внутри
+    обработчика — через contextvars, поэтому этапы (запрос к Void AI,
+    разбор ответа, отправки в Telegram) отмечаются без передачи параметров.
+    Без активной трассы span() почти ничего не стоит.
+    """
+
+    def __init__(self, buffer_size, slow_threshold, otlp_path=None, enabled=True):
+        self.enabled = enabled
+        self.recent = collections.deque(maxlen=buffer_size)
+        self.slow_threshold = slow_threshold
+        self.otlp_path = otlp_path
+        self.executor = None
+        self.otlp_file = None
+
+    def start(self, name, trace_id=None, **attrs):
+        """Начинает трассу; None, если трассировка выключена"""
+        if not self.enabled:
+            return None
+        return Trace(name, trace_id, **attrs)
+
+    @contextlib.contextmanager
+    def use(self, trace):
+        """Делает трассу текущей в блоке (задачи, созданные внутри, её унаследуют)"""
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+
+    @staticmethod
+    def detach():
+        """Отвязывает фоновый цикл от трассы запроса, из которого его запустили
+
+        Задача копирует контекст создателя, поэтому без этого все её отправки
+        и записи приписывались бы первому запросу.
+        """
+        current_trace.set(None)
+        current_span.set(None)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Этап текущей трассы; в блоке можно дополнить attrs (например, кодом ответа)"""
+        trace = current_trace.get()
+        if trace is None or trace.duration is not None:
+            yield attrs
+            return
+        span_id = secrets.token_hex(8)
+        parent_token = current_span.set(span_id)
+        started = time.monotonic()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs['error'] = type(e).__name__
+            raise
+        finally:
+            current_span.reset(parent_token)
+            if len(trace.spans) < CONFIG['TRACE_MAX_SPANS']:
+                parent_id = current_span.get() or trace.span_id
+                trace.spans.append((span_id, parent_id, name, started, time.monotonic(), attrs))
+
+    def finish(self, trace, status='ok'):
+        """Завершает трассу: в буфер, в журнал медленных запросов и в файл OTLP"""
+        if trace is None or trace.duration is not None:
+            return
+        trace.duration = time.monotonic() - trace.started
+        trace.status = status
+        self.recent.append(trace)
+        if trace.duration >= self.slow_threshold:
+            self.log_slow(trace)
+        if self.otlp_path:
+            self.export(trace)
+
+    @staticmethod
+    def outcome(job, result):
+        """Статус трассы по результату задачи (value, error_text)"""
+        if job.cancelled:
+            return 'cancelled'
+        return 'error' if result[1] is not None else 'ok'
+
+    @staticmethod
+    def log_slow(trace):
+        parts = ', '.join(
+            f"{name} {seconds:.2f} с" + (f" ×{count}" if count > 1 else "")
+            for name, (seconds, count) in trace.breakdown()
+        )
+        attrs = ' '.join(f"{key}={value}" for key, value in trace.attrs.items())
+        print(f"🐢 Медленный запрос {trace.name} ({attrs}, {trace.status}) {trace.duration:.2f} с, "
+              f"trace {trace.trace_id}: {parts or 'без этапов'}")
+
+    def export(self, trace):
+        """Дописывает трассу в файл OTLP/JSON в отдельном потоке, не блокируя цикл событий"""
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='otlp')
+        line = json.dumps(trace.to_otlp(CONFIG['TRACE_SERVICE_NAME']), ensure_ascii=False)
+        self.executor.submit(self.write, line)
+
+    def write(self, line):
+        try:
+            if self.otlp_file is None:
+                self.otlp_file = open(self.otlp_path, 'a', encoding='utf-8')
+            self.otlp_file.write(line + '\n')
+            self.otlp_file.flush()
+        except OSError as e:
+            print(f"Ошибка записи трассы в {self.otlp_path}: {e}")
+
+    def snapshot(self, limit=50, slow_only=False, trace_id=None):
+        """Последние трассы, самые свежие первыми"""
+        traces = reversed(self.recent)
+        if trace_id:
+            traces = (trace for trace in traces if trace.trace_id == trace_id)
+        elif slow_only:
+            traces = (trace for trace in traces if trace.duration >= self.slow_threshold)
+        return [trace.to_dict() for trace in itertools.islice(traces, limit)]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.otlp_file is not None:
+            self.otlp_file.close()
+            self.otlp_file = None
+
+
+tracer = Tracer(
+    CONFIG['TRACE_BUFFER_SIZE'],
+    CONFIG['TRACE_SLOW_SECONDS'],
+    CONFIG['TRACE_OTLP_FILE'],
+    CONFIG['TRACE_ENABLED']
+)
+
+
+class HTTPRequest:
+    """Разобранный HTTP-запрос к серверу здоровья"""
+
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+class KeepAliveServer:
+    """HTTP сервер здоровья и метрик, работающий в цикле событий бота
+
+    Обслуживает /, /health и /metrics (формат Prometheus), отладочные
+    /debug/trace, /debug/loop и /debug/profile (по токену
+    CONFIG['DEBUG_TOKEN']), а в режиме вебхука — ещё и обновления от Telegram. Обработчики выполняются в том же цикле,
+    что и бот, поэтому читают состояние напрямую.
+    """
+
+    MAX_BODY = 1024 * 1024
+    IDLE_TIMEOUT = 30.0
+
+    def __init__(self, port=8080, api_handler=None):
+        self.port = port
+        self.api_handler = api_handler
+        self.server = None
+        self.connections = set()
+        self.application = None
+        self.webhook_secret = None
+        self.routes = {
+            ('GET', '/'): self.index,
+            ('GET', '/health'): self.health,
+            ('GET', '/metrics'): self.metrics_endpoint,
+            ('GET', '/debug/trace'): self.debug_trace,
+            ('GET', '/debug/loop'): self.debug_loop,
+            ('GET', '/debug/profile'): self.debug_profile
+        }
+
+    def route(self, method, path, handler):
+        """Регистрирует обработчик: async handler(request) -> (статус, content-type, тело)"""
+        self.routes[(method, path)] = handler
+
+    def enable_webhook(self, application, path, secret):
+        """Принимает обновления Telegram по POST на path и передаёт их приложению"""
+        self.application = application
+        self.webhook_secret = secret.encode()
+        self.route('POST', path, self.webhook)
+
+    async def start(self):
+        """Запускает сервер в текущем цикле событий"""
+        self.server = await asyncio.start_server(self.handle_connection, '0.0.0.0', self.port)
+        print(f"🔄 Keep-alive сервер запущен на порту {self.port}")
+        return self
+
+    async def stop(self):
+        """Останавливает HTTP сервер"""
+        if self.server:
+            self.server.close()
+            # Закрываем простаивающие keep-alive соединения, иначе wait_closed будет их ждать
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+            print("🔴 Keep-alive сервер остановлен")
+
+    async def read_request(self, reader):
+        """Читает один запрос; None — соединение закрыто"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.IDLE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        
+        length = int(headers.get('content-length') or 0)
+        if length > self.MAX_BODY:
+            raise ValueError('request body too large')
+        body = await reader.readexactly(length) if length else b''
+        
+        path, _, query_string = target.partition('?')
+        import urllib.parse  # HTTP-сервер есть только у процесса приёма
+        query = {name: values[-1] for name, values in urllib.parse.parse_qs(query_string).items()}
+        return HTTPRequest(method.upper(), path, query, headers, body)
+
+    async def handle_connection(self, reader, writer):
+        """Обслуживает соединение (с поддержкой keep-alive)"""
+        self.connections.add(writer)
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                
+                handler = self.routes.get((request.method, request.path))
+                if handler is None:
+                    status, content_type, body = 404, 'text/plain', b'Not Found'
+                else:
+                    try:
+                        status, content_type, body = await handler(request)
+                    except Exception as e:
+                        print(f"Ошибка HTTP-обработчика {request.path}: {e}")
+                        status, content_type, body = 500, 'text/plain', b'Internal Server Error'
+                
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+                    f'Content-Type: {content_type}\r\n'
+                    f'Content-Length: {len(body)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def index(self, request):
+        return 200, 'text/html', b'<html><body><h1>C0D1X AI Bot is running!</h1><p><a href="/health">Health Check</a> | <a href="/metrics">Metrics</a></p></body></html>'
+
+    async def health(self, request):
+        uptime = datetime.now() - bot_start_time
+        response = {
+            'status': 'healthy',
+            'bot_uptime': str(uptime),
+            'text_queue_size': text_queue.qsize(),
+            'image_queue_size': image_queue.qsize(),
+            'http_pool': self.api_handler.pool_stats() if self.api_handler else None,
+            'voidai_keys': self.api_handler.keys.stats() if self.api_handler else None,
+            'startup_seconds': startup_timer.ready_after,
+            'loop_lag': loop_watchdog.percentiles(),
+            'timestamp': datetime.now().isoformat()
+        }
+        return 200, 'application/json', json.dumps(response, indent=2, ensure_ascii=False).encode()
+
+    async def metrics_endpoint(self, request):
+        body = metrics.render(self.api_handler).encode()
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', body
+
+    @staticmethod
+    def authorized(request):
+        """Доступ к /debug/*: токен в ?token= или заголовке X-Debug-Token; без DEBUG_TOKEN закрыто"""
+        expected = CONFIG['DEBUG_TOKEN']
+        if not expected:
+            return False
+        token = request.query.get('token') or request.headers.get('x-debug-token', '')
+        return hmac.compare_digest(token.encode(), expected.encode())
+
+    async def debug_trace(self, request):
+        """Последние трассы запросов: ?limit=N, ?slow=1 — только медленные, ?id= — одна трасса"""
+        if not self.authorized(request):
+            return 403, 'text/plain', b'Forbidden'
+        try:
+            limit = int(request.query.get('limit', 50))
+        except ValueError:
+            return 400, 'text/plain', b'Bad Request'
+        response = {
+            'enabled': tracer.enabled,
+            'slow_threshold': tracer.slow_threshold,
+            'traces': tracer.snapshot(limit, request.query.get('slow') == '1', request.query.get('id'))
+        }
+        return 200, 'application/json', json.dumps(response, indent=2, ensure_ascii=False).encode()
+
+    async def debug_loop(self, request):
+        """Перцентили задержки цикла событий и стеки последних блокировок"""
+        if not self.authorized(request):
+            return 403, 'text/plain', b'Forbidden'
+        return 200, 'application/json', json.dumps(loop_watchdog.stats(), indent=2, ensure_ascii=False).encode()
+
+    async def debug_profile(self, request):
+        """Выборочное профилирование на ?seconds=N; ответ — свёрнутые стеки для flamegraph"""
+        if not self.authorized(request):
+            return 403, 'text/plain', b'Forbidden'
+        try:
+            seconds = float(request.query.get('seconds', 10))
+        except ValueError:
+            return 400, 'text/plain', b'Bad Request'
+        seconds = min(max(seconds, 0.1), CONFIG['PROFILE_MAX_SECONDS'])
+        counts = await asyncio.to_thread(profiler.sample, seconds)
+        if counts is None:
+            return 409, 'text/plain', b'Profiling already in progress'
+        return 200, 'text/plain; charset=utf-8', SamplingProfiler.collapse(counts).encode()
+
+    async def webhook(self, request):
+        """Проверяет секрет и ставит обновление в очередь приложения, не дожидаясь обработки"""
+        token = request.headers.get('x-telegram-bot-api-secret-token', '').encode()
+        if not hmac.compare_digest(token, self.webhook_secret):
+            metrics.webhook_updates.inc(result='forbidden')
+            return 403, 'text/plain', b'Forbidden'
+        try:
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"Некорректное обновление вебхука: {e}")
+            metrics.webhook_updates.inc(result='invalid')
+            return 400, 'text/plain', b'Bad Request'
+        # Очередь приложения не ограничена: ответ Telegram уходит сразу,
+        # а обработчики выполняются так же, как при polling
+        self.application.update_queue.put_nowait(update)
+        metrics.webhook_updates.inc(result='accepted')
+        return 200, 'text/plain', b'OK'
+
+
+class ModelUnavailableError(Exception):
+    """Модель (и вся цепочка замен) временно недоступна — предохранители разомкнуты"""
+
+
+class CircuitBreaker:
+    """Предохранитель модели: после серии ошибок временно перестаёт её вызывать
+
+    По истечении BREAKER_COOLDOWN пропускает один пробный запрос: при успехе
+    предохранитель замыкается, при ошибке снова размыкается.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def is_open(self):
+        """Можно ли сейчас вызывать модель"""
+        state = self.state
+        if state == 'half-open':
+            return self.probe_started is not None and time.monotonic() - self.probe_started < self.cooldown
+        return state == 'open'
+
+    def allow(self):
+        """Разрешает запрос; в полуоткрытом состоянии — только один пробный"""
+        if self.is_open():
+            return False
+        if self.state == 'half-open':
+            self.probe_started = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_skip(self):
+        """Ответ ничего не говорит о модели (отказ ключа) — пробный запрос можно повторить"""
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probe_started is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+
+
+class LatencyWindow:
+    """Скользящее окно последних задержек модели для расчёта перцентилей"""
+
+    def __init__(self, size=100):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def percentile(self, q, min_samples=1):
+        """Перцентиль q (0..1) или None, если данных мало"""
+        if len(self.samples) < max(1, min_samples):
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoopWatchdog:
+    """Сторож цикла событий: задержка планирования и стек того, что его заблокировало
+
+    Корутина run() засыпает на interval и меряет, насколько позже её
+    разбудили, — это задержка цикла: столько же ждал любой другой
+    обработчик. Отдельный поток следит за сердцебиением корутины и, если
+    цикл не отзывается дольше threshold, снимает стек потока цикла через
+    sys._current_frames() — пока блокирующий вызов ещё выполняется.
+    """
+
+    def __init__(self, interval, threshold, history=20, enabled=True):
+        self.enabled = enabled
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = LatencyWindow(CONFIG['LOOP_LAG_WINDOW'])
+        self.stalls = collections.deque(maxlen=history)
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        # (сердцебиение, стек), снятый потоком-сторожем во время блокировки
+        self.blocked = None
+        self.stopping = threading.Event()
+
+    async def run(self):
+        """Цикл замеров; вместе с ним работает поток-сторож"""
+        if not self.enabled:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.stopping.clear()
+        threading.Thread(target=self.watch, name='loop-watchdog', daemon=True).start()
+        try:
+            while True:
+                beat = self.heartbeat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.observe(beat, max(0.0, time.monotonic() - beat - self.interval))
+        finally:
+            self.stopping.set()
+
+    def watch(self):
+        """Поток-сторож: снимает стек цикла, пока тот заблокирован"""
+        while not self.stopping.wait(self.threshold / 2):
+            beat = self.heartbeat
+            if self.blocked is not None and self.blocked[0] == beat:
+                continue
+            if time.monotonic() - beat - self.interval > self.threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.blocked = (beat, traceback.format_stack(frame))
+
+    def observe(self, beat, lag):
+        self.lags.add(lag)
+        metrics.loop_lag.observe(lag)
+        if lag < self.threshold:
+            return
+        stack = self.blocked[1] if self.blocked is not None and self.blocked[0] == beat else None
+        self.blocked = None
+        metrics.loop_stalls.inc()
+        self.stalls.append({
+            'at': datetime.now(timezone.utc).isoformat(),
+            'lag': round(lag, 3),
+            'stack': ''.join(stack) if stack else None
+        })
+        # В лог — только самые внутренние вызовы: их обычно достаточно, полный стек есть в /debug/loop
+        where = ''.join(stack[-CONFIG['LOOP_STALL_LOG_FRAMES']:]) if stack else "  (стек снять не успели)\n"
+        print(f"🐌 Цикл событий был заблокирован на {lag:.2f} с:\n{where}", end='')
+
+    def percentiles(self):
+        """Перцентили задержки цикла за последние замеры, секунды"""
+        result = {}
+        for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            value = self.lags.percentile(q)
+            result[name] = round(value, 4) if value is not None else None
+        result['max'] = round(max(self.lags.samples), 4) if self.lags.samples else None
+        return result
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'lag': self.percentiles(),
+            'stalls': list(reversed(self.stalls))
+        }
+
+    def stop(self):
+        self.stopping.set()
+
+
+loop_watchdog = LoopWatchdog(
+    CONFIG['LOOP_LAG_INTERVAL'],
+    CONFIG['LOOP_STALL_THRESHOLD'],
+    CONFIG['LOOP_STALL_HISTORY'],
+    CONFIG['LOOP_WATCHDOG']
+)
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик: раз в interval снимает стеки всех потоков
+
+    Результат — свёрнутые стеки (формат collapsed для flamegraph.pl,
+    speedscope и inferno): строка «поток;внешняя функция;...;внутренняя
+    число выборок». Выборки делает отдельный поток, поэтому цикл событий
+    продолжает работать; одновременно идёт только один сеанс.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+    def sample(self, seconds):
+        """Профилирует seconds секунд; возвращает {свёрнутый стек: число выборок} или None, если занят"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            own = threading.get_ident()
+            counts = collections.Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self.frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(thread_id, f'thread-{thread_id}'))
+                    counts[';'.join(reversed(stack))] += 1
+                time.sleep(self.interval)
+            return counts
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def collapse(counts):
+        return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+profiler = SamplingProfiler(CONFIG['PROFILE_INTERVAL'])
+
+
+class Resilience:
+    """Повторы с экспоненциальной задержкой, предохранители, хеджирование и замена модели"""
+
+    RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+    # Ответы, которые говорят о ключе, а не о модели
+    KEY_STATUSES = {401, 403, 429}
+
+    def __init__(self, keys=None):
+        self.keys = keys
+        self.breakers = {}
+        self.latencies = {}
+        self.healths = {}
+        self.retries = 0
+        self.hedges = 0
+        self.fallbacks = 0
+
+    def breaker(self, model):
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(CONFIG['BREAKER_THRESHOLD'], CONFIG['BREAKER_COOLDOWN'])
+        return breaker
+
+    def latency(self, model):
+        window = self.latencies.get(model)
+        if window is None:
+            window = self.latencies[model] = LatencyWindow()
+        return window
+
+    def health(self, model):
+        health = self.healths.get(model)
+        if health is None:
+            health = self.healths[model] = ModelHealth()
+        return health
+
+    @staticmethod
+    def backoff(attempt):
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(CONFIG['RETRY_MAX_DELAY'], CONFIG['RETRY_BASE_DELAY'] * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(response):
+        """Задержка из заголовка Retry-After (секунды или HTTP-дата) или None"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                import email.utils  # Дата в Retry-After встречается редко — не тратим на неё время запуска
+                delay = (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(max(delay, 0.0), CONFIG['RETRY_AFTER_MAX'])
+
+    def fallback_chain(self, model):
+        """Модель и её замены из CONFIG['MODEL_FALLBACKS']"""
+        fallbacks = CONFIG['MODEL_FALLBACKS'].get(model, CONFIG['MODEL_FALLBACKS']['default'])
+        chain = [model]
+        for candidate in fallbacks:
+            if candidate in MODELS and candidate not in chain:
+                chain.append(candidate)
+        return chain
+
+    async def call_with_fallback(self, model, send, hedge=False):
+        """Вызывает модель, переходя к заменам, пока у неё разомкнут предохранитель"""
+        for candidate in self.fallback_chain(model):
+            try:
+                response = await self.call(candidate, send, hedge)
+            except ModelUnavailableError:
+                continue
+            if candidate != model:
+                self.fallbacks += 1
+            return response, candidate
+        raise ModelUnavailableError(model)
+
+    async def call(self, model, send, hedge=False):
+        """Вызывает send(model) с повторами при 429/5xx и сетевых ошибках"""
+        breaker = self.breaker(model)
+        attempts = CONFIG['RETRY_ATTEMPTS']
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise ModelUnavailableError(model)
+            
+            last_attempt = attempt == attempts - 1
+            started = time.monotonic()
+            try:
+                with tracer.span('voidai.request', model=model, attempt=attempt + 1) as span:
+                    response = await (self.hedged(model, send) if hedge else send(model))
+                    span['status'] = response.status_code
+            except httpx.TransportError:
+                metrics.voidai_errors.inc(model=model, status='transport')
+                breaker.record_failure()
+                self.health(model).observe(failed=True)
+                if last_attempt:
+                    raise
+                self.retries += 1
+                with tracer.span('voidai.backoff', model=model):
+                    await asyncio.sleep(self.backoff(attempt))
+                continue
+            
+            metrics.voidai_latency.observe(time.monotonic() - started, model=model)
+            if response.status_code != 200:
+                metrics.voidai_errors.inc(model=model, status=response.status_code)
+            
+            if response.status_code in self.KEY_STATUSES and self.keys is not None and self.keys.available():
+                # Ключ выведен из оборота, а другие есть — сразу повторяем с другим;
+                # модель тут ни при чём: предохранитель и оценки здоровья не трогаем
+                breaker.record_skip()
+                if last_attempt:
+                    return response
+                self.retries += 1
+                await response.aclose()
+                continue
+            if response.status_code in (401, 403):
+                # Ключей не осталось — это не сбой модели и не её задержка
+                breaker.record_skip()
+                return response
+            
+            if response.status_code in self.RETRYABLE_STATUSES:
+                breaker.record_failure()
+                self.health(model).observe(time.monotonic() - started, failed=True)
+                if last_attempt:
+                    return response
+                self.retries += 1
+                delay = self.retry_after(response)
+                await response.aclose()
+                with tracer.span('voidai.backoff', model=model):
+                    await asyncio.sleep(self.backoff(attempt) if delay is None else delay)
+                continue
+            
+            breaker.record_success()
+            latency = time.monotonic() - started
+            self.latency(model).add(latency)
+            self.health(model).observe(latency)
+            return response
+
+    async def hedged(self, model, send):
+        """Если ответа нет дольше p95, отправляет второй запрос и берёт тот, что придёт первым"""
+        delay = self.latency(model).percentile(CONFIG['HEDGE_QUANTILE'], CONFIG['HEDGE_MIN_SAMPLES'])
+        first = asyncio.create_task(send(model))
+        if delay is None:
+            return await first
+        
+        pending = {first}
+        winner = None
+        finished = []
+        try:
+            # Отмена вызывающего во время ожидания не должна оставить запросы висеть
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            
+            self.hedges += 1
+            pending.add(asyncio.create_task(send(model)))
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    finished.append(task)
+                    if (winner is None and task.exception() is None
+                            and task.result().status_code not in self.RETRYABLE_STATUSES):
+                        winner = task
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        if winner is None:
+            # Оба запроса неудачны — отдаём результат последнего для обычной логики повторов
+            winner = finished[-1]
+        for task in finished:
+            if task is not winner and task.exception() is None:
+                await task.result().aclose()
+        return winner.result()
+
+    def stats(self):
+        return {
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'fallbacks': self.fallbacks,
+            'open_breakers': [model for model, breaker in self.breakers.items() if breaker.is_open()]
+        }
+
+
+class ModelHealth:
+    """Сглаженные задержка и доля ошибок модели для автовыбора"""
+
+    __slots__ = ('latency', 'error_rate')
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+
+    def observe(self, latency=None, failed=False):
+        alpha = CONFIG['AUTO_SMOOTHING']
+        self.error_rate += alpha * ((1.0 if failed else 0.0) - self.error_rate)
+        if latency is not None:
+            self.latency = latency if self.latency is None else self.latency + alpha * (latency - self.latency)
+
+
+class ModelRouter:
+    """Выбор модели для "auto": самая быстрая здоровая модель своего уровня качества
+
+    Оценка модели — сглаженная задержка плюс ожидание свободного слота её
+    адаптивного лимита, делённые на долю успешных запросов. Модели с
+    разомкнутым предохранителем пропускаются, изредка выбирается случайная,
+    чтобы статистика остальных не устаревала.
+    """
+
+    def __init__(self, resilience):
+        self.resilience = resilience
+
+    def candidates(self):
+        tier = CONFIG['AUTO_MODEL_TIERS'].get(CONFIG['AUTO_MODEL_TIER'], CONFIG['AUTO_MODEL_TIERS']['standard'])
+        return [model for model in tier if model in MODELS and not self.resilience.breaker(model).is_open()]
+
+    def score(self, model):
+        """Ожидаемое время ответа модели с учётом её загрузки и ошибок"""
+        health = self.resilience.health(model)
+        latency = health.latency if health.latency is not None else CONFIG['AUTO_UNKNOWN_LATENCY']
+        limiter = model_limits.get(model)
+        limit = max(1, int(limiter.limit))
+        waiting = limiter.waiting + max(0, limiter.in_flight + 1 - limit)
+        return latency * (1 + waiting / limit) / max(0.05, 1 - health.error_rate)
+
+    def choose(self):
+        candidates = self.candidates()
+        if not candidates:
+            # Весь уровень недоступен — дальше сработают обычные замены модели
+            return CONFIG['QUEUE_DEGRADE_MODEL']
+        if random.random() < CONFIG['AUTO_EXPLORE']:
+            model = random.choice(candidates)
+        else:
+            model = min(candidates, key=self.score)
+        metrics.auto_routes.inc(model=model)
+        return model
+
+
+class ApiKey:
+    """Ключ Void AI и его бюджеты: запросы и токены в минуту (токен-бакеты)"""
+
+    __slots__ = ('key', 'name', 'rpm', 'tpm', 'requests', 'tokens', 'updated', 'quarantined_until', 'used')
+
+    def __init__(self, key, name, rpm, tpm):
+        self.key = key
+        self.name = name
+        self.rpm = rpm
+        # 0 — лимит токенов неизвестен (пока его не сообщат заголовки ответа)
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.quarantined_until = 0.0
+        self.used = 0
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.updated = now
+
+    def headroom(self, now):
+        """Доля оставшегося бюджета по самому исчерпанному из лимитов (может быть меньше нуля)"""
+        self.refill(now)
+        headroom = self.requests / self.rpm
+        if self.tpm:
+            headroom = min(headroom, self.tokens / self.tpm)
+        return headroom
+
+
+class KeyPool:
+    """Пул ключей Void AI: запрос получает ключ с наибольшим запасом бюджета
+
+    Бюджеты задаются CONFIG['VOIDAI_KEY_RPM'] и CONFIG['VOIDAI_KEY_TPM'] и
+    уточняются по заголовкам x-ratelimit-* ответов. Ключ, получивший 401/403
+    или 429, на время выводится из оборота; если выведены все, берётся тот,
+    что вернётся раньше.
+    """
+
+    LIMIT_HEADERS = {
+        'requests': ('x-ratelimit-limit-requests', 'x-ratelimit-remaining-requests'),
+        'tokens': ('x-ratelimit-limit-tokens', 'x-ratelimit-remaining-tokens')
+    }
+
+    def __init__(self, keys, rpm, tpm):
+        self.keys = [ApiKey(key, f'key{number}', rpm, tpm) for number, key in enumerate(keys, 1)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self, tokens=0):
+        """Выбирает ключ для запроса и списывает с него запрос и оценку токенов"""
+        now = time.monotonic()
+        available = [key for key in self.keys if key.quarantined_until <= now]
+        if available:
+            key = max(available, key=lambda key: key.headroom(now))
+        else:
+            key = min(self.keys, key=lambda key: key.quarantined_until)
+            key.refill(now)
+        key.requests -= 1
+        if key.tpm:
+            key.tokens -= tokens
+        key.used += 1
+        return key
+
+    def available(self):
+        """Есть ли ключ, не выведенный из оборота"""
+        now = time.monotonic()
+        return any(key.quarantined_until <= now for key in self.keys)
+
+    def observe(self, key, response):
+        """Учитывает ответ: лимиты из заголовков, вывод ключа из оборота при 401/403/429"""
+        self.learn(key, response.headers)
+        status_code = response.status_code
+        if status_code in (401, 403):
+            self.quarantine(key, CONFIG['VOIDAI_KEY_AUTH_QUARANTINE'], 'unauthorized')
+        elif status_code == 429:
+            delay = Resilience.retry_after(response)
+            key.requests = min(key.requests, 0.0)
+            self.quarantine(key, CONFIG['VOIDAI_KEY_RATE_QUARANTINE'] if delay is None else delay, 'rate_limited')
+
+    def learn(self, key, headers):
+        """Подстраивает бюджет ключа под лимиты и остатки, которые сообщил Void AI"""
+        for kind, (limit_header, remaining_header) in self.LIMIT_HEADERS.items():
+            try:
+                limit = int(headers.get(limit_header) or 0)
+                remaining = headers.get(remaining_header)
+                remaining = float(remaining) if remaining is not None else None
+            except ValueError:
+                continue
+            if kind == 'requests':
+                if limit:
+                    key.rpm = limit
+                if remaining is not None:
+                    key.requests = min(remaining, key.rpm)
+            else:
+                if limit:
+                    key.tpm = limit
+                if remaining is not None and key.tpm:
+                    key.tokens = min(remaining, key.tpm)
+
+    def quarantine(self, key, seconds, reason):
+        key.quarantined_until = max(key.quarantined_until, time.monotonic() + seconds)
+        metrics.key_quarantines.inc(key=key.name, reason=reason)
+        print(f"🔑 Ключ {key.name} (…{key.key[-4:]}) выведен из оборота на {seconds:.0f} с: {reason}")
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            {
+                'key': key.name,
+                'headroom': round(key.headroom(now), 3),
+                'rpm': key.rpm,
+                'tpm': key.tpm or None,
+                'requests': key.used,
+                'quarantined_for': round(max(0.0, key.quarantined_until - now), 1)
+            }
+            for key in self.keys
+        ]
+
+
+def decode_image_response(content, recompress=None, quality=85, max_side=0):
+    """Разбирает ответ Void AI с b64_json и декодирует изображение; None, если его нет
+
+    Выполняется в пуле ImagePipeline: разбор JSON размером в мегабайты и
+    декодирование base64 не занимают цикл событий.
+    """
+    items = json.loads(content).get('data') or [{}]
+    encoded = items[0].get('b64_json')
+    if not encoded:
+        return None
+    image = base64.b64decode(encoded)
+    return recompress_image(image, recompress, quality, max_side) if recompress else image
+
+
+def recompress_image(image, image_format, quality=85, max_side=0):
+    """Перекодирует изображение в JPEG/WebP (Pillow), при необходимости уменьшая его
+
+    Если результат не меньше исходника, возвращается исходник.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image)) as picture:
+        if max_side and max(picture.size) > max_side:
+            picture.thumbnail((max_side, max_side))
+        if image_format == 'jpeg' and picture.mode not in ('RGB', 'L'):
+            picture = picture.convert('RGB')
+        output = io.BytesIO()
+        picture.save(output, format=image_format.upper(), quality=quality)
+    # getvalue() отдаёт внутренний буфер BytesIO без копирования
+    result = output.getvalue()
+    return result if len(result) < len(image) else image
+
+
+class ImagePipeline:
+    """Подготовка сгенерированных изображений к отправке вне цикла событий
+
+    Разбор ответа, декодирование и перекодирование (CONFIG['IMAGE_RECOMPRESS'])
+    выполняются в пуле потоков или процессов (CONFIG['IMAGE_PIPELINE_EXECUTOR']);
+    готовые байты передаются в send_photo как есть, без промежуточных копий.
+    В режиме CONFIG['IMAGE_RESPONSE_FORMAT'] == 'url' без перекодирования
+    изображение вообще не проходит через бот: Telegram скачивает его по ссылке.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.url_mode = CONFIG['IMAGE_RESPONSE_FORMAT'] == 'url'
+        self.recompress = CONFIG['IMAGE_RECOMPRESS'] if CONFIG['IMAGE_RECOMPRESS'] and self.pillow_available() else None
+        self.executor = None
+
+    @staticmethod
+    def pillow_available():
+        """Проверяет, установлен ли Pillow"""
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            print("⚠️ Перекодирование изображений запрошено, но Pillow не установлен — изображения отправляются как есть")
+            return False
+        return True
+
+    async def run(self, function, *args):
+        """Выполняет function в пуле (создаётся при первом изображении, чтобы не замедлять запуск)"""
+        if self.executor is None:
+            if CONFIG['IMAGE_PIPELINE_EXECUTOR'] == 'process':
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=CONFIG['IMAGE_PIPELINE_WORKERS'])
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=CONFIG['IMAGE_PIPELINE_WORKERS'], thread_name_prefix='image')
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def prepare(self, response):
+        """Фото для send_photo из ответа Void AI: байты или ссылка; None, если изображения в ответе нет"""
+        if not self.url_mode:
+            return await self.run(
+                decode_image_response, response.content,
+                self.recompress, CONFIG['IMAGE_RECOMPRESS_QUALITY'], CONFIG['IMAGE_MAX_SIDE']
+            )
+        # Ответ со ссылкой маленький — разбираем его сразу
+        items = response.json().get('data') or [{}]
+        url = items[0].get('url')
+        if not url or not self.recompress:
+            return url
+        return await self.download(url)
+
+    async def download(self, url):
+        """Скачивает изображение по ссылке Void AI и перекодирует его, если это включено"""
+        response = await self.client.get(url)
+        response.raise_for_status()
+        if not self.recompress:
+            return response.content
+        return await self.run(
+            recompress_image, response.content,
+            self.recompress, CONFIG['IMAGE_RECOMPRESS_QUALITY'], CONFIG['IMAGE_MAX_SIDE']
+        )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+class APIHandler:
+    """Класс для работы с API
+
+    Владеет единственным на процесс httpx.AsyncClient: пул соединений
+    рассчитан на число воркеров, соединения прогреваются при старте.
+    """
+    
+    def __init__(self):
+        self.max_connections = CONFIG['TEXT_WORKERS'] + CONFIG['IMAGE_WORKERS'] + 2
+        self.http2 = CONFIG['HTTP2'] and self.http2_available()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.keys = KeyPool(CONFIG['VOIDAI_API_KEYS'], CONFIG['VOIDAI_KEY_RPM'], CONFIG['VOIDAI_KEY_TPM'])
+        self.resilience = Resilience(self.keys)
+        self.router = ModelRouter(self.resilience)
+        self.transport = httpx.AsyncHTTPTransport(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=CONFIG['HTTP_KEEPALIVE_EXPIRY']
+            )
+        )
+        self.client = httpx.AsyncClient(
+            transport=self.transport,
+            timeout=httpx.Timeout(
+                connect=CONFIG['CONNECT_TIMEOUT'],
+                read=CONFIG['REQUEST_TIMEOUT'],
+                write=CONFIG['WRITE_TIMEOUT'],
+                pool=CONFIG['POOL_TIMEOUT']
+            )
+        )
+        self.images = ImagePipeline(self.client)
+
+    @staticmethod
+    def http2_available():
+        """Проверяет, установлен ли пакет h2"""
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("⚠️ HTTP/2 запрошен, но пакет h2 не установлен — используется HTTP/1.1")
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def track(self):
+        """Учитывает запрос к Void AI в статистике пула"""
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    async def prewarm(self):
+        """Заранее открывает соединения с Void AI, чтобы первый запрос не ждал TLS"""
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *[self.client.head(CONFIG['VOIDAI_BASE_URL']) for _ in range(CONFIG['HTTP_PREWARM_CONNECTIONS'])],
+            return_exceptions=True
+        )
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            print(f"⚠️ Прогрев соединений не удался: {failed[0]}")
+        else:
+            print(f"🔥 Соединения с Void AI прогреты за {time.monotonic() - started:.2f} с")
+
+    def pool_stats(self):
+        """Статистика пула соединений"""
+        stats = {
+            'http2': self.http2,
+            'max_connections': self.max_connections,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'connections': None,
+            'idle_connections': None
+        }
+        # httpx не даёт публичного доступа к пулу, поэтому читаем его осторожно
+        pool = getattr(self.transport, '_pool', None)
+        connections = getattr(pool, 'connections', None)
+        if connections is not None:
+            stats['connections'] = len(connections)
+            stats['idle_connections'] = sum(1 for connection in connections if connection.is_idle())
+        return stats
+
+    async def close(self):
+        """Закрывает HTTP-клиент и пул обработки изображений"""
+        self.images.close()
+        await self.client.aclose()
+
+    @staticmethod
+    def auth_headers(key):
+        """Заголовки авторизации Void AI для ключа из пула"""
+        return {
+            'Authorization': f'Bearer {key.key}',
+            'Content-Type': 'application/json'
+        }
+
+    @staticmethod
+    def estimate_request_tokens(prompt, history=None):
+        """Оценка токенов запроса вместе с ожидаемым ответом — для бюджета ключа"""
+        tokens = ConversationStore.estimate_tokens(prompt) + CONFIG['VOIDAI_KEY_OUTPUT_TOKENS']
+        return tokens + sum(ConversationStore.estimate_tokens(turn['content']) for turn in history or ())
+
+    async def send_text_request(self, prompt, model, stream=False, history=None):
+        """Отправляет один запрос генерации текста (без повторов)"""
+        payload = {
+            'model': model,
+            'messages': [*(history or ()), {'role': 'user', 'content': prompt}]
+        }
+        if stream:
+            payload['stream'] = True
+        key = self.keys.acquire(self.estimate_request_tokens(prompt, history))
+        request = self.client.build_request(
+            'POST', CONFIG['VOIDAI_TEXT_URL'], headers=self.auth_headers(key), json=payload
+        )
+        response = await self.client.send(request, stream=stream)
+        self.keys.observe(key, response)
+        return response
+
+    async def generate_text(self, prompt, model, history=None):
+        """Генерирует текст через API; возвращает (ответ, фактически использованная модель)"""
+        with self.track():
+            return await self.resilience.call_with_fallback(
+                model,
+                lambda candidate: self.send_text_request(prompt, candidate, history=history),
+                hedge=CONFIG['HEDGE_REQUESTS']
+            )
+
+    @contextlib.asynccontextmanager
+    async def stream_text(self, prompt, model, history=None):
+        """Открывает потоковый (SSE) запрос генерации текста
+
+        Используется как `async with api_handler.stream_text(...) as (response, used_model)`.
+        Повторы и хеджирование действуют до получения заголовков ответа.
+        """
+        with self.track():
+            response, used_model = await self.resilience.call_with_fallback(
+                model,
+                lambda candidate: self.send_text_request(prompt, candidate, stream=True, history=history),
+                hedge=CONFIG['HEDGE_REQUESTS']
+            )
+            try:
+                yield response, used_model
+            finally:
+                await response.aclose()
+
+    @staticmethod
+    async def iter_text_deltas(response):
+        """Разбирает SSE-поток и возвращает текстовые фрагменты ответа
+
+        Размышления из поля reasoning_content оборачиваются в <think>...</think>,
+        чтобы их можно было обработать так же, как в MessageProcessor.extract_thoughts.
+        """
+        thinking = False
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue
+            payload = line[5:].strip()
+            if payload == '[DONE]':
+                break
+            if not payload:
+                continue
+            
+            choices = json.loads(payload).get('choices') or []
+            if not choices:
+                continue
+            delta = choices[0].get('delta') or {}
+            
+            reasoning = delta.get('reasoning_content')
+            if reasoning:
+                if not thinking:
+                    thinking = True
+                    reasoning = '<think>' + reasoning
+                yield reasoning
+            
+            content = delta.get('content')
+            if content:
+                if thinking:
+                    thinking = False
+                    content = '</think>' + content
+                yield content
+        
+        if thinking:
+            yield '</think>'
+
+    async def send_image_request(self, prompt):
+        """Отправляет один запрос генерации изображения (без повторов)"""
+        payload = {
+            'model': CONFIG['IMAGE_MODEL'],
+            'prompt': prompt,
+            'size': CONFIG['IMAGE_SIZE'],
+            'quality': CONFIG['IMAGE_QUALITY'],
+            'n': 1
+        }
+        if self.images.url_mode:
+            payload['response_format'] = 'url'
+        key = self.keys.acquire()
+        response = await self.client.post(CONFIG['VOIDAI_IMAGE_URL'], headers=self.auth_headers(key), json=payload)
+        self.keys.observe(key, response)
+        return response
+
+    async def generate_image(self, prompt):
+        """Генерирует изображение через API (без хеджирования — это дорого)"""
+        with self.track():
+            return await self.resilience.call(
+                CONFIG['IMAGE_MODEL'], lambda model: self.send_image_request(prompt)
+            )
+
+
+class BrokerConnection:
+    """Соединение брокера: кадры из 4 байт длины и JSON (байты передаются в base64)"""
+
+    MAX_FRAME = 64 * 1024 * 1024
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def encode_value(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return {'__bytes__': base64.b64encode(value).decode('ascii')}
+        raise TypeError(f'{type(value).__name__} не сериализуется')
+
+    @staticmethod
+    def decode_value(obj):
+        if len(obj) == 1 and '__bytes__' in obj:
+            return base64.b64decode(obj['__bytes__'])
+        return obj
+
+    async def send(self, frame):
+        data = json.dumps(frame, default=self.encode_value, ensure_ascii=False).encode()
+        async with self.lock:
+            self.writer.write(len(data).to_bytes(4, 'big') + data)
+            await self.writer.drain()
+
+    async def receive(self):
+        size = int.from_bytes(await self.reader.readexactly(4), 'big')
+        if size > self.MAX_FRAME:
+            raise ValueError('frame too large')
+        return json.loads(await self.reader.readexactly(size), object_hook=self.decode_value)
+
+    def close(self):
+        self.writer.close()
+
+
+class LocalBroker:
+    """Брокер задач внутри процесса: воркеры берут задачи прямо из очередей (поведение по умолчанию)
+
+    Интерфейс брокера, общий с RemoteBroker:
+    - bot — Bot API для отправки результата в чат задачи;
+    - get(kind, ready) — следующая задача очереди 'text' или 'image',
+      для которой ready(job) истинно (удалённый брокер ready не учитывает);
+    - wakeup(kind) — готовность задач могла измениться (освободился слот модели);
+    - status_shown(job) — воркер отправил новое статусное сообщение задачи
+      (job.status_message_id), его правит /cancel;
+    - started(job) и finished(job, result, served) — начало и конец выполнения,
+      result — (текст, ошибка) или (SharedImage, ошибка), served=False — задача
+      снята без выполнения.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    @property
+    def bot(self):
+        return self.application.bot
+
+    @staticmethod
+    def channel(kind):
+        """Очередь и объединитель запросов для вида задач"""
+        if kind == 'text':
+            return text_queue, text_flights
+        return image_queue, image_flights
+
+    async def get(self, kind, ready=None):
+        queue, _ = self.channel(kind)
+        return await queue.get(ready)
+
+    def wakeup(self, kind):
+        queue, _ = self.channel(kind)
+        queue.wakeup()
+
+    def status_shown(self, job):
+        # Задача та же, что у процесса приёма, — номер сообщения уже в ней
+        pass
+
+    def started(self, job):
+        job_journal.started(job)
+
+    def finished(self, job, result, served=True):
+        queue, flights = self.channel(job.kind)
+        job_journal.finished(job)
+        job_registry.discard(job)
+        queue.task_done(job, measured=served and not job.cancelled)
+        tracer.finish(job.trace, Tracer.outcome(job, result))
+        if job.kind == 'text':
+            conversations.record(job.user_id, job.prompt, result[0])
+        # Результат получают и те, кто ждёт такой же запрос
+        if job.standalone:
+            flights.finish(ResponseCache.make_key(job.model, job.prompt), result)
+
+
+class BrokerServer:
+    """Сервер брокера в процессе приёма обновлений
+
+    Процессы-воркеры (локальные или на других хостах) подключаются по TCP,
+    берут задачи из общих честных очередей и отправляют ответы через Bot API
+    этого процесса — лимиты Telegram, журнал и объединение запросов остаются
+    общими. Задачи отключившегося воркера возвращаются в очередь.
+    """
+
+    BOT_METHODS = {'send_message', 'edit_message_text', 'send_photo', 'send_document'}
+    API_NAMES = {
+        'send_message': 'sendMessage',
+        'edit_message_text': 'editMessageText',
+        'send_photo': 'sendPhoto',
+        'send_document': 'sendDocument'
+    }
+
+    def __init__(self, application, host, port, secret):
+        self.local = LocalBroker(application)
+        self.host = host
+        self.port = port
+        self.secret = secret.encode()
+        self.server = None
+        self.connections = set()
+        self.next_ticket = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"📡 Брокер задач слушает {self.host}:{self.port}")
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            for connection in list(self.connections):
+                connection.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_connection(self, reader, writer):
+        """Обслуживает процесс-воркер до его отключения"""
+        connection = BrokerConnection(reader, writer)
+        try:
+            hello = await asyncio.wait_for(connection.receive(), 10)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            connection.close()
+            return
+        if hello.get('op') != 'hello' or not hmac.compare_digest(str(hello.get('secret', '')).encode(), self.secret):
+            print("Отклонено подключение к брокеру с неверным секретом")
+            connection.close()
+            return
+        
+        print(f"👷 Подключился воркер {hello.get('name', '?')}")
+        self.connections.add(connection)
+        tickets = {}
+        tasks = set()
+        try:
+            while True:
+                frame = await connection.receive()
+                task = asyncio.create_task(self.handle_frame(connection, frame, tickets))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections.discard(connection)
+            connection.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Незавершённые задачи воркера достанутся другим
+            for job in tickets.values():
+                job_registry.detach(job)
+                if job.cancelled:
+                    self.local.finished(job, (None, JobRegistry.follower_text()), served=False)
+                    continue
+                queue, _ = self.local.channel(job.kind)
+                queue.task_done(job, completed=False)
+                queue.put(job)
+            print(f"👷 Воркер {hello.get('name', '?')} отключился, возвращено задач: {len(tickets)}")
+
+    async def handle_frame(self, connection, frame, tickets):
+        """Выполняет запрос воркера; ответ получают только кадры с id"""
+        op = frame.get('op')
+        try:
+            if op == 'get':
+                queue, _ = self.local.channel(frame['kind'])
+                job = await queue.get()
+                self.next_ticket += 1
+                tickets[self.next_ticket] = job
+                job_registry.attach(job, lambda ticket=self.next_ticket: self.forward_cancel(connection, ticket))
+                result = {
+                    'ticket': self.next_ticket,
+                    'job': job.to_record(),
+                    'history': job.history,
+                    'status_message_id': job.status_message_id,
+                    'trace_id': job.trace.trace_id if job.trace is not None else None
+                }
+            elif op == 'started':
+                self.local.started(tickets[frame['ticket']])
+                return
+            elif op == 'status':
+                job = tickets.get(frame['ticket'])
+                if job is not None:
+                    job.status_message_id = frame['message_id']
+                return
+            elif op == 'finished':
+                job = tickets.pop(frame['ticket'])
+                job_registry.detach(job)
+                if job.trace is not None:
+                    job.trace.add('worker', job.dequeued_at, time.monotonic())
+                value, error_text = frame['result']
+                if job.kind == 'image' and value is not None:
+                    value = SharedImage(None, file_id=value)
+                self.local.finished(job, (value, error_text), frame.get('served', True))
+                return
+            elif op == 'call':
+                result = await self.call_bot(frame)
+            else:
+                raise ValueError(f'неизвестная операция {op}')
+            await connection.send({'id': frame['id'], 'result': result})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if 'id' in frame:
+                with contextlib.suppress(ConnectionError):
+                    await connection.send({'id': frame['id'], 'error': str(e), 'type': type(e).__name__})
+
+    def forward_cancel(self, connection, ticket):
+        """Передаёт отмену задачи воркеру, который её выполняет"""
+        async def send():
+            with contextlib.suppress(ConnectionError):
+                await connection.send({'op': 'cancel', 'ticket': ticket})
+        asyncio.create_task(send())
+
+    async def call_bot(self, frame):
+        """Выполняет вызов Bot API воркера через общий планировщик отправки"""
+        method, kwargs = frame['method'], frame['kwargs']
+        if method not in self.BOT_METHODS:
+            raise ValueError(f'метод {method} недоступен воркерам')
+        if kwargs.get('reply_markup') is not None:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], self.local.bot)
+        message = await send_scheduler.send(
+            kwargs['chat_id'], self.API_NAMES[method],
+            lambda: getattr(self.local.bot, method)(**kwargs),
+            status=frame.get('status', False),
+            merge_key=frame.get('merge_key')
+        )
+        if not hasattr(message, 'message_id'):
+            return None
+        photo = message.photo[-1].file_id if getattr(message, 'photo', None) else None
+        return {'message_id': message.message_id, 'photo': photo}
+
+
+class RemoteMessage:
+    """Сообщение, отправленное процессом приёма по просьбе воркера (id и file_id фото)"""
+
+    __slots__ = ('message_id', 'photo')
+
+    def __init__(self, message_id, photo=None):
+        self.message_id = message_id
+        self.photo = [SimpleNamespace(file_id=photo)] if photo else []
+
+
+class RemoteBot:
+    """Bot API в процессе-воркере: вызовы выполняет процесс приёма"""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    async def call(self, method, **kwargs):
+        status, merge_key = outbound_send.get()
+        if kwargs.get('reply_markup') is not None:
+            kwargs['reply_markup'] = kwargs['reply_markup'].to_dict()
+        result = await self.broker.request({
+            'op': 'call', 'method': method, 'kwargs': kwargs,
+            'status': status, 'merge_key': merge_key
+        })
+        return RemoteMessage(**result) if result else result
+
+    async def send_message(self, **kwargs):
+        return await self.call('send_message', **kwargs)
+
+    async def edit_message_text(self, **kwargs):
+        return await self.call('edit_message_text', **kwargs)
+
+    async def send_photo(self, **kwargs):
+        return await self.call('send_photo', **kwargs)
+
+    async def send_document(self, **kwargs):
+        return await self.call('send_document', **kwargs)
+
+
+class RemoteBroker:
+    """Брокер на стороне процесса-воркера: задачи и вызовы Bot API идут по TCP к процессу приёма"""
 
-class APIHandler:
-    """Класс для работы с API"""
-    
-    def __init__(self):
-        self.client = httpx.AsyncClient(timeout=CONFIG['REQUEST_TIMEOUT'])
+    def __init__(self, host, port, secret):
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.bot = RemoteBot(self)
+        self.connection = None
+        self.reader_task = None
+        self.pending = {}
+        self.next_id = 0
+        self.tickets = {}
+        self.notifications = set()
+        self.disconnected = asyncio.Event()
+
+    async def connect(self, attempts=30):
+        """Подключается к процессу приёма, дожидаясь его запуска"""
+        for attempt in range(attempts):
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                break
+            except OSError:
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(1)
+        self.connection = BrokerConnection(reader, writer)
+        await self.connection.send({'op': 'hello', 'secret': self.secret, 'name': f'pid {os.getpid()}'})
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        """Разбирает ответы процесса приёма по id запросов"""
+        try:
+            while True:
+                frame = await self.connection.receive()
+                if frame.get('op') == 'cancel':
+                    self.cancel(frame['ticket'])
+                    continue
+                future = self.pending.pop(frame['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in frame:
+                    error = BadRequest if frame['type'] == 'BadRequest' else TelegramError
+                    future.set_exception(error(frame['error']))
+                else:
+                    future.set_result(frame['result'])
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('соединение с брокером потеряно'))
+            self.pending.clear()
+            self.disconnected.set()
+
+    async def request(self, frame):
+        self.next_id += 1
+        frame['id'] = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        await self.connection.send(frame)
+        return await future
+
+    def notify(self, frame):
+        """Отправляет уведомление без ожидания ответа"""
+        async def send():
+            with contextlib.suppress(ConnectionError):
+                await self.connection.send(frame)
+        task = asyncio.create_task(send())
+        self.notifications.add(task)
+        task.add_done_callback(self.notifications.discard)
+
+    async def get(self, kind, ready=None):
+        # Лимиты моделей у воркера свои, поэтому процесс приёма выдаёт задачи без проверки слота
+        reply = await self.request({'op': 'get', 'kind': kind})
+        job = Job.from_record(reply['job'])
+        job.history = reply['history']
+        job.status_message_id = reply['status_message_id']
+        # Та же трасса, что и в процессе приёма: этапы воркера попадают в его буфер и файл OTLP
+        job.trace = tracer.start(kind, reply.get('trace_id'), model=job.model, user_id=job.user_id, role='worker')
+        self.tickets[job] = reply['ticket']
+        return job
+
+    def wakeup(self, kind):
+        pass
+
+    def cancel(self, ticket):
+        """Отмена от процесса приёма: задача не начнётся, а выполняющаяся прервётся"""
+        for job, job_ticket in self.tickets.items():
+            if job_ticket == ticket:
+                job.cancelled = True
+                job_registry.abort(job.job_id)
+                return
+
+    def status_shown(self, job):
+        self.notify({'op': 'status', 'ticket': self.tickets[job], 'message_id': job.status_message_id})
+
+    def started(self, job):
+        self.notify({'op': 'started', 'ticket': self.tickets[job]})
+
+    def finished(self, job, result, served=True):
+        value, error_text = result
+        if job.kind == 'image' and value is not None:
+            value = value.file_id
+        self.notify({
+            'op': 'finished', 'ticket': self.tickets.pop(job), 'result': [value, error_text], 'served': served
+        })
+        tracer.finish(job.trace, Tracer.outcome(job, result))
 
     async def close(self):
-        """Закрывает HTTP-клиент"""
-        await self.client.aclose()
+        if self.notifications:
+            await asyncio.gather(*self.notifications, return_exceptions=True)
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.reader_task
+        if self.connection is not None:
+            self.connection.close()
 
-    async def generate_text(self, prompt, model):
-        """Генерирует текст через API"""
-        response = await self.client.post(
-            CONFIG['VOIDAI_TEXT_URL'],
-            headers={
-                'Authorization': f'Bearer {CONFIG["VOIDAI_API_KEY"]}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'model': model,
-                'messages': [{'role': 'user', 'content': prompt}]
-            }
-        )
-        return response
 
-    async def generate_image(self, prompt):
-        """Генерирует изображение через API"""
-        response = await self.client.post(
-            CONFIG['VOIDAI_IMAGE_URL'],
-            headers={
-                'Authorization': f'Bearer {CONFIG["VOIDAI_API_KEY"]}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'model': 'gpt-image-1',
-                'prompt': prompt,
-                'size': '1024x1024',
-                'quality': 'standard',
-                'n': 1
-            }
+class WorkerProcesses:
+    """Локальные процессы-воркеры для роли ingest: запускает и перезапускает их при падении"""
+
+    def __init__(self, count, secret):
+        self.count = count
+        self.secret = secret
+        self.processes = set()
+        self.tasks = []
+        self.stopping = False
+
+    def start(self):
+        for index in range(self.count):
+            self.tasks.append(asyncio.create_task(self.supervise(index)))
+
+    async def supervise(self, index):
+        host = CONFIG['BROKER_HOST']
+        env = dict(
+            os.environ, BOT_ROLE='worker', BROKER_SECRET=self.secret,
+            BROKER_HOST='127.0.0.1' if host in ('0.0.0.0', '') else host,
+            BROKER_PORT=str(CONFIG['BROKER_PORT'])
         )
-        return response
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self.processes.add(process)
+            code = await process.wait()
+            self.processes.discard(process)
+            if not self.stopping:
+                print(f"⚠️ Воркер {index} завершился с кодом {code}, перезапуск")
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        self.stopping = True
+        for process in list(self.processes):
+            with contextlib.suppress(ProcessLookupError):
+                process.terminate()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
 
 class BotHandlers:
     """Класс с обработчиками бота"""
     
-    def __init__(self, api_handler):
+    # Неизменные тексты и клавиатуры собираются один раз при загрузке модуля
+    RULES_TEXT = """📋 <b>Правила использования бота:</b>
+Т.к. запросы бота обрабатывает сервер, использущий API поставщиков нейросетей <i>(Void AI)</i>,
+все запросы пользователей - общие для тарифов <b>Void AI</b>, по этому при нарушении общих правил
+пользователями окажется под угрозой вся инфраструктура <b>C0D1X AI</b>. Тем не менее, мы уважаем
+анонимность пользователей и не храним <b>НИКАКИХ</b> данных, звязанных с пользователями,
+тем более истории сообщений, их данные и т.д. 
+Надеемся на совесть пользователей и выполнение ими правил.
+<i>Генерируя люой контент, вы автоматически соглашаетесь с правилами использования бота.</i>
+
+Что ЗАПРЕЩЕНО делать:
+- Генерировать любой контент, связанный с нецензурной лексикой, призывами к насилию, пропагандой
+ультраправых организаций и т.д.
+- Генерировать любой контент, связанный с предпренимательской деятельностью и рекламой."""
+    RULES_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Понятно", callback_data="close_rules")]])
+    START_KEYBOARD = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📋 Правила", callback_data="show_rules"), 
+         InlineKeyboardButton("👤 Автор", callback_data="show_author")],
+        [InlineKeyboardButton("✅ Понятно", callback_data="close_start")]
+    ])
+    AUTHOR_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("👤 Перейти к автору", url="https://t.me/C0DIX_X")]])
+    COMMANDS_HELP = ("Доступные команды:\n"
+                     "• <code>/start</code> - справка и приветствие\n"
+                     "• <code>/text [запрос]</code> - генерация текста\n"
+                     "• <code>/image [описание]</code> - генерация изображения\n"
+                     "• <code>/model</code> - выбор модели\n"
+                     "• <code>/cancel</code> - отменить свои запросы\n"
+                     "• <code>/reset</code> - очистить историю диалога\n"
+                     "• <code>/status</code> - статус бота\n"
+                     "• <code>/queue</code> - статус очередей\n"
+                     "• <code>/rules</code> - правила использования")
+    NOT_A_COMMAND_HELP = ("ℹ️ Это не команда! Все команды должны начинаться с <code>/</code>\n\n"
+                          "Используйте:\n"
+                          "• <code>/text [запрос]</code> - для генерации текста\n"
+                          "• <code>/image [описание]</code> - для генерации изображения\n"
+                          "• <code>/start</code> - для справки")
+    
+    def __init__(self, api_handler, broker):
         self.api_handler = api_handler
+        # Задачи не хранят контекст обновления: для отправки из воркера
+        # достаточно брокера, у него есть .bot (в процессе-воркере — прокси)
+        self.broker = broker
         self.processor = MessageProcessor()
 
-    async def send_safe_message(self, context, chat_id, text, parse_mode='HTML', reply_markup=None):
-        """Безопасно отправляет сообщение с обработкой ошибок"""
+    async def send_safe_message(self, context, chat_id, text, parse_mode='HTML', reply_markup=None, status=False):
+        """Безопасно отправляет сообщение через планировщик отправки
+
+        status=True — статусное сообщение: под нагрузкой оно может быть
+        отброшено, тогда возвращается None.
+        """
         try:
-            await context.bot.send_message(
-                chat_id=chat_id, 
-                text=text, 
-                parse_mode=parse_mode,
-                reply_markup=reply_markup
+            return await send_scheduler.send(
+                chat_id, 'sendMessage',
+                lambda: context.bot.send_message(
+                    chat_id=chat_id, 
+                    text=text, 
+                    parse_mode=parse_mode,
+                    reply_markup=reply_markup
+                ),
+                status=status
             )
-        except Exception as e:
-            print(f"Ошибка отправки сообщения: {e}")
-            # Отправляем без HTML разметки
-            plain_text = text.replace('<i>', '').replace('</i>', '').replace('<code>', '').replace('</code>', '')
+        except BadRequest as e:
+            # Повторяем без разметки только при ошибке разбора HTML, а не при любой ошибке
+            if 'parse' not in str(e).lower():
+                raise
+            print(f"Ошибка разметки сообщения: {e}")
+            plain_text = self.processor.strip_html(text)
             parts = self.processor.split_text(plain_text, CONFIG['MAX_MESSAGE_LENGTH'])
+            message = None
             for part in parts:
-                await context.bot.send_message(chat_id=chat_id, text=part)
+                message = await send_scheduler.send(
+                    chat_id, 'sendMessage',
+                    lambda part=part: context.bot.send_message(chat_id=chat_id, text=part)
+                )
+            return message
 
     async def send_chunked_messages(self, context, chat_id, messages):
         """Отправляет разбитые на части сообщения"""
         for message in messages:
             await self.send_safe_message(context, chat_id, message)
 
-    async def process_text_queue(self):
-        """Обрабатывает очередь текстовых запросов"""
-        while True:
+    async def show_status(self, context, job, text, cancellable=True, final=False):
+        """Статус генерации: правит сообщение о месте в очереди или отправляет новое
+
+        final=True — завершающий статус (отмена, устаревание): планировщик его
+        не отбрасывает, иначе в чате осталось бы «в очереди» с кнопкой отмены.
+        """
+        reply_markup = cancel_keyboard(job) if cancellable else None
+        status = not final
+        if job.status_message_id is not None:
+            message_id = job.status_message_id
             try:
-                chat_id, prompt, model, context = await text_queue.get()
-                
-                await self.send_safe_message(
-                    context, chat_id, 
-                    f"🔄 Генерирую текст с помощью \n{MODELS.get(model, model)}..."
+                await send_scheduler.send(
+                    job.chat_id, 'editMessageText',
+                    lambda: context.bot.edit_message_text(
+                        chat_id=job.chat_id, message_id=message_id, text=text, reply_markup=reply_markup
+                    ),
+                    status=status, merge_key=message_id
                 )
-                
-                response = await self.api_handler.generate_text(prompt, model)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    text = data['choices'][0]['message']['content']
-                    thoughts, content = self.processor.extract_thoughts(text)
-                    messages = self.processor.format_ai_response(thoughts, content)
-                    await self.send_chunked_messages(context, chat_id, messages)
-                else:
-                    await self.send_safe_message(
-                        context, chat_id,
-                        f"❌ Ошибка: {response.status_code} - {response.text}"
-                    )
-                
-                text_queue.task_done()
-                
-            except Exception as e:
-                print(f"Ошибка обработки текста: {e}")
-                try:
-                    await self.send_safe_message(context, chat_id, f"❌ Ошибка: {str(e)}")
-                except:
-                    pass
-                text_queue.task_done()
+                return SimpleNamespace(message_id=message_id)
+            except TelegramError as e:
+                # Сообщение удалили или оно недоступно — начинаем со свежего
+                print(f"Не удалось обновить статус: {e}")
+        message = await self.send_safe_message(context, job.chat_id, text, reply_markup=reply_markup, status=status)
+        if message is not None:
+            # Это сообщение правит и /cancel, в том числе в процессе приёма
+            job.status_message_id = message.message_id
+            self.broker.status_shown(job)
+        return message
+
+    async def reply_text(self, update, text, **kwargs):
+        """Отвечает на сообщение пользователя через планировщик отправки"""
+        return await send_scheduler.send(
+            update.effective_chat.id, 'sendMessage',
+            lambda: update.message.reply_text(text, **kwargs)
+        )
+
+    async def edit_query_message(self, query, text, **kwargs):
+        """Редактирует сообщение с кнопками через планировщик отправки"""
+        return await send_scheduler.send(
+            query.message.chat_id, 'editMessageText',
+            lambda: query.edit_message_text(text, **kwargs)
+        )
+
+    def start_workers(self):
+        """Запускает пулы воркеров: CONFIG['TEXT_WORKERS'] текстовых и CONFIG['IMAGE_WORKERS'] для изображений"""
+        workers = [asyncio.create_task(self.process_text_queue()) for _ in range(CONFIG['TEXT_WORKERS'])]
+        workers += [asyncio.create_task(self.process_image_queue()) for _ in range(CONFIG['IMAGE_WORKERS'])]
+        return workers
+
+    async def process_text_queue(self):
+        """Воркер текстовой очереди"""
+        await self.consume_queue('text', self.handle_text_job)
 
     async def process_image_queue(self):
-        """Обрабатывает очередь запросов изображений"""
+        """Воркер очереди изображений"""
+        await self.consume_queue('image', self.handle_image_job)
+
+    async def consume_queue(self, kind, handler):
+        """Забирает задачи у брокера с учётом лимита параллельности модели
+
+        Очередь выдаёт только задачи, у модели которых есть свободный слот:
+        остальные ждут в ней же — по кругу между пользователями и в пределах
+        её размера, — а воркер тем временем берёт задачи быстрых моделей.
+        """
         while True:
+            job = await self.broker.get(kind, self.job_ready)
+            if await self.drop_dead_job(job):
+                continue
+            if job.model == 'auto':
+                # Выбираем модель перед выполнением, по самой свежей статистике
+                job.routed_model = self.api_handler.router.choose()
+            limiter = model_limits.get(job.upstream_model)
+            if not limiter.try_acquire():
+                # Выбранная для "auto" модель занята или задачу выдал удалённый брокер
+                waited = time.monotonic()
+                await limiter.acquire()
+                if job.trace is not None:
+                    job.trace.add('model.slot', waited, time.monotonic(), model=job.upstream_model)
+                if await self.drop_dead_job(job):
+                    limiter.release()
+                    self.broker.wakeup(kind)
+                    continue
+            
+            metrics.queue_wait.observe(time.monotonic() - job.enqueued_at, queue=job.kind)
+            metrics.jobs_in_flight.inc(queue=job.kind)
+            self.broker.started(job)
+            result = (None, "❌ Ошибка: запрос не выполнен")
+            try:
+                result = await self.run_cancellable(job, handler(job, limiter))
+            finally:
+                self.broker.finished(job, result)
+                limiter.release()
+                self.broker.wakeup(kind)
+                metrics.jobs_in_flight.dec(queue=job.kind)
+                metrics.job_duration.observe(time.monotonic() - job.enqueued_at, queue=job.kind)
+
+    @staticmethod
+    def job_ready(job):
+        """Можно ли выдать задачу воркеру: у модели есть слот (снятые задачи выдаются сразу)"""
+        if job.model == 'auto' or job.cancelled or job.expired():
+            return True
+        return model_limits.get(job.model).available()
+
+    async def run_cancellable(self, job, coro):
+        """Выполняет обработчик отдельной задачей, чтобы отмена пользователя прервала его, но не воркер"""
+        with tracer.use(job.trace):
+            task = asyncio.ensure_future(coro)
+        job_registry.attach(job, task.cancel)
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            job_registry.detach(job)
+        if task.cancelled():
+            metrics.jobs_dropped.inc(queue=job.kind, reason='cancelled')
+            return None, JobRegistry.follower_text()
+        return task.result()
+
+    async def drop_dead_job(self, job):
+        """Завершает отменённую или устаревшую задачу, не обращаясь к Void AI; True, если она снята"""
+        if job.cancelled:
+            reason, error_text = 'cancelled', JobRegistry.follower_text()
+        elif job.expired():
+            reason = 'expired'
+            error_text = "⌛ Запрос слишком долго ждал в очереди и отменён. Отправьте его ещё раз."
+            try:
+                await self.show_status(self.broker, job, error_text, cancellable=False, final=True)
+            except Exception as e:
+                print(f"Не удалось сообщить об устаревшем запросе: {e}")
+        else:
+            return False
+        metrics.jobs_dropped.inc(queue=job.kind, reason=reason)
+        self.broker.finished(job, (None, error_text), served=False)
+        return True
+
+    async def handle_text_job(self, job, limiter):
+        """Обрабатывает один текстовый запрос; возвращает (текст, текст ошибки) для объединённых запросов"""
+        chat_id, prompt, model, context = job.chat_id, job.prompt, job.model, self.broker
+        text, error_text = None, None
+        try:
+            # Пока задача ждала в очереди, такой же ответ мог попасть в кэш
+            if job.standalone:
+                text = await self.send_cached_text(context, chat_id, prompt, model)
+            if text is None:
+                text, error_text = await self.generate_text_reply(context, job, limiter)
+            
+        except Exception as e:
+            print(f"Ошибка обработки текста: {e}")
+            error_text = f"❌ Ошибка: {str(e)}"
+            try:
+                await self.send_safe_message(context, chat_id, error_text)
+            except:
+                pass
+        return text, error_text
+
+    async def generate_text_reply(self, context, job, limiter):
+        """Запрашивает ответ у модели и отправляет его; возвращает (текст, текст ошибки)"""
+        chat_id, prompt, model, history = job.chat_id, job.prompt, job.upstream_model, job.history
+        status_message = await self.show_status(
+            context, job, f"🔄 Генерирую текст с помощью \n{MODELS.get(model, model)}..."
+        )
+        
+        started = time.monotonic()
+        try:
+            if CONFIG['STREAM_TEXT']:
+                response, used_model, text = await self.stream_text_reply(
+                    context, chat_id, prompt, model, status_message, history, cancel_keyboard(job)
+                )
+            else:
+                response, used_model = await self.api_handler.generate_text(prompt, model, history)
+                text = None
+        except ModelUnavailableError:
+            error_text = "⚠️ Модель и её замены сейчас недоступны. Попробуйте позже или выберите другую модель в /model."
+            await self.send_safe_message(context, chat_id, error_text)
+            return None, error_text
+        except httpx.TransportError:
+            limiter.observe(time.monotonic() - started)
+            raise
+        limiter.observe(time.monotonic() - started, response.status_code)
+        
+        if response.status_code != 200:
+            error_text = self.describe_api_error(response)
+            await self.send_safe_message(context, chat_id, error_text)
+            return None, error_text
+        
+        if not CONFIG['STREAM_TEXT']:
+            await self.notify_fallback(context, chat_id, model, used_model)
+            with tracer.span('json.parse'):
+                data = response.json()
+            text = data['choices'][0]['message']['content']
+            await self.send_text_answer(context, chat_id, text)
+        # Ответ замещающей модели кэшируем под её собственным именем;
+        # ответ с учётом истории диалога годится только этому пользователю
+        if not history:
+            await response_cache.set(used_model, prompt, text)
+            if job.model == 'auto':
+                await response_cache.set('auto', prompt, text)
+        return text, None
+
+    @staticmethod
+    def describe_api_error(response):
+        """Понятное пользователю описание ошибки Void AI (сырой ответ — только в лог)"""
+        print(f"Ошибка Void AI: {response.status_code} - {response.text[:500]}")
+        status_code = response.status_code
+        if status_code == 429:
+            return "⏳ Void AI сейчас перегружен запросами. Попробуйте чуть позже."
+        if status_code >= 500:
+            return "⚠️ Модель временно недоступна. Попробуйте позже или выберите другую модель в /model."
+        if status_code in (401, 403):
+            return "❌ Ошибка доступа к Void AI. Пожалуйста, сообщите автору бота."
+        if status_code == 400:
+            return "❌ Модель отклонила запрос. Попробуйте переформулировать его."
+        return f"❌ Ошибка: {status_code}"
+
+    async def notify_fallback(self, context, chat_id, model, used_model):
+        """Сообщает, что ответ дала модель из цепочки замен"""
+        if used_model != model:
+            await self.send_safe_message(
+                context, chat_id,
+                f"ℹ️ {MODELS.get(model, model)} временно недоступна, отвечает {MODELS.get(used_model, used_model)}"
+            )
+
+    async def stream_text_reply(self, context, chat_id, prompt, model, status_message, history=None,
+                                reply_markup=None):
+        """Генерирует ответ потоково, редактируя статусное сообщение по мере получения текста
+
+        reply_markup (кнопка отмены) остаётся под ответом, пока он пишется.
+        """
+        async with self.api_handler.stream_text(prompt, model, history) as (response, used_model):
+            if response.status_code != 200:
+                await response.aread()
+                return response, used_model, None
+            
+            await self.notify_fallback(context, chat_id, model, used_model)
+            reply = StreamingReply(context.bot, chat_id, status_message, reply_markup)
+            with tracer.span('voidai.stream', model=used_model) as span:
+                async for piece in self.api_handler.iter_text_deltas(response):
+                    reply.feed(piece)
+                    await reply.flush()
+                span['chars'] = len(reply.text)
+            await reply.flush(final=True)
+            return response, used_model, reply.text
+
+    async def send_text_answer(self, context, chat_id, text):
+        """Форматирует и отправляет готовый ответ модели"""
+        with tracer.span('format', chars=len(text)):
+            thoughts, content = self.processor.extract_thoughts(text)
+            as_document = self.processor.is_long_answer(thoughts, content)
+            if as_document:
+                # Длинный ответ — превью и файл вместо десятков сообщений
+                messages = [self.processor.format_preview(thoughts, content)]
+            else:
+                messages = self.processor.format_ai_response(thoughts, content)
+        with tracer.span('send_chunked_messages', messages=len(messages)):
+            await self.send_chunked_messages(context, chat_id, messages)
+        if as_document:
+            await send_answer_document(context.bot, chat_id, thoughts, content)
+
+    async def send_cached_text(self, context, chat_id, prompt, model):
+        """Отправляет ответ из кэша, если он есть; возвращает его текст или None"""
+        with tracer.span('cache.lookup') as span:
+            text = await response_cache.get(model, prompt)
+            span['hit'] = text is not None
+        if text is not None:
+            await self.send_text_answer(context, chat_id, text)
+        return text
+
+    async def deliver_coalesced_text(self, context, chat_id, user_id, prompt, model, flight):
+        """Дожидается результата такого же запроса другого пользователя и отправляет его"""
+        try:
+            await self.send_safe_message(
+                context, chat_id,
+                f"🔄 Генерирую текст с помощью \n{MODELS.get(model, model)}...",
+                status=True
+            )
+            text, error_text = await asyncio.shield(flight)
+            if text is not None:
+                conversations.record(user_id, prompt, text)
+                await self.send_text_answer(context, chat_id, text)
+            else:
+                await self.send_safe_message(context, chat_id, error_text or "❌ Ошибка: запрос не выполнен")
+        except Exception as e:
+            print(f"Ошибка доставки объединённого ответа: {e}")
+        finally:
+            # Трасса унаследована от обработчика команды при создании задачи
+            tracer.finish(current_trace.get(), 'coalesced')
+
+    async def handle_image_job(self, job, limiter):
+        """Обрабатывает один запрос на генерацию изображения; возвращает (SharedImage, текст ошибки)"""
+        chat_id, prompt, context = job.chat_id, job.prompt, self.broker
+        image, error_text = None, None
+        try:
+            # Пока задача ждала в очереди, такое же изображение могло попасть в кэш
+            image = await self.send_cached_image(context, chat_id, prompt)
+            if image is not None:
+                return image, None
+            
+            await self.show_status(context, job, "🎨 Генерирую изображение...")
+            
+            started = time.monotonic()
             try:
-                chat_id, prompt, context = await image_queue.get()
-                
-                await self.send_safe_message(context, chat_id, "🎨 Генерирую изображение...")
-                
                 response = await self.api_handler.generate_image(prompt)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get('data') and data['data'][0].get('b64_json'):
-                        b64_image = data['data'][0]['b64_json']
-                        image_bytes = base64.b64decode(b64_image)
-                        await context.bot.send_photo(
-                            chat_id=chat_id,
-                            photo=image_bytes,
-                            caption=f"✅ Изображение по запросу: <b>{self.processor.escape_html(prompt)}</b>",
-                            parse_mode='HTML'
-                        )
-                    else:
-                        await self.send_safe_message(
-                            context, chat_id,
-                            "❌ Не удалось получить изображение из ответа API"
-                        )
+            except ModelUnavailableError:
+                error_text = "⚠️ Генерация изображений временно недоступна. Попробуйте позже."
+                await self.send_safe_message(context, chat_id, error_text)
+                return None, error_text
+            except httpx.TransportError:
+                limiter.observe(time.monotonic() - started)
+                raise
+            limiter.observe(time.monotonic() - started, response.status_code)
+            
+            if response.status_code == 200:
+                # Готовим один раз вне цикла событий — фото общее для всех ожидающих чатов
+                with tracer.span('image.prepare'):
+                    photo = await self.api_handler.images.prepare(response)
+                if photo is not None:
+                    image = SharedImage(photo)
+                    try:
+                        await self.send_image_answer(context, chat_id, prompt, image)
+                    except BadRequest:
+                        if not isinstance(photo, str):
+                            raise
+                        # Telegram не смог скачать изображение по ссылке — загружаем его сами
+                        with tracer.span('image.download'):
+                            image = SharedImage(await self.api_handler.images.download(photo))
+                        await self.send_image_answer(context, chat_id, prompt, image)
+                    if image.file_id:
+                        await image_cache.set(self.image_variant(), prompt, image.file_id)
                 else:
-                    await self.send_safe_message(
-                        context, chat_id,
-                        f"❌ Ошибка: {response.status_code} - {response.text}"
-                    )
-                
-                image_queue.task_done()
-                
-            except Exception as e:
-                print(f"Ошибка обработки изображения: {e}")
-                try:
-                    await self.send_safe_message(context, chat_id, f"❌ Ошибка: {str(e)}")
-                except:
-                    pass
-                image_queue.task_done()
+                    error_text = "❌ Не удалось получить изображение из ответа API"
+                    await self.send_safe_message(context, chat_id, error_text)
+            else:
+                error_text = self.describe_api_error(response)
+                await self.send_safe_message(context, chat_id, error_text)
+            
+        except Exception as e:
+            print(f"Ошибка обработки изображения: {e}")
+            error_text = f"❌ Ошибка: {str(e)}"
+            try:
+                await self.send_safe_message(context, chat_id, error_text)
+            except:
+                pass
+        return image, error_text
+
+    async def send_image_answer(self, context, chat_id, prompt, image):
+        """Отправляет сгенерированное изображение"""
+        await image.send(
+            context.bot, chat_id,
+            f"✅ Изображение по запросу: <b>{self.processor.escape_html(prompt)}</b>"
+        )
+
+    @staticmethod
+    def image_variant():
+        """Параметры генерации, от которых зависит изображение (часть ключа кэша)"""
+        return f"{CONFIG['IMAGE_MODEL']}:{CONFIG['IMAGE_SIZE']}:{CONFIG['IMAGE_QUALITY']}"
+
+    async def send_cached_image(self, context, chat_id, prompt):
+        """Отправляет изображение из кэша по file_id; возвращает SharedImage или None"""
+        with tracer.span('cache.lookup') as span:
+            file_id = await image_cache.get(self.image_variant(), prompt)
+            span['hit'] = file_id is not None
+        if file_id is None:
+            return None
+        image = SharedImage(None, file_id=file_id)
+        try:
+            await self.send_image_answer(context, chat_id, prompt, image)
+        except Exception as e:
+            print(f"Не удалось отправить изображение из кэша: {e}")
+            await image_cache.discard(self.image_variant(), prompt)
+            return None
+        return image
+
+    async def deliver_coalesced_image(self, context, chat_id, prompt, flight):
+        """Дожидается изображения по такому же запросу другого пользователя и отправляет его"""
+        try:
+            await self.send_safe_message(context, chat_id, "🎨 Генерирую изображение...", status=True)
+            image, error_text = await asyncio.shield(flight)
+            if image is not None:
+                await self.send_image_answer(context, chat_id, prompt, image)
+            else:
+                await self.send_safe_message(context, chat_id, error_text or "❌ Ошибка: запрос не выполнен")
+        except Exception as e:
+            print(f"Ошибка доставки объединённого изображения: {e}")
+        finally:
+            tracer.finish(current_trace.get(), 'coalesced')
+
+    async def replay_journal(self):
+        """Ставит в очереди задачи из журнала, оставшиеся после перезапуска или падения"""
+        jobs = await asyncio.to_thread(job_journal.open)
+        replayed = 0
+        for job in jobs:
+            if job.attempts >= CONFIG['JOURNAL_MAX_ATTEMPTS']:
+                # Задача уже несколько раз прерывалась вместе с ботом — не повторяем её
+                print(f"Задача {job.job_id} пропущена после {job.attempts} попыток")
+                job_journal.finished(job)
+                continue
+            if job.kind == 'text':
+                queue, flights, model = text_queue, text_flights, job.model
+            else:
+                queue, flights, model = image_queue, image_flights, CONFIG['IMAGE_MODEL']
+            queue.put(job)
+            job_registry.add(job)
+            flight_key = ResponseCache.make_key(model, job.prompt)
+            if flight_key not in flights.flights:
+                flights.lead(flight_key)
+            replayed += 1
+        if replayed:
+            print(f"♻️ Из журнала восстановлено задач: {replayed}")
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
@@ -386,16 +4361,9 @@ class BotHandlers:
 ⏱ <b>Аптайм:</b> {hours}ч {minutes}м {seconds}с
 📊 <b>Очереди:</b> Текст: {text_queue.qsize()}, Изображения: {image_queue.qsize()}"""
         
-        keyboard = [
-            [InlineKeyboardButton("📋 Правила", callback_data="show_rules"), 
-             InlineKeyboardButton("👤 Автор", callback_data="show_author")],
-            [InlineKeyboardButton("✅ Понятно", callback_data="close_start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await self.send_safe_message(
             context, update.effective_chat.id, welcome_text, 
-            reply_markup=reply_markup
+            reply_markup=self.START_KEYBOARD
         )
 
     async def status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -412,38 +4380,89 @@ class BotHandlers:
 📅 <b>Запущен:</b> {bot_start_time.strftime('%d.%m.%Y %H:%M:%S')}
 
 📊 <b>Очереди:</b>
-📝 Текстовые запросы: {text_queue.qsize()}
-🎨 Генерация изображений: {image_queue.qsize()}
+📝 Текстовые запросы: {self.format_queue(text_queue)}
+🎨 Генерация изображений: {self.format_queue(image_queue)}
+
+💾 <b>Кэш ответов:</b>
+{self.format_cache_stats(response_cache)}
+🖼 <b>Кэш изображений:</b>
+{self.format_cache_stats(image_cache)}
+🔗 <b>Объединено одинаковых запросов:</b> {text_flights.coalesced + image_flights.coalesced}
+
+⚙️ <b>Параллельность моделей:</b>
+{self.format_model_limits()}
+
+🌐 <b>Пул соединений Void AI:</b>
+{self.format_pool_stats()}
+
+🛡 <b>Устойчивость:</b>
+{self.format_resilience_stats()}
 
 🛠 <b>Система:</b>
 ✅ Keep-alive сервер: Активен
 ✅ Самопинг: Активен (каждые 5 мин)
 ✅ Анти-слип: Включен
+📤 Отправка: {self.format_send_stats()}
+💬 Диалоги: {self.format_conversation_stats()}
         """
         await self.send_safe_message(context, update.effective_chat.id, status_text)
 
+    def format_conversation_stats(self):
+        """Форматирует состояние хранилища историй диалогов"""
+        if not conversations.enabled:
+            return "Выключены"
+        stats = conversations.stats()
+        return (f"Пользователей: {stats['users']}, токенов в истории: {stats['tokens']}, "
+                f"вытеснено: {stats['evicted']}")
+
+    def format_cache_stats(self, cache):
+        """Форматирует счётчики кэша"""
+        stats = cache.stats()
+        return (f"Записей: {stats['entries']}, попаданий: {stats['hits'] + stats['disk_hits']} "
+                f"(с диска: {stats['disk_hits']}), промахов: {stats['misses']} "
+                f"({stats['hit_rate']:.0%})")
+
+    def format_pool_stats(self):
+        """Форматирует статистику пула HTTP-соединений"""
+        stats = self.api_handler.pool_stats()
+        text = (f"Запросов в работе: {stats['in_flight']}/{stats['max_connections']} "
+                f"(пик: {stats['peak_in_flight']}), HTTP/2: {'да' if stats['http2'] else 'нет'}")
+        if stats['connections'] is not None:
+            text += f"\nСоединений: {stats['connections']} (свободных: {stats['idle_connections']})"
+        return text
+
+    def format_resilience_stats(self):
+        """Форматирует счётчики повторов, хеджирования и замен моделей"""
+        stats = self.api_handler.resilience.stats()
+        text = (f"Повторов: {stats['retries']}, хеджирований: {stats['hedges']}, "
+                f"замен модели: {stats['fallbacks']}")
+        if stats['open_breakers']:
+            text += f"\nНедоступны: {', '.join(stats['open_breakers'])}"
+        return text
+
+    def format_send_stats(self):
+        """Форматирует счётчики планировщика исходящих сообщений"""
+        stats = send_scheduler.stats()
+        return (f"в очереди {stats['queued']}, отправлено {stats['sent']}, "
+                f"статусов отброшено {stats['dropped']}, правок слито {stats['merged']}, "
+                f"ожиданий RetryAfter {stats['flood_waits']}")
+
+    def format_model_limits(self):
+        """Форматирует текущие лимиты параллельности по моделям"""
+        snapshot = model_limits.snapshot()
+        if not snapshot:
+            return "Запросов пока не было"
+        return "\n".join(
+            f"• {model}: {in_flight}/{limit}" + (f" (ожидают: {waiting})" if waiting else "")
+            for model, (in_flight, limit, waiting) in snapshot.items()
+        )
+
     async def rules(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /rules"""
-        rules_text = """📋 <b>Правила использования бота:</b>
-Т.к. запросы бота обрабатывает сервер, использущий API поставщиков нейросетей <i>(Void AI)</i>,
-все запросы пользователей - общие для тарифов <b>Void AI</b>, по этому при нарушении общих правил
-пользователями окажется под угрозой вся инфраструктура <b>C0D1X AI</b>. Тем не менее, мы уважаем
-анонимность пользователей и не храним <b>НИКАКИХ</b> данных, звязанных с пользователями,
-тем более истории сообщений, их данные и т.д. 
-Надеемся на совесть пользователей и выполнение ими правил.
-<i>Генерируя люой контент, вы автоматически соглашаетесь с правилами использования бота.</i>
 
-Что ЗАПРЕЩЕНО делать:
-- Генерировать любой контент, связанный с нецензурной лексикой, призывами к насилию, пропагандой
-ультраправых организаций и т.д.
-- Генерировать любой контент, связанный с предпренимательской деятельностью и рекламой."""
-        
-        keyboard = [[InlineKeyboardButton("✅ Понятно", callback_data="close_rules")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await self.send_safe_message(
-            context, update.effective_chat.id, rules_text,
-            reply_markup=reply_markup
+            context, update.effective_chat.id, self.RULES_TEXT,
+            reply_markup=self.RULES_KEYBOARD
         )
 
     async def queue_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -451,29 +4470,75 @@ class BotHandlers:
         status_text = f"""
 📊 Статус очередей:
 
-📝 Текстовые запросы: {text_queue.qsize()}
-🎨 Генерация изображений: {image_queue.qsize()}
-
+📝 Текстовые запросы: {self.format_queue(text_queue)}
+🎨 Генерация изображений: {self.format_queue(image_queue)}
+{self.format_user_queue(update.effective_user.id)}
 💡 Используйте /status для полной информации
         """
-        await update.message.reply_text(status_text)
+        await self.reply_text(update, status_text)
+
+    @staticmethod
+    def format_queue(queue):
+        """Размер очереди, её предел и ожидание для новой задачи"""
+        text = f"{queue.qsize()}/{queue.max_size}" if queue.max_size else str(queue.qsize())
+        wait = queue.estimate_wait(queue.qsize())
+        if wait is not None and queue.qsize():
+            text += f" (ожидание ≈ {format_duration(wait)})"
+        return text
+
+    @staticmethod
+    def format_user_queue(user_id):
+        """Места задач пользователя в очередях"""
+        lines = []
+        for name, queue in (("📝", text_queue), ("🎨", image_queue)):
+            for ahead, job in enumerate(queue.order()):
+                if job.user_id != user_id:
+                    continue
+                line = f"{name} Ваш запрос: перед ним {ahead}"
+                wait = queue.estimate_wait(ahead)
+                if wait is not None:
+                    line += f", готов через ≈ {format_duration(wait)}"
+                lines.append(line)
+        return "\n" + "\n".join(lines) + "\n" if lines else ""
 
     async def select_model(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /model"""
         user_id = update.effective_user.id
-        current_model = user_models.get(user_id, 'gpt-4o-mini')
+        current_model = user_models.get(user_id, CONFIG['DEFAULT_MODEL'])
         
-        keyboard = []
-        for model_id, model_name in MODELS.items():
-            marker = "✓ " if model_id == current_model else ""
-            keyboard.append([InlineKeyboardButton(f"{marker}{model_name}", callback_data=f"model:{model_id}")])
+        labels = tuple(
+            ("✓ " if model_id == current_model else "") + model_name + self.format_model_latency(model_id)
+            for model_id, model_name in MODELS.items()
+        )
         
-        await update.message.reply_text(
+        await self.reply_text(
+            update,
             f"🤖 Выберите модель для генерации текста:\n\n"
-            f"Текущая модель: {MODELS.get(current_model, current_model)}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            f"Текущая модель: {MODELS.get(current_model, current_model)}\n"
+            f"Рядом с моделью — медианное время ответа за последние запросы",
+            reply_markup=self.model_keyboard(labels)
         )
 
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def model_keyboard(labels):
+        """Клавиатура выбора модели; пока задержки не меняются, берётся готовая"""
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(label, callback_data=f"model:{model_id}")]
+            for label, model_id in zip(labels, MODELS)
+        ])
+
+    def format_model_latency(self, model):
+        """Медианная задержка модели для подписи кнопки ("" без замеров)"""
+        if model == 'auto':
+            return ""
+        resilience = self.api_handler.resilience
+        p50 = resilience.latency(model).percentile(0.5) if model in resilience.latencies else None
+        if p50 is None:
+            return ""
+        marker = " ⛔" if resilience.breaker(model).is_open() else ""
+        return f" · {p50:.1f} с{marker}"
+
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на кнопки"""
         query = update.callback_query
@@ -489,46 +4554,182 @@ class BotHandlers:
             await self.rules(update, context)
         elif data == "show_author":
             await query.answer("Переводим к автору...", show_alert=False)
-            keyboard = [[InlineKeyboardButton("👤 Перейти к автору", url="https://t.me/C0DIX_X")]]
-            await query.edit_message_text(
-                text="👤 <b>Автор бота:</b>\n\nНажми на кнопку ниже, чтобы перейти к автору!",
+            await self.edit_query_message(
+                query,
+                "👤 <b>Автор бота:</b>\n\nНажми на кнопку ниже, чтобы перейти к автору!",
                 parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=self.AUTHOR_KEYBOARD
             )
+        elif data.startswith("cancel:"):
+            job = job_registry.cancel(int(data[7:]), user_id) if data[7:].isdigit() else None
+            if job is None:
+                await self.edit_query_message(query, "ℹ️ Запрос уже выполнен или отменён.")
+            else:
+                await self.edit_query_message(query, JobRegistry.CANCELLED_TEXT)
         elif data.startswith("model:"):
             model_id = data[6:]
             if model_id in MODELS:
                 user_models[user_id] = model_id
-                await query.edit_message_text(
+                await self.edit_query_message(
+                    query,
                     f"✅ Модель изменена на: {MODELS[model_id]}\n\n"
                     f"Теперь все ваши запросы /text будут использовать эту модель."
                 )
             else:
-                await query.edit_message_text("❌ Неизвестная модель")
+                await self.edit_query_message(query, "❌ Неизвестная модель")
 
     async def generate_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /text"""
         if not context.args:
-            await update.message.reply_text("❌ Пожалуйста, укажите запрос.\nПример: /text Расскажи анекдот")
+            await self.reply_text(update, "❌ Пожалуйста, укажите запрос.\nПример: /text Расскажи анекдот")
             return
         
         prompt = ' '.join(context.args)
         chat_id = update.effective_chat.id
         user_id = update.effective_user.id
-        model = user_models.get(user_id, 'gpt-4o-mini')
+        model = user_models.get(user_id, CONFIG['DEFAULT_MODEL'])
+        preferred, model = model, self.shed_model(model)
+        job = Job('text', chat_id, user_id, prompt, model, history=conversations.context(user_id, model, prompt))
+        job.trace = tracer.start('text', model=model, user_id=user_id)
+        with tracer.use(job.trace):
+            await self.enqueue_text(update, context, job, preferred)
+
+    async def enqueue_text(self, update, context, job, preferred):
+        """Отвечает из кэша, присоединяет к такому же запросу или ставит задачу в очередь"""
+        chat_id, user_id, prompt, model = job.chat_id, job.user_id, job.prompt, job.model
+        if job.standalone:
+            # Повторные запросы отдаём из кэша сразу, минуя очередь
+            text = await self.send_cached_text(context, chat_id, prompt, model)
+            if text is not None:
+                conversations.record(user_id, prompt, text)
+                tracer.finish(job.trace, 'cache_hit')
+                return
+            
+            # Такой же запрос уже в работе — ждём его результата вместо нового вызова API
+            flight = text_flights.join(ResponseCache.make_key(model, prompt))
+            if flight is not None:
+                context.application.create_task(
+                    self.deliver_coalesced_text(context, chat_id, user_id, prompt, model, flight)
+                )
+                return
+        
+        # Переполнение проверяем после кэша и объединения: они не нагружают очередь
+        if text_queue.full():
+            await self.reply_overloaded(update, text_queue)
+            tracer.finish(job.trace, 'rejected')
+            return
         
-        await text_queue.put((chat_id, prompt, model, context))
+        if not text_queue.try_put(job):
+            await self.reply_rate_limited(update, text_queue)
+            tracer.finish(job.trace, 'rate_limited')
+            return
+        job_journal.append(job)
+        job_registry.add(job)
+        if job.standalone:
+            text_flights.lead(ResponseCache.make_key(model, prompt))
+        if model != preferred:
+            metrics.shed.inc(queue='text', action='degrade')
+            await self.send_safe_message(
+                context, chat_id,
+                f"ℹ️ Бот сейчас перегружен, поэтому ответит {MODELS.get(model, model)} — так быстрее.",
+                status=True
+            )
+        await queue_feedback.track(context.bot, text_queue, job)
 
     async def generate_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /image"""
         if not context.args:
-            await update.message.reply_text("❌ Пожалуйста, укажите описание изображения.\nПример: /image cute cat playing")
+            await self.reply_text(update, "❌ Пожалуйста, укажите описание изображения.\nПример: /image cute cat playing")
             return
         
         prompt = ' '.join(context.args)
-        chat_id = update.effective_chat.id
+        job = Job('image', update.effective_chat.id, update.effective_user.id, prompt, CONFIG['IMAGE_MODEL'])
+        job.trace = tracer.start('image', model=job.model, user_id=job.user_id)
+        with tracer.use(job.trace):
+            await self.enqueue_image(update, context, job)
+
+    async def enqueue_image(self, update, context, job):
+        """Отправляет изображение из кэша, присоединяет к такому же запросу или ставит задачу в очередь"""
+        chat_id, prompt = job.chat_id, job.prompt
+        # Популярные запросы отдаём по file_id без генерации и повторной загрузки
+        if await self.send_cached_image(context, chat_id, prompt) is not None:
+            tracer.finish(job.trace, 'cache_hit')
+            return
+        
+        flight_key = ResponseCache.make_key(CONFIG['IMAGE_MODEL'], prompt)
+        flight = image_flights.join(flight_key)
+        if flight is not None:
+            context.application.create_task(self.deliver_coalesced_image(context, chat_id, prompt, flight))
+            return
+        
+        # Переполнение проверяем после кэша и объединения: они не нагружают очередь
+        if image_queue.full():
+            await self.reply_overloaded(update, image_queue)
+            tracer.finish(job.trace, 'rejected')
+            return
         
-        await image_queue.put((chat_id, prompt, context))
+        if not image_queue.try_put(job):
+            await self.reply_rate_limited(update, image_queue)
+            tracer.finish(job.trace, 'rate_limited')
+            return
+        job_journal.append(job)
+        job_registry.add(job)
+        image_flights.lead(flight_key)
+        await queue_feedback.track(context.bot, image_queue, job)
+
+    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /cancel — отменяет все запросы пользователя в очереди и в работе"""
+        user_id = update.effective_user.id
+        cancelled = [job for job in job_registry.user_jobs(user_id) if job_registry.cancel(job.job_id, user_id)]
+        if not cancelled:
+            await self.reply_text(update, "ℹ️ У вас нет запросов в очереди или в работе.")
+            return
+        for job in cancelled:
+            await self.mark_cancelled(context, job)
+        await self.reply_text(update, f"🚫 Отменено запросов: {len(cancelled)}")
+
+    async def mark_cancelled(self, context, job):
+        """Заменяет статус отменённой задачи, убирая кнопку отмены"""
+        if job.status_message_id is None:
+            return
+        try:
+            await self.show_status(context, job, JobRegistry.CANCELLED_TEXT, cancellable=False, final=True)
+        except Exception as e:
+            print(f"Не удалось обновить статус отменённого запроса: {e}")
+
+    async def reset(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /reset — забывает историю диалога пользователя"""
+        if not conversations.enabled:
+            await self.reply_text(update, "ℹ️ Режим диалога выключен: каждый запрос обрабатывается отдельно.")
+            return
+        if conversations.reset(update.effective_user.id):
+            await self.reply_text(update, "🧹 История диалога очищена. Начинаем с чистого листа!")
+        else:
+            await self.reply_text(update, "ℹ️ История диалога и так пуста.")
+
+    @staticmethod
+    def shed_model(model):
+        """Модель с учётом нагрузки: при политике degrade переполняющаяся очередь отвечает дешёвой моделью"""
+        if CONFIG['QUEUE_SHED_POLICY'] != 'degrade' or text_queue.load() < CONFIG['QUEUE_DEGRADE_AT']:
+            return model
+        return CONFIG['QUEUE_DEGRADE_MODEL']
+
+    async def reply_overloaded(self, update, queue):
+        """Отказывает в приёме задачи, когда очередь заполнена"""
+        kind = 'text' if queue is text_queue else 'image'
+        metrics.shed.inc(queue=kind, action='reject')
+        text = f"🚦 Бот сейчас перегружен: в очереди {queue.qsize()} запросов."
+        wait = queue.estimate_wait(queue.qsize())
+        if wait is not None:
+            text += f" Попробуйте снова примерно через {format_duration(wait)}."
+        else:
+            text += " Попробуйте снова чуть позже."
+        await self.reply_text(update, text)
+
+    async def reply_rate_limited(self, update, queue):
+        """Сообщает пользователю, что его лимит запросов исчерпан"""
+        wait = max(1, round(queue.retry_after(update.effective_user.id)))
+        await self.reply_text(update, f"⏳ Слишком много запросов. Попробуйте снова через {wait} с.")
 
     async def handle_invalid_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик неизвестных команд"""
@@ -536,63 +4737,117 @@ class BotHandlers:
         
         if message_text.startswith('/'):
             error_text = (f"❌ <b>Неизвестная команда:</b> <code>{self.processor.escape_html(message_text)}</code>\n\n"
-                         f"Доступные команды:\n"
-                         f"• <code>/start</code> - справка и приветствие\n"
-                         f"• <code>/text [запрос]</code> - генерация текста\n"
-                         f"• <code>/image [описание]</code> - генерация изображения\n"
-                         f"• <code>/model</code> - выбор модели\n"
-                         f"• <code>/status</code> - статус бота\n"
-                         f"• <code>/queue</code> - статус очередей\n"
-                         f"• <code>/rules</code> - правила использования")
+                          + self.COMMANDS_HELP)
             await self.send_safe_message(context, update.effective_chat.id, error_text)
         else:
-            help_text = ("ℹ️ Это не команда! Все команды должны начинаться с <code>/</code>\n\n"
-                        "Используйте:\n"
-                        "• <code>/text [запрос]</code> - для генерации текста\n"
-                        "• <code>/image [описание]</code> - для генерации изображения\n"
-                        "• <code>/start</code> - для справки")
-            await self.send_safe_message(context, update.effective_chat.id, help_text)
+            await self.send_safe_message(context, update.effective_chat.id, self.NOT_A_COMMAND_HELP)
 
 
 async def post_init(application: Application):
-    """Инициализация при запуске бота"""
-    api_handler = APIHandler()
-    bot_handlers = BotHandlers(api_handler)
+    """Инициализация при запуске бота
+
+    Независимые шаги идут параллельно: getMe (application.initialize),
+    запуск сервера здоровья и восстановление журнала. Прогрев соединений
+    с Void AI не задерживает запуск вовсе.
+    """
+    # Обработчики созданы в main() — используем тот же экземпляр и HTTP-клиент
+    api_handler = application.bot_data['api_handler']
+    bot_handlers = application.bot_data['bot_handlers']
     
-    # Сохраняем обработчики в контекст бота
-    application.bot_data['api_handler'] = api_handler
-    application.bot_data['bot_handlers'] = bot_handlers
+    # Прогреваем соединения с Void AI в фоне, не задерживая запуск
+    application.bot_data['prewarm_task'] = asyncio.create_task(
+        startup_timer.timed('прогрев Void AI (фон)', api_handler.prewarm())
+    )
     
-    # Запускаем keep-alive сервер
-    keep_alive_server = KeepAliveServer(port=CONFIG['PORT'])
-    keep_alive_server.start()
+    keep_alive_server = KeepAliveServer(port=CONFIG['PORT'], api_handler=api_handler)
+    if CONFIG['UPDATE_MODE'] == 'webhook':
+        keep_alive_server.enable_webhook(application, CONFIG['WEBHOOK_PATH'], CONFIG['WEBHOOK_SECRET'])
     application.bot_data['keep_alive_server'] = keep_alive_server
     
+    await asyncio.gather(
+        # Повторный вызов initialize() (если приложение уже открыто через async with) ничего не делает
+        startup_timer.timed('getMe', application.initialize()),
+        startup_timer.timed('сервер здоровья', keep_alive_server.start()),
+        # Возвращаем в очереди задачи, не завершённые до перезапуска
+        startup_timer.timed('журнал задач', bot_handlers.replay_journal())
+    )
+    
     # Запускаем самопинг
-    self_pinger = SelfPinger(interval=CONFIG['SELF_PING_INTERVAL'])
+    self_pinger = SelfPinger(api_handler.client, interval=CONFIG['SELF_PING_INTERVAL'])
     application.bot_data['self_pinger'] = self_pinger
     asyncio.create_task(self_pinger.start())
     
-    # Запускаем фоновые задачи
-    asyncio.create_task(bot_handlers.process_text_queue())
-    asyncio.create_task(bot_handlers.process_image_queue())
+    # Обновляем места в очереди у ожидающих пользователей
+    application.bot_data['queue_feedback_task'] = asyncio.create_task(queue_feedback.run())
+    
+    # Следим, чтобы синхронный код не блокировал цикл событий
+    application.bot_data['loop_watchdog_task'] = asyncio.create_task(loop_watchdog.run())
+    
+    if CONFIG['ROLE'] == 'ingest':
+        # Задачи выполняют процессы-воркеры, подключённые к брокеру
+        broker_server = BrokerServer(application, CONFIG['BROKER_HOST'], CONFIG['BROKER_PORT'], CONFIG['BROKER_SECRET'])
+        await broker_server.start()
+        application.bot_data['broker_server'] = broker_server
+        worker_processes = WorkerProcesses(CONFIG['WORKER_PROCESSES'], CONFIG['BROKER_SECRET'])
+        worker_processes.start()
+        application.bot_data['worker_processes'] = worker_processes
+    else:
+        # Запускаем пулы воркеров
+        bot_handlers.start_workers()
     
     print("🚀 Бот запущен и готов к работе!")
     print(f"🔧 Keep-alive сервер работает на порту {CONFIG['PORT']}")
     print(f"🔄 Самопинг настроен с интервалом {CONFIG['SELF_PING_INTERVAL']} секунд")
+    if CONFIG['ROLE'] == 'ingest':
+        print(f"👷 Локальных процессов-воркеров: {CONFIG['WORKER_PROCESSES']}")
+    else:
+        print(f"👷 Воркеры: текст {CONFIG['TEXT_WORKERS']}, изображения {CONFIG['IMAGE_WORKERS']}")
 
 
 async def post_stop(application: Application):
     """Очистка при остановке бота"""
+    prewarm_task = application.bot_data.get('prewarm_task')
+    if prewarm_task:
+        prewarm_task.cancel()
+    
     # Останавливаем самопинг
     self_pinger = application.bot_data.get('self_pinger')
     if self_pinger:
         self_pinger.stop()
     
+    queue_feedback.stop()
+    queue_feedback_task = application.bot_data.get('queue_feedback_task')
+    if queue_feedback_task:
+        queue_feedback_task.cancel()
+    
+    loop_watchdog.stop()
+    loop_watchdog_task = application.bot_data.get('loop_watchdog_task')
+    if loop_watchdog_task:
+        loop_watchdog_task.cancel()
+    
     # Останавливаем keep-alive сервер
     keep_alive_server = application.bot_data.get('keep_alive_server')
     if keep_alive_server:
-        keep_alive_server.stop()
+        await keep_alive_server.stop()
+    
+    # Останавливаем брокер и процессы-воркеры
+    worker_processes = application.bot_data.get('worker_processes')
+    if worker_processes:
+        await worker_processes.stop()
+    broker_server = application.bot_data.get('broker_server')
+    if broker_server:
+        await broker_server.stop()
+    
+    # Останавливаем планировщик отправки
+    await send_scheduler.stop()
+    
+    # Дописываем журнал задач
+    await job_journal.close()
+    
+    # Закрываем дисковый кэш и дописываем файл трасс
+    response_cache.close()
+    image_cache.close()
+    await asyncio.to_thread(tracer.close)
     
     # Закрываем API handler
     api_handler = application.bot_data.get('api_handler')
@@ -602,21 +4857,96 @@ async def post_stop(application: Application):
     print("👋 Бот остановлен")
 
 
-def main():
-    """Основная функция запуска бота"""
-    if not CONFIG['TELEGRAM_TOKEN']:
-        print('❌ Ошибка: TELEGRAM_BOT_TOKEN не установлен!')
-        return
+def stop_on_signals():
+    """Событие, которое устанавливается по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+
+async def run_bot(application):
+    """Запуск процесса приёма: long polling или вебхук на keep-alive сервере (CONFIG['PORT'])
+
+    Вместо application.run_polling() жизненный цикл ведём сами, чтобы
+    getMe шёл параллельно с остальной инициализацией (см. post_init).
+    """
+    stop_event = stop_on_signals()
+    webhook = CONFIG['UPDATE_MODE'] == 'webhook'
     
-    if not CONFIG['VOIDAI_API_KEY']:
-        print('❌ Ошибка: VOIDAI_API_KEY не установлен!')
+    try:
+        await post_init(application)
+        await startup_timer.timed('запуск приёма', start_receiving(application, webhook))
+        startup_timer.report()
+        await stop_event.wait()
+    finally:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+
+
+async def start_receiving(application, webhook):
+    """Запускает обработку обновлений и их получение от Telegram"""
+    await application.start()
+    if not webhook:
+        await application.updater.start_polling(drop_pending_updates=True)
         return
+    # Накопившиеся обновления не сбрасываем: во время деплоя Telegram
+    # держит их у себя и доставит новому экземпляру. Вебхук при остановке
+    # не удаляем, чтобы обновления во время перезапуска не терялись
+    await application.bot.set_webhook(
+        url=CONFIG['WEBHOOK_URL'].rstrip('/') + CONFIG['WEBHOOK_PATH'],
+        secret_token=CONFIG['WEBHOOK_SECRET'],
+        max_connections=CONFIG['WEBHOOK_MAX_CONNECTIONS'],
+        allowed_updates=Update.ALL_TYPES
+    )
+    print(f"🪝 Вебхук: {CONFIG['WEBHOOK_URL'].rstrip('/')}{CONFIG['WEBHOOK_PATH']}")
+
+
+async def run_worker():
+    """Процесс-воркер: берёт задачи у процесса приёма, ответы отправляет через него же"""
+    stop_event = stop_on_signals()
+    api_handler = APIHandler()
+    broker = RemoteBroker(CONFIG['BROKER_HOST'], CONFIG['BROKER_PORT'], CONFIG['BROKER_SECRET'])
+    await broker.connect()
+    bot_handlers = BotHandlers(api_handler, broker)
+    asyncio.create_task(api_handler.prewarm())
+    watchdog_task = asyncio.create_task(loop_watchdog.run())
+    workers = bot_handlers.start_workers()
+    print(f"👷 Воркер {os.getpid()} подключён к {CONFIG['BROKER_HOST']}:{CONFIG['BROKER_PORT']}")
+    
+    disconnected = asyncio.create_task(broker.disconnected.wait())
+    stopping = asyncio.create_task(stop_event.wait())
+    await asyncio.wait([disconnected, stopping], return_when=asyncio.FIRST_COMPLETED)
+    for task in (*workers, disconnected, stopping, watchdog_task):
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await send_scheduler.stop()
+    await broker.close()
+    response_cache.close()
+    image_cache.close()
+    await asyncio.to_thread(tracer.close)
+    await api_handler.close()
+
+
+def build_application():
+    """Создаёт приложение с обработчиками (используется в main() и в benchmarks/bench_e2e.py)"""
+    # telegram.ext нужен только процессу приёма — воркеры его не импортируют
+    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
     
-    application = Application.builder().token(CONFIG['TELEGRAM_TOKEN']).post_init(post_init).post_stop(post_stop).build()
+    builder = Application.builder().token(CONFIG['TELEGRAM_TOKEN'])
+    if CONFIG['TELEGRAM_API_URL']:
+        builder = builder.base_url(CONFIG['TELEGRAM_API_URL'])
+    application = builder.build()
     
-    # Получаем обработчики из контекста
+    # Создаём обработчики и единственный HTTP-клиент Void AI
     api_handler = APIHandler()
-    bot_handlers = BotHandlers(api_handler)
+    bot_handlers = BotHandlers(api_handler, LocalBroker(application))
     
     # Сохраняем в контекст приложения
     application.bot_data['api_handler'] = api_handler
@@ -631,12 +4961,42 @@ def main():
         CommandHandler("model", bot_handlers.select_model),
         CommandHandler("text", bot_handlers.generate_text),
         CommandHandler("image", bot_handlers.generate_image),
+        CommandHandler("cancel", bot_handlers.cancel),
+        CommandHandler("reset", bot_handlers.reset),
         CallbackQueryHandler(bot_handlers.button_callback),
         MessageHandler(filters.TEXT, bot_handlers.handle_invalid_command)
     ]
     
     for handler in handlers:
         application.add_handler(handler)
+    return application
+
+
+def main():
+    """Основная функция запуска бота"""
+    if CONFIG['ROLE'] == 'worker':
+        if not CONFIG['VOIDAI_API_KEYS'] or not os.getenv('BROKER_SECRET'):
+            print('❌ Ошибка: воркеру нужны VOIDAI_API_KEY и BROKER_SECRET!')
+            return
+        asyncio.run(run_worker())
+        return
+    
+    if not CONFIG['TELEGRAM_TOKEN']:
+        print('❌ Ошибка: TELEGRAM_BOT_TOKEN не установлен!')
+        return
+    
+    if not CONFIG['VOIDAI_API_KEYS']:
+        print('❌ Ошибка: не установлен ни VOIDAI_API_KEY, ни VOIDAI_API_KEYS!')
+        return
+    
+    if CONFIG['UPDATE_MODE'] == 'webhook' and not CONFIG['WEBHOOK_URL']:
+        print('❌ Ошибка: для UPDATE_MODE=webhook нужен WEBHOOK_URL!')
+        return
+    
+    startup_timer.mark('модуль', IMPORTS_DONE)
+    started = time.perf_counter()
+    application = build_application()
+    startup_timer.mark('приложение', started)
     
     print('✅ AI Бот запущен и готов к работе 24/7!')
     print('📝 Текстовая очередь готова')
@@ -644,11 +5004,7 @@ def main():
     print('🛡 Анти-слип система активирована')
     
     try:
-        # Для Render.com используем polling с обработкой прерываний
-        application.run_polling(
-            drop_pending_updates=True,
-            close_loop=False
-        )
+        asyncio.run(run_bot(application))
     except KeyboardInterrupt:
         print("👋 Бот остановлен пользователем")
     except Exception as e: